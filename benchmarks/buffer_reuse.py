@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+import argparse
+import os
+import resource
+import threading
+import time
+import cv2
+import numpy
+import psutil
+from insightface.utils import face_align
+
+import roop.processors.frame.face_swapper as face_swapper
+from roop.typing import Frame
+
+RSS_SAMPLE_INTERVAL = 0.002
+CROP_SIZE = 128
+
+
+def parse_args() -> argparse.Namespace:
+    program = argparse.ArgumentParser(prog='python -m benchmarks.buffer_reuse', formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('--resolution', help='frame resolution', dest='resolution', default='3840x2160')
+    program.add_argument('--threads', help='number of execution threads', dest='threads', type=int, default=8)
+    program.add_argument('--frame-total', help='number of frames per thread', dest='frame_total', type=int, default=100)
+    program.add_argument('--rounds', help='number of alternating runs of each swap path', dest='rounds', type=int, default=3)
+    program.add_argument('--face-size', help='size of the swapped face in pixels', dest='face_size', type=int, default=600)
+    return program.parse_args()
+
+
+def install_model() -> Any:
+    # the model is replaced by a fixed prediction, only the work around it is measured
+
+    prediction = numpy.random.default_rng(0).random((1, 3, CROP_SIZE, CROP_SIZE), dtype=numpy.float32)
+    face_swapper.FACE_SWAPPER = SimpleNamespace(
+        input_size=(CROP_SIZE, CROP_SIZE),
+        input_mean=0.0,
+        input_std=255.0,
+        input_names=['target', 'source'],
+        output_names=['output'],
+        session=SimpleNamespace(run=lambda output_names, input_feed: [prediction.copy()])
+    )
+    return SimpleNamespace(latent=numpy.ones((1, 512), dtype=numpy.float32))
+
+
+def create_target_face(width: int, height: int, face_size: int) -> Any:
+    # arcface landmarks scaled around the frame center
+
+    kps = face_align.arcface_dst / 112 * face_size + (width / 2 - face_size / 2, height / 2 - face_size / 2)
+    return SimpleNamespace(kps=kps.astype(numpy.float32))
+
+
+def swap_face_fresh(source_face: Any, target_face: Any, temp_frame: Frame) -> Frame:
+    # the swap as it was before the thread buffers, every step allocates its result
+
+    return swap_face_fresh_crop(source_face, target_face, temp_frame, paste_back_fresh)
+
+
+def swap_face_fresh_crop(source_face: Any, target_face: Any, temp_frame: Frame, paste_back: Callable[[Frame, Frame, Frame], Frame] = face_swapper.paste_back) -> Frame:
+    # without the crop and prediction buffers only, the paste back still reuses its region buffers
+
+    face_swapper_model = face_swapper.get_face_swapper()
+    crop_frame, affine_matrix = face_align.norm_crop2(temp_frame, target_face.kps, face_swapper_model.input_size[0])
+    crop_blob = cv2.dnn.blobFromImage(crop_frame, 1.0 / face_swapper_model.input_std, face_swapper_model.input_size, (face_swapper_model.input_mean, face_swapper_model.input_mean, face_swapper_model.input_mean), swapRB=True)
+    prediction = face_swapper_model.session.run(face_swapper_model.output_names, {
+        face_swapper_model.input_names[0]: crop_blob,
+        face_swapper_model.input_names[1]: face_swapper.get_source_latent(source_face)
+    })[0]
+    swapped_face = numpy.clip(255 * prediction.transpose((0, 2, 3, 1))[0], 0, 255).astype(numpy.uint8)[:, :, ::-1]
+    return paste_back(temp_frame, swapped_face, affine_matrix)
+
+
+def paste_back_fresh(temp_frame: Frame, swapped_face: Frame, affine_matrix: Frame) -> Frame:
+    crop_size = swapped_face.shape[0]
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    crop_corners = numpy.array([[[0, 0], [crop_size, 0], [0, crop_size], [crop_size, crop_size]]], dtype=numpy.float32)
+    frame_corners = cv2.transform(crop_corners, inverse_matrix)[0]
+    frame_height, frame_width = temp_frame.shape[:2]
+    min_x, min_y = numpy.clip(frame_corners.min(axis=0), 0, (frame_width - 1, frame_height - 1))
+    max_x, max_y = numpy.clip(frame_corners.max(axis=0), 0, (frame_width - 1, frame_height - 1))
+    mask_size = int(numpy.sqrt((max_x - min_x) * (max_y - min_y)))
+    erode_size = max(mask_size // 10, 10)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    margin = blur_size + 2
+    start_x = max(int(min_x) - margin, 0)
+    start_y = max(int(min_y) - margin, 0)
+    end_x = min(int(max_x) + margin, frame_width)
+    end_y = min(int(max_y) + margin, frame_height)
+
+    if start_x >= end_x or start_y >= end_y:
+        return temp_frame
+
+    region_matrix = inverse_matrix.copy()
+    region_matrix[:, 2] -= (start_x, start_y)
+    region_size = (end_x - start_x, end_y - start_y)
+    temp_region = temp_frame[start_y:end_y, start_x:end_x]
+    swapped_region = cv2.warpAffine(swapped_face, region_matrix, region_size, borderValue=0.0)
+    mask_region = cv2.warpAffine(numpy.full((crop_size, crop_size), 255, dtype=numpy.float32), region_matrix, region_size, borderValue=0.0)
+    mask_region = cv2.threshold(mask_region, 20, 1, cv2.THRESH_BINARY)[1]
+    mask_region = cv2.erode(mask_region, numpy.ones((erode_size, erode_size), dtype=numpy.uint8))
+    mask_region = cv2.GaussianBlur(mask_region, (blur_size, blur_size), 0)
+    merge_region = (swapped_region.astype(numpy.float32) - temp_region) * mask_region[:, :, numpy.newaxis] + temp_region
+    temp_frame[start_y:end_y, start_x:end_x] = merge_region.astype(numpy.uint8)
+    return temp_frame
+
+
+def write_frame_copying(output_file: Any, temp_frame: Frame) -> None:
+    output_file.write(temp_frame.tobytes())
+
+
+def write_frame_direct(output_file: Any, temp_frame: Frame) -> None:
+    output_file.write(numpy.ascontiguousarray(temp_frame).data)
+
+
+def measure(run: Callable[[], None], frame_total: int) -> Dict[str, float]:
+    process = psutil.Process(os.getpid())
+    start_rss = process.memory_info().rss
+    peak_rss = start_rss
+    done = threading.Event()
+
+    def sample() -> None:
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, process.memory_info().rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start_faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start_time = time.perf_counter()
+    run()
+    run_time = time.perf_counter() - start_time
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - start_faults
+    done.set()
+    sampler.join()
+
+    return {
+        'frames_per_second': frame_total / run_time,
+        'peak_rss_mb': (peak_rss - start_rss) / 1024 ** 2,
+        'page_faults_per_frame': faults / frame_total
+    }
+
+
+def benchmark_swap(swap: Callable[[Any, Any, Frame], Frame], executor: ThreadPoolExecutor, source_face: Any, target_face: Any, temp_frames: List[Frame], frame_total: int) -> Dict[str, float]:
+    def run_thread(temp_frame: Frame) -> None:
+        for _ in range(frame_total):
+            swap(source_face, target_face, temp_frame)
+
+    def run() -> None:
+        for future in [executor.submit(run_thread, temp_frame) for temp_frame in temp_frames]:
+            future.result()
+
+    return measure(run, frame_total * len(temp_frames))
+
+
+def benchmark_write(write: Callable[[Any, Frame], None], temp_frame: Frame, frame_total: int) -> Dict[str, float]:
+    def run() -> None:
+        with open(os.devnull, 'wb') as output_file:
+            for _ in range(frame_total):
+                write(output_file, temp_frame)
+
+    return measure(run, frame_total)
+
+
+def format_result(name: str, result: Dict[str, float]) -> str:
+    return f'{name:<22} {result["frames_per_second"]:>10.1f} fps {result["peak_rss_mb"]:>10.1f} MB peak rss {result["page_faults_per_frame"]:>10.1f} page faults per frame'
+
+
+def run() -> None:
+    args = parse_args()
+    width, height = map(int, args.resolution.split('x'))
+    source_face = install_model()
+    target_face = create_target_face(width, height, args.face_size)
+    temp_frames = [numpy.random.default_rng(thread).integers(0, 255, (height, width, 3), dtype=numpy.uint8) for thread in range(args.threads)]
+
+    print(f'{args.resolution}, {args.threads} threads, {args.frame_total} frames per thread, {args.face_size}px face')
+
+    # both paths compute the same frame, only how their intermediate arrays are allocated differs
+
+    buffered_frame = face_swapper.swap_face(source_face, target_face, temp_frames[0].copy())
+    fresh_frame = swap_face_fresh(source_face, target_face, temp_frames[0].copy())
+    print(f'buffered and fresh swap differ by at most {numpy.abs(buffered_frame.astype(numpy.int16) - fresh_frame).max()}')
+
+    # the threads live through all runs like the execution threads do, a first run warms the allocator and the thread buffers up
+    # the paths alternate so neither one profits from running last
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for _ in range(args.rounds):
+            for name, swap in [('swap fresh', swap_face_fresh), ('swap fresh crop', swap_face_fresh_crop), ('swap buffered', face_swapper.swap_face)]:
+                benchmark_swap(swap, executor, source_face, target_face, temp_frames, args.frame_total // 4 or 1)
+                print(format_result(name, benchmark_swap(swap, executor, source_face, target_face, temp_frames, args.frame_total)))
+
+    for name, write in [('encoder write tobytes', write_frame_copying), ('encoder write direct', write_frame_direct)]:
+        benchmark_write(write, temp_frames[0], args.frame_total // 4 or 1)
+        print(format_result(name, benchmark_write(write, temp_frames[0], args.frame_total)))
+
+
+if __name__ == '__main__':
+    run()
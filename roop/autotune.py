@@ -0,0 +1,164 @@
+from typing import Any, Dict, List, Tuple
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import roop.globals
+
+from roop.face_analyser import clear_face_analyser
+from roop.face_reference import get_face_reference, set_face_reference
+from roop.file import get_models_directory_path, lock_file
+from roop.processors.frame.core import get_frame_processor_batch_size, get_frame_processors_modules, get_frame_resolution
+from roop.progress import update_status
+
+AUTOTUNE_FILE = 'autotune.json'
+AUTOTUNE_FRAME_TOTAL = 16
+AUTOTUNE_EXECUTION_THREADS = [1, 2, 4, 8, 16]
+AUTOTUNE_BATCH_SIZES = [1, 2, 4, 8]
+NAME = 'ROOP.AUTOTUNE'
+
+
+def get_autotune_key(frame_file_path: str) -> str:
+    width, height = get_frame_resolution(frame_file_path)
+    model_names = '+'.join(roop.globals.frame_processors)
+    execution_providers = '+'.join(roop.globals.execution_providers)
+
+    return f'{socket.gethostname()}|{execution_providers}|{model_names}|{roop.globals.model_precision}|{roop.globals.detection_size}|{width}x{height}'
+
+
+def get_batch_size() -> int:
+    return max(get_frame_processor_batch_size(frame_processor) for frame_processor in get_frame_processors_modules(roop.globals.frame_processors))
+
+
+def get_autotune_batch_sizes() -> List[int]:
+    # 0 keeps the preferred batch size, only processors that batch are measured with others
+
+    if any(hasattr(frame_processor, 'BATCH_SIZE') for frame_processor in get_frame_processors_modules(roop.globals.frame_processors)):
+        return AUTOTUNE_BATCH_SIZES
+    return [0]
+
+
+def read_autotune() -> Dict[str, Dict[str, Any]]:
+    autotune_file_path = os.path.join(get_models_directory_path(), AUTOTUNE_FILE)
+
+    try:
+        with open(autotune_file_path) as autotune_file:
+            return json.load(autotune_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_autotune(autotune_key: str, autotune_result: Dict[str, Any]) -> None:
+    autotune_file_path = os.path.join(get_models_directory_path(), AUTOTUNE_FILE)
+    os.makedirs(get_models_directory_path(), exist_ok=True)
+
+    with lock_file(autotune_file_path + '.lock'):
+        autotune = read_autotune()
+        autotune[autotune_key] = autotune_result
+        with open(autotune_file_path + '.part', 'w') as autotune_file:
+            json.dump(autotune, autotune_file, indent=4)
+        os.replace(autotune_file_path + '.part', autotune_file_path)
+
+
+def get_autotune_candidates() -> List[Tuple[int, int, int]]:
+    cpu_count = os.cpu_count() or 1
+    batch_sizes = get_autotune_batch_sizes()
+
+    # gpu providers scale with concurrent runs, cpu runs share the cores between both levels
+
+    if roop.globals.execution_providers != ['CPUExecutionProvider']:
+        return [(execution_threads, 0, batch_size) for execution_threads in AUTOTUNE_EXECUTION_THREADS for batch_size in batch_sizes]
+
+    candidates = []
+    for execution_threads in AUTOTUNE_EXECUTION_THREADS:
+        if execution_threads <= cpu_count:
+            for intra_op_threads in sorted({1, max(cpu_count // execution_threads, 1)}):
+                for batch_size in batch_sizes:
+                    candidates.append((execution_threads, intra_op_threads, batch_size))
+    return candidates
+
+
+def clear_models() -> None:
+    face_reference = get_face_reference()
+
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        frame_processor.post_process()
+    clear_face_analyser()
+
+    # post_process also forgets the reference face, it was chosen before calibrating and still applies
+
+    if face_reference is not None:
+        set_face_reference(face_reference)
+
+
+def measure(sorted_frame_file_paths: List[str], calibration_directory_path: str) -> float:
+    calibration_frame_file_paths = []
+
+    for frame_file_path in sorted_frame_file_paths:
+        calibration_frame_file_path = os.path.join(calibration_directory_path, os.path.basename(frame_file_path))
+        shutil.copy2(frame_file_path, calibration_frame_file_path)
+        calibration_frame_file_paths.append(calibration_frame_file_path)
+
+    # the first batch loads the models and is not timed
+
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        frame_processor.process_frames(roop.globals.replacement_path, calibration_frame_file_paths[:get_batch_size()], None)
+
+    start_time = time.perf_counter()
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        frame_processor.process_frames(roop.globals.replacement_path, calibration_frame_file_paths, None)
+    return len(calibration_frame_file_paths) / (time.perf_counter() - start_time)
+
+
+def autotune(sorted_frame_file_paths: List[str]) -> None:
+    autotune_key = get_autotune_key(sorted_frame_file_paths[0])
+    autotune_result = read_autotune().get(autotune_key)
+
+    # batching processors take the frames by batch, the largest batch gets as many batches as single frames otherwise
+
+    if autotune_result is None:
+        autotune_result = calibrate(sorted_frame_file_paths[:AUTOTUNE_FRAME_TOTAL * max(get_autotune_batch_sizes() + [1])])
+        update_autotune(autotune_key, autotune_result)
+    else:
+        update_status(f'Using cached calibration for {autotune_key}', NAME)
+
+    roop.globals.execution_threads = autotune_result['execution_threads']
+    roop.globals.execution_intra_op_threads = autotune_result['intra_op_threads']
+    roop.globals.execution_batch_size = autotune_result.get('batch_size', 0)
+    update_status(f'Execution threads {roop.globals.execution_threads}, intra op threads {roop.globals.execution_intra_op_threads or "auto"}, batch size {roop.globals.execution_batch_size or "preferred"} at {autotune_result["frames_per_second"]:.2f} frames per second', NAME)
+
+
+def calibrate(sorted_frame_file_paths: List[str]) -> Dict[str, Any]:
+    many_faces = roop.globals.many_faces
+    autotune_result: Dict[str, Any] = {}
+    calibration_directory_path = tempfile.mkdtemp(prefix='roop-autotune-')
+
+    # every face counts without a reference, the reference is only known once processing starts
+
+    roop.globals.many_faces = True
+
+    try:
+        for execution_threads, intra_op_threads, batch_size in get_autotune_candidates():
+            roop.globals.execution_threads = execution_threads
+            roop.globals.execution_intra_op_threads = intra_op_threads
+            roop.globals.execution_batch_size = batch_size
+            clear_models()
+            frames_per_second = measure(sorted_frame_file_paths, calibration_directory_path)
+            update_status(f'Execution threads {execution_threads}, intra op threads {intra_op_threads or "auto"}, batch size {batch_size or "preferred"}: {frames_per_second:.2f} frames per second', NAME)
+
+            if frames_per_second > autotune_result.get('frames_per_second', 0):
+                autotune_result = {
+                    'execution_threads': execution_threads,
+                    'intra_op_threads': intra_op_threads,
+                    'batch_size': batch_size,
+                    'frames_per_second': frames_per_second
+                }
+    finally:
+        roop.globals.many_faces = many_faces
+        clear_models()
+        shutil.rmtree(calibration_directory_path, ignore_errors=True)
+
+    return autotune_result
@@ -1,22 +1,111 @@
-from typing import Optional
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import threading
 import cv2
 
+from roop.probe import probe, probe_packets
 from roop.typing import Frame
 
+VIDEO_CAPTURES: Dict[str, Any] = {}
+VIDEO_POSITIONS: Dict[str, int] = {}
+VIDEO_INDEXES: Dict[str, Tuple[List[int], List[float]]] = {}
+VIDEO_FRAMES: OrderedDict[Tuple[str, int], Frame] = OrderedDict()
+VIDEO_FRAMES_SIZE = 8
+VIDEO_DECODE_DISTANCE = 30
+THREAD_LOCK = threading.RLock()
+
+
+def get_video_capture(video_path: str) -> Any:
+    if video_path not in VIDEO_CAPTURES:
+        VIDEO_CAPTURES[video_path] = cv2.VideoCapture(video_path)
+        VIDEO_POSITIONS[video_path] = 0
+        threading.Thread(target=index_video, args=(video_path, VIDEO_CAPTURES[video_path]), daemon=True).start()
+
+    return VIDEO_CAPTURES[video_path]
+
+
+def index_video(video_path: str, capture: Any) -> None:
+    # listing every packet takes seconds on long videos, frames are served by the probe until the index is ready
+
+    video_index = create_video_index(video_path)
+
+    with THREAD_LOCK:
+        if VIDEO_CAPTURES.get(video_path) is capture:
+            VIDEO_INDEXES[video_path] = video_index
+
+
+def create_video_index(video_path: str) -> Tuple[List[int], List[float]]:
+    # packets are listed in decode order, sorting by pts yields the frame numbers
+
+    packets = sorted(probe_packets(video_path))
+    keyframe_numbers = [frame_number for frame_number, (_, is_keyframe) in enumerate(packets) if is_keyframe]
+    timestamps = [pts_time for pts_time, _ in packets]
+    return keyframe_numbers, timestamps
+
+
+def can_decode_forward(video_path: str, position: int, frame_number: int) -> bool:
+    if frame_number < position:
+        return False
+
+    keyframe_numbers, _ = VIDEO_INDEXES.get(video_path, ([], []))
+
+    # seeking would decode from the same keyframe anyway
+
+    if keyframe_numbers:
+        keyframe_index = bisect_right(keyframe_numbers, frame_number) - 1
+        return keyframe_index < 0 or keyframe_numbers[keyframe_index] <= position
+
+    return frame_number - position <= VIDEO_DECODE_DISTANCE
+
+
 def get_video_frame(video_path: str, frame_number: int = 0) -> Optional[Frame]:
-    capture = cv2.VideoCapture(video_path)
-    frame_total = capture.get(cv2.CAP_PROP_FRAME_COUNT)
-    capture.set(cv2.CAP_PROP_POS_FRAMES, min(frame_total, frame_number - 1))
-    has_frame, frame = capture.read()
-    capture.release()
+    with THREAD_LOCK:
+        capture = get_video_capture(video_path)
+        frame_total = get_video_frame_total(video_path)
+        frame_number = max(min(frame_total, frame_number - 1), 0)
+
+        if (video_path, frame_number) in VIDEO_FRAMES:
+            VIDEO_FRAMES.move_to_end((video_path, frame_number))
+            return VIDEO_FRAMES[(video_path, frame_number)].copy()
+
+        position = VIDEO_POSITIONS[video_path]
+
+        if not can_decode_forward(video_path, position, frame_number):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            position = frame_number
 
-    if has_frame:
-        return frame
+        while position < frame_number and capture.grab():
+            position += 1
+
+        has_frame, frame = capture.read()
+        VIDEO_POSITIONS[video_path] = position + 1 if has_frame else frame_total
+
+        if has_frame:
+            VIDEO_FRAMES[(video_path, frame_number)] = frame
+            while len(VIDEO_FRAMES) > VIDEO_FRAMES_SIZE:
+                VIDEO_FRAMES.popitem(last=False)
+            return frame.copy()
 
     return None
 
+
 def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    with THREAD_LOCK:
+        get_video_capture(video_path)
+        _, timestamps = VIDEO_INDEXES.get(video_path, ([], []))
+
+        if timestamps:
+            return len(timestamps)
+
+        return probe(video_path)['frame_total']
+
+
+def release_video_captures() -> None:
+    with THREAD_LOCK:
+        for capture in VIDEO_CAPTURES.values():
+            capture.release()
+        VIDEO_CAPTURES.clear()
+        VIDEO_POSITIONS.clear()
+        VIDEO_INDEXES.clear()
+        VIDEO_FRAMES.clear()
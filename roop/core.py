@@ -2,15 +2,16 @@ import os
 import sys
 
 # single thread doubles cuda performance
-# this needs to be set before torch import
+# this needs to be set before torch import, autotune measures the thread counts instead
 
-if any(arg.startswith('--execution-provider') for arg in sys.argv):
+if any(arg.startswith('--execution-provider') for arg in sys.argv) and '--autotune' not in sys.argv:
     os.environ['OMP_NUM_THREADS'] = '1'
 
 # reduce tensorflow log level
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
+from concurrent.futures import ThreadPoolExecutor
 from time import gmtime, strftime
 from typing import List
 
@@ -26,11 +27,16 @@ import roop.globals
 import roop.metadata
 import roop.ui as ui
 
-from roop.ffmpeg import detect_fps, extract_frames, create_video, restore_audio
-from roop.file import get_temp_directory_path, has_image_extension, is_image, is_video, get_sorted_frame_file_paths, create_temp_directory, move_temp_file, clean_temp_directory, normalize_output_file_path
-from roop.predictor import predict_image, predict_video
-from roop.processors.frame.core import get_frame_processors_modules
+from roop.autotune import autotune
+from roop.draft import DRAFT_HEIGHT, apply_draft_settings, get_draft_fps, open_draft_decisions, save_draft_decisions, close_draft_decisions
+from roop.face_store import open_face_store, save_face_store, close_face_store
+from roop.ffmpeg import detect_fps, has_audio_stream, extract_frames, create_video, open_video_encoder, write_video_frame, close_video_encoder
+from roop.file import estimate_temp_frames_size, select_temp_directory, get_temp_directory_path, get_temp_output_file_path, get_image_file_paths, get_image_output_file_paths, has_image_extension, is_image, is_image_directory, is_video, get_sorted_frame_file_paths, create_temp_directory, move_temp_file, clean_temp_directory, normalize_output_file_path
+from roop.live import start_live
+from roop.predictor import predict_image, predict_images, predict_video
+from roop.processors.frame.core import start_warm_up, get_face_analyser_modules, get_frame_processors_modules, get_frame_resolution, set_frame_encoder, clear_frame_encoder
 from roop.progress import update_status
+from roop.shard import start_shard
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -39,7 +45,7 @@ warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
 def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
-    program.add_argument('-i', '--input', help='input image or video file', dest='input_path')
+    program.add_argument('-i', '--input', help='input image, video file, image directory or glob', dest='input_path')
     program.add_argument('-r', '--replacement', help='replacement image file', dest='replacement_path')
     program.add_argument('-o', '--output', help='output file or directory', dest='output_path')
     program.add_argument('--frame-processors', help='frame processors (e.g., face_swapper, face_enhancer, ...)', dest='frame_processors', default=['face_swapper'], nargs='+')
@@ -48,19 +54,40 @@ def parse_args() -> None:
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true')
     program.add_argument('--reprocess-frames', help='reprocess temporary frames', dest='reprocess_frames', action='store_true')
     program.add_argument('--render-only', help='only generate a video from the temporary frames', dest='render_only', action='store_true')
+    program.add_argument('--draft', help='quickly render a low resolution preview and keep its face matches for the full render', dest='draft', action='store_true')
     program.add_argument('--skip-video', help='skip video creation', dest='skip_video', action='store_true')
     program.add_argument('--skip-audio', help='skip copying audio to video', dest='skip_audio', action='store_true')
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true')
     program.add_argument('--reference-face-position', help='position of the reference face', dest='reference_face_position', type=int, default=0)
     program.add_argument('--reference-frame-number', help='number of the reference frame', dest='reference_frame_number', type=int, default=0)
     program.add_argument('--similar-face-distance', help='face distance used for recognition', dest='similar_face_distance', type=float, default=0.85)
+    program.add_argument('--face-analyser-profile', help='face analysis modules to load, minimal loads only those the frame processors need', dest='face_analyser_profile', default='minimal', choices=['minimal', 'full'])
+    program.add_argument('--detection-size', help='input size of the face detector', dest='detection_size', type=int, default=640, choices=[320, 480, 640, 800, 960, 1280])
+    program.add_argument('--detection-proxy-size', help='detect faces on a frame downscaled to this longest side', dest='detection_proxy_size', type=int)
+    program.add_argument('--temp-directory', help='directories to extract frames to, the first with room for them is used before the input directory (default: /dev/shm and the system temp directory)', dest='temp_directories', nargs='+')
     program.add_argument('--temp-frame-format', help='image format used for frame extraction', dest='temp_frame_format', default='png', choices=['jpg', 'png'])
     program.add_argument('--temp-frame-quality', help='image quality used for frame extraction', dest='temp_frame_quality', type=int, default=0, choices=range(101), metavar='[0-100]')
     program.add_argument('--output-video-encoder', help='encoder used for the output video', dest='output_video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9', 'h264_nvenc', 'hevc_nvenc'])
     program.add_argument('--output-video-lossiness', help='the amount of lossiness for the output video', dest='output_video_lossiness', type=int, default=35, choices=range(101), metavar='[0-100]')
+    program.add_argument('--output-video-format', help='container of the output video, fmp4 and hls are playable while processing', dest='output_video_format', default='mp4', choices=['mp4', 'fmp4', 'hls'])
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int)
+    program.add_argument('--models-directory', help='directory to download and load models from, can be shared between installs', dest='models_directory', default=os.environ.get('ROOP_MODELS_DIRECTORY'))
     program.add_argument('--execution-provider', help='available execution provider (choices: cpu, cuda, mps, ...)', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-intra-op-threads', help='number of onnxruntime threads per execution thread, 0 lets onnxruntime decide', dest='execution_intra_op_threads', type=int, default=0)
+    program.add_argument('--execution-batch-size', help='number of frames per batch for processors that batch, 0 uses their preferred size', dest='execution_batch_size', type=int, default=0)
+    program.add_argument('--autotune', help='measure execution threads, intra op threads and batch size on the first frames and cache the fastest per host', dest='autotune', action='store_true')
+    program.add_argument('--model-precision', help='precision of the face swapper and analyser models, int8 needs models from python -m roop.quantize', dest='model_precision', default='fp32', choices=['fp32', 'int8'])
+    program.add_argument('--io-threads', help='number of threads reading and writing frames', dest='io_threads', type=int, default=suggest_io_threads(), choices=range(1, 33), metavar='[1-32]')
+    program.add_argument('--live', help='stream from an input pipe or url to an output pipe or url in real time', dest='live', action='store_true')
+    program.add_argument('--live-latency', help='latency budget per frame in milliseconds, older frames are dropped', dest='live_latency', type=int, default=200)
+    program.add_argument('--live-resolution', help='resolution of a raw bgr24 live input (e.g., 1280x720)', dest='live_resolution')
+    program.add_argument('--live-fps', help='frame rate of the live input', dest='live_fps', type=float)
+    program.add_argument('--shard-count', help='split the video into this many shards processed by separate workers', dest='shard_count', type=int)
+    program.add_argument('--shard-index', help='process only this shard as a worker', dest='shard_index', type=int)
+    program.add_argument('--shard-directory', help='shared directory for shard frames, segments and status', dest='shard_directory')
+    program.add_argument('--shard-workers', help='number of local shard workers, 0 waits for remote workers', dest='shard_workers', type=int)
+    program.add_argument('--shard-retries', help='number of retries for a failed shard', dest='shard_retries', type=int, default=2)
     program.add_argument('-v', '--version', action='version', version=f'{roop.metadata.name} {roop.metadata.version}')
 
     args = program.parse_args()
@@ -68,6 +95,8 @@ def parse_args() -> None:
     roop.globals.input_path = args.input_path
     roop.globals.replacement_path = args.replacement_path
     roop.globals.output_path = normalize_output_file_path(roop.globals.replacement_path, roop.globals.input_path, args.output_path)
+    if roop.globals.output_path and args.output_video_format == 'hls' and is_video(roop.globals.input_path):
+        roop.globals.output_path = os.path.splitext(roop.globals.output_path)[0] + '.m3u8'
     roop.globals.headless = roop.globals.replacement_path is not None and roop.globals.input_path is not None and roop.globals.output_path is not None
     roop.globals.frame_processors = args.frame_processors
     roop.globals.allow_nsfw = args.allow_nsfw
@@ -75,19 +104,43 @@ def parse_args() -> None:
     roop.globals.keep_frames = args.keep_frames
     roop.globals.reprocess_frames = args.reprocess_frames
     roop.globals.render_only = args.render_only
+    roop.globals.draft = args.draft
     roop.globals.skip_video = args.skip_video
     roop.globals.skip_audio = args.skip_audio
     roop.globals.many_faces = args.many_faces
     roop.globals.reference_face_position = args.reference_face_position
     roop.globals.reference_frame_number = args.reference_frame_number
     roop.globals.similar_face_distance = args.similar_face_distance
+    roop.globals.face_analyser_profile = args.face_analyser_profile
+    roop.globals.detection_size = args.detection_size
+    roop.globals.detection_proxy_size = args.detection_proxy_size
+    roop.globals.temp_directories = args.temp_directories
     roop.globals.temp_frame_format = args.temp_frame_format
     roop.globals.temp_frame_quality = args.temp_frame_quality
     roop.globals.output_video_encoder = args.output_video_encoder
     roop.globals.output_video_lossiness = args.output_video_lossiness
+    roop.globals.output_video_format = args.output_video_format
     roop.globals.max_memory = args.max_memory
+    roop.globals.models_directory = args.models_directory
     roop.globals.execution_providers = decode_execution_providers(args.execution_provider)
     roop.globals.execution_threads = args.execution_threads
+    roop.globals.execution_intra_op_threads = args.execution_intra_op_threads
+    roop.globals.execution_batch_size = args.execution_batch_size
+    roop.globals.autotune = args.autotune
+    roop.globals.model_precision = args.model_precision
+    roop.globals.io_threads = args.io_threads
+    roop.globals.live = args.live
+    roop.globals.live_latency = args.live_latency
+    roop.globals.live_resolution = args.live_resolution
+    roop.globals.live_fps = args.live_fps
+    roop.globals.shard_count = args.shard_count
+    roop.globals.shard_index = args.shard_index
+    roop.globals.shard_directory = args.shard_directory
+    roop.globals.shard_workers = args.shard_count if args.shard_workers is None else args.shard_workers
+    roop.globals.shard_retries = args.shard_retries
+
+    if roop.globals.draft:
+        apply_draft_settings()
 
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
@@ -110,6 +163,10 @@ def suggest_execution_threads() -> int:
     return 1
 
 
+def suggest_io_threads() -> int:
+    return min(max((os.cpu_count() or 1) // 4, 1), 4)
+
+
 def limit_resources() -> None:
     # prevent tensorflow memory leak
 
@@ -156,18 +213,19 @@ def process_image() -> None:
             update_status('Processing image halted: NSFW detected!')
             destroy()
 
-    shutil.copy2(roop.globals.input_path, roop.globals.output_path)
+    # the first frame processor writes straight to the output, the others work on it in place
 
-    # process image
+    input_path = roop.globals.input_path
 
     for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
         update_status('Processing...', frame_processor.NAME)
-        frame_processor.process_image(roop.globals.replacement_path, roop.globals.output_path, roop.globals.output_path)
+        frame_processor.process_image(roop.globals.replacement_path, input_path, roop.globals.output_path)
         frame_processor.post_process()
+        input_path = roop.globals.output_path
 
     # validate image
 
-    if is_image(roop.globals.input_path):
+    if is_image(roop.globals.output_path):
         update_status('Processing to image succeed!')
     else:
         update_status('Processing to image failed!')
@@ -175,7 +233,53 @@ def process_image() -> None:
     return
 
 
+def process_images() -> None:
+    input_file_paths = get_image_file_paths(roop.globals.input_path)
+
+    if not input_file_paths:
+        update_status('Images not found...')
+        return
+
+    warm_up_thread = start_warm_up(roop.globals.frame_processors)
+
+    if not roop.globals.allow_nsfw:
+        update_status('NSFW check...')
+        if predict_images(input_file_paths):
+            update_status('Processing images halted: NSFW detected!')
+            destroy()
+
+    output_file_paths = get_image_output_file_paths(input_file_paths, roop.globals.output_path)
+
+    for output_directory_path in set(map(os.path.dirname, output_file_paths)):
+        os.makedirs(output_directory_path, exist_ok=True)
+
+    warm_up_thread.join()
+
+    if roop.globals.autotune:
+        update_status('Calibrating execution...')
+        autotune(input_file_paths)
+
+    # all images share one worker pool, models load once per frame processor
+
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        update_status(f'Processing {len(input_file_paths)} images...', frame_processor.NAME)
+        frame_processor.process_images(roop.globals.replacement_path, input_file_paths, output_file_paths)
+        frame_processor.post_process()
+        input_file_paths = output_file_paths
+
+    # validate images
+
+    if all(is_image(output_file_path) for output_file_path in output_file_paths):
+        update_status('Processing to images succeed!')
+    else:
+        update_status('Processing to images failed!')
+
+
 def process_video() -> None:
+    # models load while the nsfw check and extraction run
+
+    warm_up_thread = start_warm_up(roop.globals.frame_processors) if not roop.globals.render_only else None
+
     # not safe for work check
 
     if not roop.globals.allow_nsfw:
@@ -184,19 +288,27 @@ def process_video() -> None:
             update_status('Processing video halted: NSFW detected!')
             destroy()
 
+    fps = get_draft_fps(roop.globals.input_path) if roop.globals.draft else detect_fps(roop.globals.input_path) if roop.globals.keep_fps else 30
+    frame_height = DRAFT_HEIGHT if roop.globals.draft else None
+
     if not roop.globals.reprocess_frames and not roop.globals.render_only:
-        update_status('Creating temporary directory...')
+        # fail before extraction rather than halfway through it
+
+        temp_directory_path = select_temp_directory(roop.globals.input_path, fps, frame_height)
+        if not temp_directory_path:
+            update_status(f'Processing video halted: no temporary directory has room for {estimate_temp_frames_size(roop.globals.input_path, fps, frame_height) / 1024 ** 3:.2f}GB of frames')
+            destroy()
+
+        update_status(f'Creating temporary directory in {temp_directory_path}...')
         create_temp_directory(roop.globals.input_path)
 
         # extract frames
 
-        if roop.globals.keep_fps:
-            fps = detect_fps(roop.globals.input_path)
-            update_status(f'Extracting frames with {fps} FPS...')
-            extract_frames(roop.globals.input_path, fps)
+        if roop.globals.draft:
+            update_status(f'Extracting draft frames at {DRAFT_HEIGHT}p with {fps} FPS...')
         else:
-            update_status('Extracting frames with 30 FPS...')
-            extract_frames(roop.globals.input_path)
+            update_status(f'Extracting frames with {fps} FPS...')
+        extract_frames(roop.globals.input_path, fps, frame_height)
     else:
         update_status('Checking for frames to reprocess and/or render...')
         temp_directory_path = get_temp_directory_path(roop.globals.input_path)
@@ -219,35 +331,105 @@ def process_video() -> None:
 
     update_status(f'render only: {roop.globals.render_only}')
 
+    audio = not roop.globals.skip_audio and has_audio_stream(roop.globals.input_path)
+    video_encoder = None
+
+    # audio is muxed while encoding straight into the output, without audio the temporary file is moved there
+    # progressive formats always encode straight into the output so it is playable while processing
+
+    progressive = roop.globals.output_video_format in ['fmp4', 'hls']
+    video_output_path = roop.globals.output_path if audio or progressive else get_temp_output_file_path(roop.globals.input_path)
+
+    if not roop.globals.skip_video:
+        if roop.globals.skip_audio:
+            update_status('Skipping audio...')
+        elif not audio:
+            update_status('Skipping audio as none was found...')
+        elif roop.globals.keep_fps:
+            update_status('Muxing audio...')
+        else:
+            update_status('Muxing audio might cause issues as fps are not kept...')
+
     if not roop.globals.render_only:
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_video(roop.globals.replacement_path, sorted_frame_file_paths)
-            frame_processor.post_process()
+        frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+
+        if warm_up_thread and warm_up_thread.is_alive():
+            update_status('Waiting for models to warm up...')
+            warm_up_thread.join()
+
+        if roop.globals.autotune:
+            update_status('Calibrating execution...')
+            autotune(sorted_frame_file_paths)
+
+        # detections of earlier runs on the same input are reused, new ones are stored for later runs
+
+        open_face_store(roop.globals.input_path, fps, get_frame_resolution(sorted_frame_file_paths[0]))
+        open_draft_decisions(roop.globals.input_path, fps)
+
+        # the last frame processor feeds the encoder while it is processing
+
+        if not roop.globals.skip_video:
+            update_status(f'Opening encoder with {fps} FPS...')
+            video_encoder = open_video_encoder(roop.globals.input_path, video_output_path, get_frame_resolution(sorted_frame_file_paths[0]), fps, audio)
+
+        try:
+            for frame_processor in frame_processors:
+                if video_encoder and frame_processor == frame_processors[-1]:
+                    set_frame_encoder(lambda temp_frame: write_video_frame(video_encoder, temp_frame))
+                update_status('Progressing...', frame_processor.NAME)
+                frame_processor.process_video(roop.globals.replacement_path, sorted_frame_file_paths)
+                frame_processor.post_process()
+        except BrokenPipeError:
+            # the encoder exited while frames were still processing, the extracted frames are removed like on any halt
+
+            if video_encoder:
+                close_video_encoder(video_encoder, False)
+            update_status('Processing video halted: encoder exited while processing')
+            destroy()
+        except BaseException:
+            if video_encoder:
+                close_video_encoder(video_encoder, False)
+            raise
+        finally:
+            clear_frame_encoder()
+            try:
+                save_face_store()
+            except OSError as exception:
+                update_status(f'Face store not saved: {exception}')
+            close_face_store()
+            save_draft_decisions()
+            close_draft_decisions()
 
     # create video
 
     if not roop.globals.skip_video:
-        if roop.globals.keep_fps:
-            fps = detect_fps(roop.globals.input_path)
-            update_status(f'Creating video with {fps} FPS...')
-            create_video(roop.globals.input_path, fps)
-        else:
-            update_status('Creating video with 30 FPS...')
-            create_video(roop.globals.input_path)
+        video_done = video_encoder is not None and close_video_encoder(video_encoder)
 
-        # handle audio
+        # the last frame processor only writes its frames to disk when they are kept, without them there is nothing to fall back to
 
-        if roop.globals.skip_audio:
-            move_temp_file(roop.globals.input_path, roop.globals.output_path)
-            update_status('Skipping audio...')
+        if not video_done and video_encoder is not None and not roop.globals.keep_frames:
+            update_status('Processing video halted: encoder failed and the processed frames were not kept')
+            destroy()
+
+        if video_done:
+            update_status('Created video while processing...')
         else:
-            if roop.globals.keep_fps:
-                update_status('Restoring audio...')
-            else:
-                update_status('Restoring audio might cause issues as fps are not kept...')
+            update_status(f'Creating video with {fps} FPS...')
+            video_done = create_video(roop.globals.input_path, video_output_path, fps, audio)
+
+        # the fallback without audio re-encodes the same frames, they are current at this point
 
-            restore_audio(roop.globals.input_path, roop.globals.output_path)
+        if not video_done and audio:
+            update_status('Creating video without audio...')
+            audio = False
+            video_done = create_video(roop.globals.input_path, video_output_path if progressive else get_temp_output_file_path(roop.globals.input_path), fps)
+
+        if not video_done:
+            update_status('Processing video halted: could not create video from the frames')
+            destroy()
+
+        if not audio and not progressive:
+            move_temp_file(roop.globals.input_path, roop.globals.output_path)
 
     # clean temp
 
@@ -269,10 +451,22 @@ def start() -> None:
             if not frame_processor.pre_start():
                 return
 
+    if roop.globals.live:
+        start_live()
+        return
+
     if has_image_extension(roop.globals.input_path):
         process_image()
         return
 
+    if is_image_directory(roop.globals.input_path):
+        process_images()
+        return
+
+    if roop.globals.shard_count and roop.globals.headless:
+        start_shard(roop.globals.shard_index)
+        return
+
     process_video()
 
 
@@ -297,12 +491,19 @@ def run() -> None:
     if not pre_check():
         return
 
-    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-        if not frame_processor.pre_check():
+    # frame processors download their models in pre_check, checking them side by side overlaps the downloads
+
+    frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+
+    with ThreadPoolExecutor(max_workers=len(frame_processors)) as executor:
+        if not all(list(executor.map(lambda frame_processor: frame_processor.pre_check(), frame_processors))):
             return
 
     limit_resources()
 
+    if roop.globals.face_analyser_profile == 'minimal':
+        roop.globals.face_analyser_modules = get_face_analyser_modules(roop.globals.frame_processors)
+
     if roop.globals.headless:
         start()
     else:
@@ -1,21 +1,227 @@
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from typing import Any, Dict, List, Optional, Set
+import hashlib
+import json
 import os
+import threading
+import urllib.error
+import urllib.request
 from tqdm import tqdm
-import urllib
+
+from roop.file import lock_file
+
+MANIFEST_FILE = 'manifest.json'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_SHA256S = {
+    'https://huggingface.co/CountFloyd/deepfake/resolve/main/inswapper_128.onnx': 'e4a3f08c753cb72d04e10aa0f7dbe3deebbf39567d4ead6dce08e98aa49e16af',
+    'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth': 'e2cd4703ab14f4d01fd1383a8a8b266f9a5833dacee8e6a79d3bf21a1b6be5ad'
+}
+DOWNLOAD_POSITIONS: Set[int] = set()
+THREAD_LOCK = threading.Lock()
 
 
 def conditional_download(download_directory_path: str, urls: List[str]) -> None:
     if not os.path.exists(download_directory_path):
-        os.makedirs(download_directory_path)
+        os.makedirs(download_directory_path, exist_ok=True)
 
     urls.sort()
 
-    for url in urls:
-        download_file_path = os.path.join(download_directory_path, os.path.basename(url))
+    with ThreadPoolExecutor(max_workers=len(urls) or 1) as executor:
+        futures = [executor.submit(download_file, download_directory_path, url) for url in urls]
+        for future in futures:
+            future.result()
+
+
+def download_file(download_directory_path: str, url: str) -> None:
+    download_file_path = os.path.join(download_directory_path, os.path.basename(url))
+
+    # other workers sharing the directory wait and reuse the finished file
+
+    with lock_file(download_file_path + '.lock'):
+        if is_download_done(download_directory_path, url):
+            return
+
+        position = acquire_download_position()
+
+        try:
+            for _ in range(DOWNLOAD_RETRIES):
+                download_part(url, download_file_path + '.part', position)
+                sha256 = get_sha256(download_file_path + '.part')
+                expected_sha256 = get_expected_sha256(download_directory_path, url)
+
+                if expected_sha256 in [None, sha256]:
+                    os.replace(download_file_path + '.part', download_file_path)
+                    remove_file(download_file_path + '.part.validator')
+                    update_manifest(download_directory_path, download_file_path, sha256)
+                    return
+                os.remove(download_file_path + '.part')
+                remove_file(download_file_path + '.part.validator')
+        finally:
+            release_download_position(position)
+        raise IOError(f'Checksum of {url} does not match the pinned checksum or the manifest')
+
+
+def get_expected_sha256(download_directory_path: str, url: str) -> Optional[str]:
+    # pinned checksums of known models win, other files trust the manifest of their first download
+
+    return DOWNLOAD_SHA256S.get(url) or read_manifest(download_directory_path).get(os.path.basename(url), {}).get('sha256')
+
+
+def acquire_download_position() -> int:
+    # downloads of concurrent calls each get their own progress bar line
+
+    with THREAD_LOCK:
+        position = next(position for position in count() if position not in DOWNLOAD_POSITIONS)
+        DOWNLOAD_POSITIONS.add(position)
+    return position
+
+
+def release_download_position(position: int) -> None:
+    with THREAD_LOCK:
+        DOWNLOAD_POSITIONS.discard(position)
+
+
+def is_download_done(download_directory_path: str, url: str) -> bool:
+    download_file_path = os.path.join(download_directory_path, os.path.basename(url))
+
+    if not os.path.isfile(download_file_path):
+        return False
+
+    manifest_entry = read_manifest(download_directory_path).get(os.path.basename(url))
+    pinned_sha256 = DOWNLOAD_SHA256S.get(url)
+
+    # files from before the manifest are checked against their pinned checksum once
+
+    if manifest_entry is None and pinned_sha256:
+        if get_sha256(download_file_path) != pinned_sha256:
+            os.remove(download_file_path)
+            return False
+        update_manifest(download_directory_path, download_file_path, pinned_sha256)
+        return True
+
+    # other files from before the manifest are trusted when their size matches or the server is unreachable
+
+    if manifest_entry is None:
+        content_length = get_content_length(url)
+        if content_length and content_length != os.path.getsize(download_file_path):
+            os.remove(download_file_path)
+            return False
+        update_manifest(download_directory_path, download_file_path, get_sha256(download_file_path))
+        return True
+
+    file_stat = os.stat(download_file_path)
+
+    if manifest_entry.get('size') == file_stat.st_size and manifest_entry.get('mtime') == file_stat.st_mtime:
+        return True
+
+    if get_expected_sha256(download_directory_path, url) == get_sha256(download_file_path):
+        update_manifest(download_directory_path, download_file_path, get_expected_sha256(download_directory_path, url))
+        return True
+
+    os.remove(download_file_path)
+    return False
+
+
+def download_part(url: str, download_part_path: str, position: int = 0) -> None:
+    initial = os.path.getsize(download_part_path) if os.path.isfile(download_part_path) else 0
+    validator = read_validator(download_part_path + '.validator') if initial else None
+    headers = {}
+
+    # the range is only honoured while the upstream file is unchanged, a changed file is sent whole and replaces the part
+
+    if initial and validator:
+        headers = {'Range': f'bytes={initial}-', 'If-Range': validator}
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as exception:
+        # a complete part has nothing left to send, its checksum decides whether it is kept
+
+        if exception.code == 416:
+            return
+        raise
+
+    with response:
+        # servers without range support send the whole file again
+
+        if response.status != 206:
+            initial = 0
+            write_validator(download_part_path + '.validator', response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        total = initial + int(response.headers.get('Content-Length', 0))
+
+        with open(download_part_path, 'ab' if initial else 'wb') as download_part_file:
+            with tqdm(total=total, initial=initial, desc=os.path.basename(url), position=position, unit='B', unit_scale=True, unit_divisor=1024) as progress:
+                for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    download_part_file.write(chunk)
+                    progress.update(len(chunk))
+
+
+def read_validator(validator_file_path: str) -> Optional[str]:
+    try:
+        with open(validator_file_path) as validator_file:
+            return validator_file.read() or None
+    except OSError:
+        return None
+
+
+def write_validator(validator_file_path: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+    # weak etags are not allowed in if-range, the modification date is used instead
+
+    validator = etag if etag and not etag.startswith('W/') else last_modified
+
+    if validator:
+        with open(validator_file_path, 'w') as validator_file:
+            validator_file.write(validator)
+    else:
+        remove_file(validator_file_path)
+
+
+def remove_file(file_path: str) -> None:
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+
+
+def get_content_length(url: str) -> int:
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=DOWNLOAD_TIMEOUT) as response:
+            return int(response.headers.get('Content-Length', 0))
+    except Exception:
+        return 0
+
+
+def get_sha256(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_manifest(download_directory_path: str) -> Dict[str, Dict[str, Any]]:
+    manifest_file_path = os.path.join(download_directory_path, MANIFEST_FILE)
+
+    try:
+        with open(manifest_file_path) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
 
-        if not os.path.exists(download_file_path):
-            request = urllib.request.urlopen(url)  # type: ignore[attr-defined]
-            total = int(request.headers.get('Content-Length', 0))
+def update_manifest(download_directory_path: str, download_file_path: str, sha256: str) -> None:
+    manifest_file_path = os.path.join(download_directory_path, MANIFEST_FILE)
+    file_stat = os.stat(download_file_path)
 
-            with tqdm(total=total, desc='Downloading', unit='B', unit_scale=True, unit_divisor=1024) as progress:
-                urllib.request.urlretrieve(url, download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size))  # type: ignore[attr-defined]
+    with lock_file(manifest_file_path + '.lock'):
+        manifest = read_manifest(download_directory_path)
+        manifest[os.path.basename(download_file_path)] = {
+            'sha256': sha256,
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime
+        }
+        with open(manifest_file_path + '.part', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        os.replace(manifest_file_path + '.part', manifest_file_path)
@@ -0,0 +1,177 @@
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import threading
+import numpy
+
+import roop.globals
+
+from roop.face_store import get_content_hash
+from roop.file import TEMP_DIRECTORY
+from roop.probe import probe
+from roop.progress import update_status
+from roop.typing import Face, Frame
+
+DRAFT_DECISIONS: Optional[Dict[str, Any]] = None
+DRAFT_HEIGHT = 360
+DRAFT_FPS = 10
+DRAFT_DETECTION_SIZE = 320
+DRAFT_MATCH_IOU = 0.3
+THREAD_LOCK = threading.Lock()
+NAME = 'ROOP.DRAFT'
+
+
+def apply_draft_settings() -> None:
+    # fewer and smaller frames, a smaller detector and the fastest encoder preset
+
+    roop.globals.detection_size = DRAFT_DETECTION_SIZE
+    roop.globals.temp_frame_format = 'jpg'
+
+    if roop.globals.output_path:
+        output_name, output_extension = os.path.splitext(roop.globals.output_path)
+        roop.globals.output_path = output_name + '-draft' + output_extension
+
+
+def get_draft_fps(input_path: str) -> float:
+    return min(DRAFT_FPS, probe(input_path)['fps'] or DRAFT_FPS)
+
+
+def get_draft_decisions_key(input_path: str) -> str:
+    sha256 = hashlib.sha256(get_content_hash(input_path).encode())
+    sha256.update(repr((
+        roop.globals.reference_face_position,
+        roop.globals.reference_frame_number,
+        roop.globals.similar_face_distance
+    )).encode())
+    return sha256.hexdigest()[:16]
+
+
+def get_draft_decisions_path(input_path: str) -> str:
+    # next to the input rather than in the temp root, the full render has to find it after a reboot
+
+    input_name, _ = os.path.splitext(os.path.basename(input_path))
+    return os.path.join(os.path.dirname(input_path), TEMP_DIRECTORY, input_name + '-decisions-' + get_draft_decisions_key(input_path) + '.json')
+
+
+def open_draft_decisions(input_path: str, fps: float) -> None:
+    global DRAFT_DECISIONS
+
+    if roop.globals.many_faces:
+        return
+
+    draft_decisions_path = get_draft_decisions_path(input_path)
+    draft_decisions: Dict[str, Any] = {'fps': fps, 'reference_embedding': None, 'decisions': {}}
+
+    if not roop.globals.draft:
+        try:
+            with open(draft_decisions_path) as draft_decisions_file:
+                draft_decisions = json.load(draft_decisions_file)
+        except (OSError, ValueError):
+            return
+
+    with THREAD_LOCK:
+        DRAFT_DECISIONS = {
+            'path': draft_decisions_path,
+            'fps': fps,
+            'draft_fps': draft_decisions['fps'],
+            'reference_embedding': draft_decisions.get('reference_embedding'),
+            'decisions': {int(frame_number): bbox for frame_number, bbox in draft_decisions['decisions'].items()},
+            'recording': roop.globals.draft
+        }
+
+
+def save_draft_decisions() -> None:
+    with THREAD_LOCK:
+        if not DRAFT_DECISIONS or not DRAFT_DECISIONS['recording']:
+            return
+        draft_decisions = {
+            'fps': DRAFT_DECISIONS['draft_fps'],
+            'reference_embedding': DRAFT_DECISIONS['reference_embedding'],
+            'decisions': {str(frame_number): bbox for frame_number, bbox in sorted(DRAFT_DECISIONS['decisions'].items())}
+        }
+        draft_decisions_path = DRAFT_DECISIONS['path']
+
+    # the draft itself is rendered, an input directory that cannot be written only loses the decisions
+
+    try:
+        os.makedirs(os.path.dirname(draft_decisions_path), exist_ok=True)
+        with open(draft_decisions_path + '.part', 'w') as draft_decisions_file:
+            json.dump(draft_decisions, draft_decisions_file)
+        os.replace(draft_decisions_path + '.part', draft_decisions_path)
+    except OSError as exception:
+        update_status(f'Draft decisions not saved to {draft_decisions_path}: {exception}', NAME)
+
+
+def close_draft_decisions() -> None:
+    global DRAFT_DECISIONS
+
+    with THREAD_LOCK:
+        DRAFT_DECISIONS = None
+
+
+def check_draft_reference(reference_face: Optional[Face]) -> None:
+    global DRAFT_DECISIONS
+
+    if reference_face is None or not hasattr(reference_face, 'normed_embedding'):
+        return
+
+    with THREAD_LOCK:
+        if DRAFT_DECISIONS is None:
+            return
+
+        if DRAFT_DECISIONS['recording']:
+            DRAFT_DECISIONS['reference_embedding'] = reference_face.normed_embedding.tolist()
+            return
+
+        # the reference frame number counts extracted frames, at the draft fps it can point to another moment and face
+
+        reference_embedding = DRAFT_DECISIONS['reference_embedding']
+        if reference_embedding is not None and numpy.sum(numpy.square(reference_face.normed_embedding - numpy.array(reference_embedding, dtype=numpy.float32))) < roop.globals.similar_face_distance:
+            return
+        DRAFT_DECISIONS = None
+
+    update_status('Draft decisions ignored as the draft used another reference face', NAME)
+
+
+def get_relative_bbox(frame: Frame, face: Face) -> List[float]:
+    height, width = frame.shape[:2]
+    return (face.bbox / numpy.array([width, height, width, height], dtype=numpy.float32)).tolist()
+
+
+def get_iou(bbox: List[float], other_bbox: List[float]) -> float:
+    intersection_width = max(min(bbox[2], other_bbox[2]) - max(bbox[0], other_bbox[0]), 0)
+    intersection_height = max(min(bbox[3], other_bbox[3]) - max(bbox[1], other_bbox[1]), 0)
+    intersection = intersection_width * intersection_height
+    union = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) + (other_bbox[2] - other_bbox[0]) * (other_bbox[3] - other_bbox[1]) - intersection
+    return intersection / union if union > 0 else 0
+
+
+def record_draft_decision(frame: Frame, frame_number: Optional[int], face: Optional[Face]) -> None:
+    draft_decisions = DRAFT_DECISIONS
+
+    if draft_decisions is None or not draft_decisions['recording'] or frame_number is None:
+        return
+
+    with THREAD_LOCK:
+        draft_decisions['decisions'][frame_number] = get_relative_bbox(frame, face) if face is not None else None
+
+
+def get_draft_face(frame: Frame, frame_number: Optional[int], many_faces: Optional[List[Face]]) -> Optional[Face]:
+    draft_decisions = DRAFT_DECISIONS
+
+    if draft_decisions is None or draft_decisions['recording'] or frame_number is None or not many_faces:
+        return None
+
+    # the draft frame closest in time decided which face matches, the face overlapping it most takes its place
+
+    draft_frame_number = round(frame_number / draft_decisions['fps'] * draft_decisions['draft_fps'])
+    bbox = draft_decisions['decisions'].get(draft_frame_number)
+
+    # faces the draft missed at its low resolution are matched by embedding again
+
+    if bbox is None:
+        return None
+
+    iou, face = max(((get_iou(bbox, get_relative_bbox(frame, face)), face) for face in many_faces), key=lambda item: item[0])
+    return face if iou >= DRAFT_MATCH_IOU else None
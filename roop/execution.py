@@ -0,0 +1,45 @@
+from typing import Any
+import os
+
+import onnxruntime
+from insightface.model_zoo.model_zoo import ModelRouter
+
+import roop.globals
+
+from roop.file import get_models_directory_path
+
+QUANTIZED_DIRECTORY = 'int8'
+
+
+def get_session_options() -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+
+    # zero leaves the intra op thread count to onnxruntime
+
+    if roop.globals.execution_intra_op_threads:
+        session_options.intra_op_num_threads = roop.globals.execution_intra_op_threads
+    return session_options
+
+
+def get_model(model_file_path: str) -> Any:
+    # insightface.model_zoo.get_model drops the session options, the router hands them to the session
+
+    return ModelRouter(model_file_path).get_model(providers=roop.globals.execution_providers, sess_options=get_session_options())
+
+
+def get_quantized_models_directory_path() -> str:
+    # kept apart from the fp32 models, the analysis app loads every model it finds in its directory
+
+    return os.path.join(get_models_directory_path(), QUANTIZED_DIRECTORY)
+
+
+def get_quantized_model_path(model_file_path: str) -> str:
+    return os.path.join(get_quantized_models_directory_path(), os.path.basename(model_file_path))
+
+
+def get_precision_model_path(model_file_path: str) -> str:
+    # models without an int8 variant keep running in fp32
+
+    if roop.globals.model_precision == 'int8' and os.path.isfile(get_quantized_model_path(model_file_path)):
+        return get_quantized_model_path(model_file_path)
+    return model_file_path
@@ -1,9 +1,13 @@
 import threading
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Tuple
+import cv2
 import insightface
 import numpy
+from insightface.utils import face_align
 
 import roop.globals
+from roop.execution import get_model, get_precision_model_path
+from roop.face_store import get_stored_faces, set_frame_number, store_faces
 from roop.typing import Frame, Face
 
 FACE_ANALYSER = None
@@ -15,8 +19,19 @@ def get_face_analyser() -> Any:
 
     with THREAD_LOCK:
         if FACE_ANALYSER is None:
-            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers)
-            FACE_ANALYSER.prepare(ctx_id=0)
+            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', allowed_modules=roop.globals.face_analyser_modules, providers=roop.globals.execution_providers)
+            # the analysis app cannot pass session options or load other files, rebuild its sessions when they matter
+
+            for task_name, model in FACE_ANALYSER.models.items():
+                model_file_path = get_precision_model_path(model.model_file)
+                if roop.globals.execution_intra_op_threads or model_file_path != model.model_file:
+                    FACE_ANALYSER.models[task_name] = get_model(model_file_path)
+
+                    # the normalization is guessed from the graph, quantized graphs look different
+
+                    FACE_ANALYSER.models[task_name].input_mean = model.input_mean
+                    FACE_ANALYSER.models[task_name].input_std = model.input_std
+            FACE_ANALYSER.prepare(ctx_id=0, det_size=(roop.globals.detection_size, roop.globals.detection_size))
     return FACE_ANALYSER
 
 
@@ -37,15 +52,102 @@ def get_one_face(frame: Frame, position: int = 0) -> Optional[Face]:
 
 
 def get_many_faces(frame: Frame) -> Optional[List[Face]]:
+    many_faces = get_stored_faces(frame)
+
+    if many_faces is not None:
+        return many_faces
+
     try:
-        return get_face_analyser().get(frame)
+        if roop.globals.detection_proxy_size:
+            many_faces = get_many_faces_on_proxy(frame)
+        else:
+            many_faces = get_face_analyser().get(frame)
     except ValueError:
         return None
 
+    store_faces(frame, many_faces)
+    return many_faces
+
+
+def get_many_faces_on_proxy(frame: Frame) -> List[Face]:
+    face_analyser = get_face_analyser()
+    height, width = frame.shape[:2]
+    proxy_scale = roop.globals.detection_proxy_size / max(height, width)
+
+    if proxy_scale >= 1:
+        return face_analyser.get(frame)
+
+    many_faces = detect_faces(frame)
+
+    for face in many_faces:
+        for task_name, model in face_analyser.models.items():
+            if task_name != 'detection':
+                model.get(frame, face)
+    return many_faces
+
+
+def detect_faces(frame: Frame) -> List[Face]:
+    face_analyser = get_face_analyser()
+    height, width = frame.shape[:2]
+    proxy_scale = roop.globals.detection_proxy_size / max(height, width) if roop.globals.detection_proxy_size else 1
+    scale = numpy.ones(2, dtype=numpy.float32)
+
+    # detect on the downscaled frame, analyse on crops of the original frame
+
+    if proxy_scale < 1:
+        proxy_width = max(int(width * proxy_scale), 1)
+        proxy_height = max(int(height * proxy_scale), 1)
+        frame = cv2.resize(frame, (proxy_width, proxy_height), interpolation=cv2.INTER_AREA)
+        scale = numpy.array([width / proxy_width, height / proxy_height], dtype=numpy.float32)
+
+    bboxes, kpss = face_analyser.det_model.detect(frame, max_num=0, metric='default')
+    return [Face(bbox=bbox[0:4] * numpy.tile(scale, 2), kps=kpss[index] * scale if kpss is not None else None, det_score=bbox[4]) for index, bbox in enumerate(bboxes)]
+
+
+def get_many_faces_batch(frames: Frame, frame_numbers: List[int]) -> List[Optional[List[Face]]]:
+    face_analyser = get_face_analyser()
+    batch_faces: List[Optional[List[Face]]] = []
+    detected_faces: List[Tuple[Frame, Face]] = []
+
+    for frame, frame_number in zip(frames, frame_numbers):
+        set_frame_number(frame_number)
+        try:
+            many_faces = get_stored_faces(frame)
+            if many_faces is None:
+                many_faces = detect_faces(frame)
+                detected_faces.extend((frame, face) for face in many_faces)
+        except ValueError:
+            many_faces = None
+        finally:
+            set_frame_number(None)
+        batch_faces.append(many_faces)
+
+    # one recognition run embeds the faces of the whole batch
+
+    for task_name, model in face_analyser.models.items():
+        if task_name == 'recognition' and detected_faces and not model.input_shape[0] == 1:
+            crop_frames = [face_align.norm_crop(frame, landmark=face.kps, image_size=model.input_size[0]) for frame, face in detected_faces]
+            for (_, face), embedding in zip(detected_faces, model.get_feat(crop_frames)):
+                face.embedding = embedding.flatten()
+        elif task_name != 'detection':
+            for frame, face in detected_faces:
+                model.get(frame, face)
+
+    for frame, frame_number, many_faces in zip(frames, frame_numbers, batch_faces):
+        if many_faces is not None:
+            set_frame_number(frame_number)
+            try:
+                store_faces(frame, many_faces)
+            finally:
+                set_frame_number(None)
+    return batch_faces
+
 
 def find_similar_face(frame: Frame, reference_face: Face) -> Optional[Face]:
-    many_faces = get_many_faces(frame)
+    return get_similar_face(get_many_faces(frame), reference_face)
+
 
+def get_similar_face(many_faces: Optional[List[Face]], reference_face: Face) -> Optional[Face]:
     if many_faces:
         for face in many_faces:
             if hasattr(face, 'normed_embedding') and hasattr(reference_face, 'normed_embedding'):
@@ -0,0 +1,169 @@
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import os
+import threading
+import numpy
+from insightface.app.common import Face
+
+import roop.globals
+
+from roop.file import TEMP_DIRECTORY
+from roop.typing import Frame
+
+FACE_STORE: Optional[Dict[str, Any]] = None
+FACE_STORE_SAMPLE_SIZE = 4 * 1024 * 1024
+CONTENT_HASHES: Dict[Tuple[str, int, float], str] = {}
+THREAD_LOCK = threading.Lock()
+FRAME_CONTEXT = threading.local()
+
+
+def get_content_hash(input_path: str) -> str:
+    input_stat = os.stat(input_path)
+    content_key = (os.path.abspath(input_path), input_stat.st_size, input_stat.st_mtime)
+
+    # head, middle and tail of the file identify the content without reading all of it
+
+    if content_key not in CONTENT_HASHES:
+        sha256 = hashlib.sha256(str(input_stat.st_size).encode())
+        with open(input_path, 'rb') as input_file:
+            for offset in sorted({0, max(input_stat.st_size // 2 - FACE_STORE_SAMPLE_SIZE // 2, 0), max(input_stat.st_size - FACE_STORE_SAMPLE_SIZE, 0)}):
+                input_file.seek(offset)
+                sha256.update(input_file.read(FACE_STORE_SAMPLE_SIZE))
+        CONTENT_HASHES[content_key] = sha256.hexdigest()
+    return CONTENT_HASHES[content_key]
+
+
+def get_face_store_key(input_path: str, fps: float) -> str:
+    sha256 = hashlib.sha256(get_content_hash(input_path).encode())
+
+    # the cli passes 30 without keep_fps, the preview the probed 30.0, both name the same frames
+
+    sha256.update(repr((
+        round(float(fps), 3),
+        roop.globals.detection_size,
+        roop.globals.detection_proxy_size,
+        roop.globals.face_analyser_modules,
+        roop.globals.model_precision
+    )).encode())
+    return sha256.hexdigest()[:16]
+
+
+def get_face_store_path(input_path: str, fps: float) -> str:
+    # next to the input rather than in the temp root, memory backed roots are emptied on reboot and the root can change between runs
+
+    input_name, _ = os.path.splitext(os.path.basename(input_path))
+    return os.path.join(os.path.dirname(input_path), TEMP_DIRECTORY, input_name + '-faces-' + get_face_store_key(input_path, fps) + '.npz')
+
+
+def open_face_store(input_path: str, fps: float, resolution: Tuple[int, int]) -> None:
+    global FACE_STORE
+
+    face_store_path = get_face_store_path(input_path, fps)
+
+    with THREAD_LOCK:
+        if FACE_STORE and FACE_STORE['path'] == face_store_path:
+            return
+        FACE_STORE = {
+            'path': face_store_path,
+            'resolution': resolution,
+            'faces': read_face_store(face_store_path),
+            'dirty': False
+        }
+
+
+def close_face_store() -> None:
+    global FACE_STORE
+
+    with THREAD_LOCK:
+        FACE_STORE = None
+
+
+def read_face_store(face_store_path: str) -> Dict[int, List[Face]]:
+    stored_faces: Dict[int, List[Face]] = {}
+
+    try:
+        with numpy.load(face_store_path) as face_store:
+            face_arrays = {name: face_store[name] for name in face_store.files}
+    except (OSError, ValueError):
+        return {}
+
+    face_offsets = face_arrays['face_offsets']
+
+    for index, frame_number in enumerate(face_arrays['frame_numbers']):
+        stored_faces[int(frame_number)] = []
+        for face_index in range(face_offsets[index], face_offsets[index + 1]):
+            face = Face(bbox=face_arrays['bboxes'][face_index], kps=face_arrays['kpss'][face_index], det_score=face_arrays['det_scores'][face_index])
+            if 'embeddings' in face_arrays:
+                face.embedding = face_arrays['embeddings'][face_index]
+            stored_faces[int(frame_number)].append(face)
+    return stored_faces
+
+
+def save_face_store() -> None:
+    with THREAD_LOCK:
+        if not FACE_STORE or not FACE_STORE['dirty']:
+            return
+        stored_faces = dict(FACE_STORE['faces'])
+        frame_numbers = sorted(stored_faces)
+        many_faces = [face for frame_number in frame_numbers for face in stored_faces[frame_number]]
+        face_store_path = FACE_STORE['path']
+        FACE_STORE['dirty'] = False
+
+    # columnar layout, faces of frame i are rows face_offsets[i] to face_offsets[i + 1]
+
+    face_arrays: Dict[str, numpy.ndarray] = {
+        'frame_numbers': numpy.array(frame_numbers, dtype=numpy.int64),
+        'face_offsets': numpy.cumsum([0] + [len(stored_faces[frame_number]) for frame_number in frame_numbers], dtype=numpy.int64),
+        'bboxes': numpy.array([face.bbox for face in many_faces], dtype=numpy.float32).reshape((-1, 4)),
+        'kpss': numpy.array([face.kps for face in many_faces], dtype=numpy.float32).reshape((-1, 5, 2)),
+        'det_scores': numpy.array([face.det_score for face in many_faces], dtype=numpy.float32)
+    }
+    if many_faces and all(face.embedding is not None for face in many_faces):
+        face_arrays['embeddings'] = numpy.array([face.embedding for face in many_faces], dtype=numpy.float32)
+
+    os.makedirs(os.path.dirname(face_store_path), exist_ok=True)
+    with open(face_store_path + '.part', 'wb') as face_store_file:
+        numpy.savez(face_store_file, allow_pickle=False, **face_arrays)
+    os.replace(face_store_path + '.part', face_store_path)
+
+
+def set_frame_number(frame_number: Optional[int]) -> None:
+    FRAME_CONTEXT.frame_number = frame_number
+
+
+def get_frame_number() -> Optional[int]:
+    return getattr(FRAME_CONTEXT, 'frame_number', None)
+
+
+def get_stored_faces(frame: Frame) -> Optional[List[Face]]:
+    face_store = FACE_STORE
+    frame_number = get_frame_number()
+
+    if face_store is None or frame_number is None or frame_number not in face_store['faces']:
+        return None
+
+    stored_faces = face_store['faces'][frame_number]
+    width, height = face_store['resolution']
+
+    if frame.shape[:2] == (height, width):
+        return stored_faces
+
+    # downscaled frames like the preview drafts get the faces in their own coordinates
+
+    scale = numpy.array([frame.shape[1] / width, frame.shape[0] / height], dtype=numpy.float32)
+    return [Face(dict(face), bbox=face.bbox * numpy.tile(scale, 2), kps=face.kps * scale) for face in stored_faces]
+
+
+def store_faces(frame: Frame, many_faces: List[Face]) -> None:
+    face_store = FACE_STORE
+    frame_number = get_frame_number()
+
+    if face_store is None or frame_number is None or any(face.kps is None for face in many_faces):
+        return
+
+    width, height = face_store['resolution']
+
+    if frame.shape[:2] == (height, width):
+        with THREAD_LOCK:
+            face_store['faces'][frame_number] = many_faces
+            face_store['dirty'] = True
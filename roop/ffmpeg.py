@@ -1,5 +1,6 @@
 import glob
-from typing import List
+import numpy
+from typing import List, Optional, Tuple
 import os
 import subprocess
 import time
@@ -7,36 +8,51 @@ import time
 import roop.globals
 
 from roop.progress import update_status
-from roop.file import get_temp_directory_path, get_temp_output_file_path, move_temp_file
+from roop.file import get_temp_directory_path
+from roop.probe import probe
+from roop.typing import Frame
 
+OUTPUT_SEGMENT_DURATION = 2
 
-def detect_fps(input_path: str) -> float:
-    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', input_path]
-    output = subprocess.check_output(command).decode().strip().split('/')
-
-    try:
-        numerator, denominator = map(int, output)
-        return numerator / denominator
-    except Exception:
-        pass
 
-    return 30
+def detect_fps(input_path: str) -> float:
+    return probe(input_path)['fps']
 
 
 # Example extract command line command
 # ffmpeg -hide_banner -hwaccel auto -i ..\?.mp4 -q:v 0 -pix_fmt rgb24 -vf fps=30 %04d.png
+# ffmpeg -hide_banner -hwaccel auto -i ..\?.mp4 -q:v 0 -pix_fmt rgb24 -vf fps=10,scale=-2:'min(ih,360)' %04d.jpg
 
-def extract_frames(input_file_path: str, fps: float = 30) -> bool:
+def extract_frames(input_file_path: str, fps: float = 30, height: Optional[int] = None) -> bool:
     temp_directory_path = get_temp_directory_path(input_file_path)
     temp_frame_quality = roop.globals.temp_frame_quality * 31 // 100
+    video_filter = 'fps=' + str(fps)
+
+    # downscaled frames are never upscaled, the width keeps the aspect ratio and stays even
+
+    if height:
+        video_filter += f",scale=-2:'min(ih,{height})'"
+
+    return run_ffmpeg(['-hwaccel', 'auto', '-i', input_file_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', video_filter, os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+
+
+# Example extract frame range command line command
+# ffmpeg -hide_banner -hwaccel auto -ss 40.0 -i ..\?.mp4 -q:v 0 -pix_fmt rgb24 -vf fps=30 -frames:v 1200 %04d.png
+
+def extract_frame_range(input_file_path: str, output_directory_path: str, start_frame_number: int, frame_total: int, fps: float = 30) -> bool:
+    temp_frame_quality = roop.globals.temp_frame_quality * 31 // 100
+
+    return run_ffmpeg(['-hwaccel', 'auto', '-ss', str(start_frame_number / fps), '-i', input_file_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps), '-frames:v', str(frame_total), os.path.join(output_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+
 
-    return run_ffmpeg(['-hwaccel', 'auto', '-i', input_file_path, '-q:v', str(temp_frame_quality), '-pix_fmt', 'rgb24', '-vf', 'fps=' + str(fps), os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+def has_audio_stream(input_path: str) -> bool:
+    return bool(probe(input_path)['audio_streams'])
 
 
-# Example create video command line command
-# ffmpeg -hide_banner -hwaccel auto -r 30 -start_number 0001 -i .\%04d.png -c:v libx264 -crf 0 -pix_fmt yuv420p -vf colorspace=bt709:iall=bt601-6-625:fast=1 -y x.mp4
+# Example create video command line command, audio is mapped from the original when requested
+# ffmpeg -hide_banner -hwaccel auto -r 30 -start_number 0001 -i .\%04d.png -ss 00:00:00.03 -i .\original.mp4 -map 0:v:0 -map 1:a:0 -shortest -c:v libx264 -crf 0 -pix_fmt yuv420p -vf colorspace=bt709:iall=bt601-6-625:fast=1 -y x.mp4
 
-def create_video(input_file_path: str, fps: float = 30) -> bool:
+def create_video(input_file_path: str, output_file_path: str, fps: float = 30, audio: bool = False) -> bool:
     commands = ['-hwaccel', 'auto', '-r', str(fps)]
 
     temp_directory_path = get_temp_directory_path(input_file_path)
@@ -45,40 +61,210 @@ def create_video(input_file_path: str, fps: float = 30) -> bool:
     if 0 < int(first_frame_number):
         commands.extend(['-start_number', first_frame_number])
 
-    commands.extend(['-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format), '-c:v', roop.globals.output_video_encoder])
+    commands.extend(['-i', os.path.join(temp_directory_path, '%04d.' + roop.globals.temp_frame_format)])
+
+    if audio:
+        commands.extend(get_audio_args(input_file_path, fps))
+
+    commands.extend(get_output_video_args(output_file_path))
+
+    return run_ffmpeg(commands)
+
+
+# Example create segment command line command
+# ffmpeg -hide_banner -hwaccel auto -r 30 -i .\%04d.png -c:v libx264 -crf 0 -pix_fmt yuv420p -vf colorspace=bt709:iall=bt601-6-625:fast=1 -y segment.mp4
+
+def create_segment(frame_directory_path: str, output_file_path: str, fps: float = 30) -> bool:
+    commands = ['-hwaccel', 'auto', '-r', str(fps), '-i', os.path.join(frame_directory_path, '%04d.' + roop.globals.temp_frame_format)]
+
+    # segments stay plain mp4 for the concat demuxer, only the concatenated output gets the output format
+
+    commands.extend(get_output_codec_args())
+    commands.extend(['-y', output_file_path])
+
+    return run_ffmpeg(commands)
+
+
+# Example concat segments command line command
+# ffmpeg -hide_banner -f concat -safe 0 -i segments.txt -i ..\?.mp4 -map 0:v:0 -map 1:a:0 -shortest -c copy -y x.mp4
+
+def concat_segments(segment_list_file_path: str, input_file_path: str, output_file_path: str, audio: bool = False) -> bool:
+    commands = ['-f', 'concat', '-safe', '0', '-i', segment_list_file_path]
+
+    if audio:
+        commands.extend(['-i', input_file_path, '-map', '0:v:0', '-map', '1:a:0', '-shortest', '-c:v', 'copy'])
+    else:
+        commands.extend(['-c', 'copy'])
+
+    commands.extend(get_output_format_args(output_file_path))
+
+    return run_ffmpeg(commands)
+
+
+# Example incremental create video command line command, frames are written to stdin in order
+# ffmpeg -hide_banner -f rawvideo -pix_fmt bgr24 -s 1920x1080 -r 30 -i - -ss 00:00:00.03 -i .\original.mp4 -map 0:v:0 -map 1:a:0 -shortest -c:v libx264 -crf 0 -pix_fmt yuv420p -vf colorspace=bt709:iall=bt601-6-625:fast=1 -y x.mp4
+
+def open_video_encoder(input_file_path: str, output_file_path: str, resolution: Tuple[int, int], fps: float = 30, audio: bool = False) -> Optional[subprocess.Popen[bytes]]:
+    width, height = resolution
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+
+    if audio:
+        commands.extend(get_audio_args(input_file_path, fps))
+
+    commands.extend(get_output_video_args(output_file_path))
+
+    try:
+        print()
+        update_status('Opening encoder', 'ROOP.FFMPEG')
+
+        print()
+        print(" ".join(map(str, commands)))
+        print()
+
+        return subprocess.Popen(commands, stdin=subprocess.PIPE)
+    except Exception as exception:
+        print("Error: ffmpeg encoder failed to start")
+        print(exception)
+        print()
+        return None
+
+
+def write_video_frame(video_encoder: subprocess.Popen[bytes], frame: Frame) -> None:
+    # the pipe reads the frame memory directly, tobytes would copy every frame
+
+    video_encoder.stdin.write(numpy.ascontiguousarray(frame).data)
+
+
+def close_video_encoder(video_encoder: subprocess.Popen[bytes], done: bool = True) -> bool:
+    try:
+        video_encoder.stdin.close()
+    except BrokenPipeError:
+        done = False
+
+    if not done:
+        video_encoder.kill()
+
+    return video_encoder.wait() == 0 and done
+
+
+# Example stream decoder command line command
+# ffmpeg -hide_banner -re -i ..\?.mp4 -f rawvideo -pix_fmt bgr24 -
+
+def open_stream_decoder(input_url: str, resolution: Tuple[int, int], fps: float, raw: bool = False) -> subprocess.Popen[bytes]:
+    width, height = resolution
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level]
+
+    # local files are replayed at their native rate, live inputs arrive at it anyway
+
+    if os.path.isfile(input_url):
+        commands.append('-re')
+
+    if raw:
+        commands.extend(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps)])
+
+    commands.extend(['-i', input_url, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-'])
+
+    return subprocess.Popen(commands, stdin=subprocess.DEVNULL if input_url != '-' else None, stdout=subprocess.PIPE)
+
+
+def read_stream_frame(stream_decoder: subprocess.Popen[bytes], resolution: Tuple[int, int]) -> Optional[Frame]:
+    width, height = resolution
+    frame_buffer = stream_decoder.stdout.read(width * height * 3)
+
+    if len(frame_buffer) < width * height * 3:
+        return None
+
+    return numpy.frombuffer(frame_buffer, dtype=numpy.uint8).reshape((height, width, 3)).copy()
+
+
+# Example stream encoder command line command
+# ffmpeg -hide_banner -f rawvideo -pix_fmt bgr24 -s 1280x720 -r 30 -i - -c:v libx264 -preset ultrafast -tune zerolatency -pix_fmt yuv420p -f mpegts udp://127.0.0.1:1234
+
+def open_stream_encoder(output_url: str, resolution: Tuple[int, int], fps: float) -> subprocess.Popen[bytes]:
+    width, height = resolution
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-c:v', roop.globals.output_video_encoder]
+
+    if roop.globals.output_video_encoder in ['libx264', 'libx265']:
+        commands.extend(['-preset', 'ultrafast', '-tune', 'zerolatency'])
+
+    commands.extend(['-pix_fmt', 'yuv420p', '-f', get_stream_format(output_url), '-y', output_url])
+
+    return subprocess.Popen(commands, stdin=subprocess.PIPE)
+
+
+def get_stream_format(output_url: str) -> str:
+    if output_url.startswith(('rtmp://', 'rtmps://')):
+        return 'flv'
+
+    if output_url.startswith('rtsp://'):
+        return 'rtsp'
+
+    if output_url.endswith('.mp4'):
+        return 'mp4'
+
+    if output_url.endswith('.mkv'):
+        return 'matroska'
+
+    return 'mpegts'
+
+
+def get_output_video_args(output_file_path: str) -> List[str]:
+    commands = get_output_codec_args()
+    commands.extend(get_output_format_args(output_file_path))
+
+    return commands
+
+
+def get_output_codec_args() -> List[str]:
+    commands = ['-c:v', roop.globals.output_video_encoder]
 
     output_video_lossiness = (roop.globals.output_video_lossiness + 1) * 51 // 100
 
     if roop.globals.output_video_encoder in ['libx264', 'libx265', 'libvpx']:
         commands.extend(['-crf', str(output_video_lossiness)])
 
+    if roop.globals.draft and roop.globals.output_video_encoder in ['libx264', 'libx265']:
+        commands.extend(['-preset', 'ultrafast'])
+
     if roop.globals.output_video_encoder in ['h264_nvenc', 'hevc_nvenc']:
         commands.extend(['-cq', str(output_video_lossiness)])
 
-    temp_output_file_path = get_temp_output_file_path(input_file_path)
-    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_file_path])
+    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1'])
 
-    return run_ffmpeg(commands)
+    # progressive formats cut a fragment or segment at every forced keyframe
 
+    if roop.globals.output_video_format in ['fmp4', 'hls']:
+        commands.extend(['-force_key_frames', f'expr:gte(t,n_forced*{OUTPUT_SEGMENT_DURATION})'])
 
-# Example restore command line command
-# ffmpeg -hide_banner -hwaccel auto -i /content/drive/MyDrive/Colab/input/temp/video.mp4 -ss 00:00:50:00 -i /content/drive/MyDrive/Colab/input/original.mp4 -shortest -c:v copy -map 0:v:0 -map 1:a:0 -y /content/drive/MyDrive/Colab/input/temp/merged.mp4
+    return commands
 
-def restore_audio(input_file_path: str, output_file_path: str, fps: float = 30) -> None:
-    temp_output_file_path = get_temp_output_file_path(input_file_path)
-    temp_directory_path = get_temp_directory_path(input_file_path)
 
-    commands = ['-i', temp_output_file_path]
+def get_output_format_args(output_file_path: str) -> List[str]:
+    commands = []
+
+    if roop.globals.output_video_format == 'fmp4':
+        commands.extend(['-movflags', '+frag_keyframe+empty_moov+default_base_moof', '-flush_packets', '1'])
+
+    if roop.globals.output_video_format == 'hls':
+        output_name, _ = os.path.splitext(os.path.basename(output_file_path))
+        output_directory_path = os.path.dirname(output_file_path)
+        commands.extend(['-f', 'hls', '-hls_time', str(OUTPUT_SEGMENT_DURATION), '-hls_playlist_type', 'event', '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', output_name + '-init.mp4', '-hls_segment_filename', os.path.join(output_directory_path, output_name + '-%05d.m4s')])
+
+    commands.extend(['-y', output_file_path])
+
+    return commands
+
+
+def get_audio_args(input_file_path: str, fps: float = 30) -> List[str]:
+    temp_directory_path = get_temp_directory_path(input_file_path)
+    commands = []
 
     if 0 < int(get_first_frame_number(temp_directory_path)):
         commands.extend(['-ss', get_first_frame_time_index(temp_directory_path, fps)])
 
-    commands.extend(['-i', input_file_path, '-shortest', '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_file_path])
-
-    done = run_ffmpeg(commands)
+    commands.extend(['-i', input_file_path, '-map', '0:v:0', '-map', '1:a:0', '-shortest'])
 
-    if not done:
-        move_temp_file(input_file_path, output_file_path)
+    return commands
 
 
 def run_ffmpeg(args: List[str]) -> bool:
@@ -1,30 +1,134 @@
 import glob
+import hashlib
+import math
 import mimetypes
 import os
+import platform
 import shutil
+import tempfile
+import psutil
 
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional
 
 import roop.globals
 
+from roop.probe import probe
+
 TEMP_DIRECTORY = 'temp'
+TEMP_ROOT_DIRECTORY = 'roop-temp'
 TEMP_VIDEO_FILE = 'temp.mp4'
+# only linux mounts a tmpfs at /dev/shm for every user
+
+TEMP_DIRECTORY_CANDIDATES = ['/dev/shm', tempfile.gettempdir()] if platform.system().lower() == 'linux' else [tempfile.gettempdir()]
+TEMP_FRAME_BYTES_PER_PIXEL = {'jpg': 1.0, 'png': 2.0}
+TEMP_SPACE_MARGIN = 1.1
+TEMP_MEMORY_RESERVE = 2 * 1024 ** 3
+TEMP_ROOTS: Dict[str, Optional[str]] = {}
 
 
 def get_absolute_path(path: str) -> str:
     return os.path.abspath(os.path.join(os.path.dirname(__file__), path))
 
 
+def get_models_directory_path() -> str:
+    return roop.globals.models_directory or get_absolute_path('../models')
+
+
 def get_sorted_frame_file_paths(input_file_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(input_file_path)
     return sorted(glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format))))
 
 
 def get_temp_directory_path(input_file_path: str) -> str:
+    input_key = os.path.abspath(input_file_path)
+
+    if input_key in TEMP_ROOTS:
+        return get_temp_directory_path_in(input_file_path, TEMP_ROOTS[input_key])
+
+    # frames of an earlier run are found in whichever root they were extracted to
+
+    for temp_root in get_temp_roots():
+        temp_directory_path = get_temp_directory_path_in(input_file_path, temp_root)
+        if os.path.isdir(temp_directory_path):
+            TEMP_ROOTS[input_key] = temp_root
+            return temp_directory_path
+
+    return get_temp_directory_path_in(input_file_path, None)
+
+
+def get_temp_directory_path_in(input_file_path: str, temp_root: Optional[str]) -> str:
     input_file_name, _ = os.path.splitext(os.path.basename(input_file_path))
-    input_directory_path = os.path.dirname(input_file_path)
-    return os.path.join(input_directory_path, TEMP_DIRECTORY, input_file_name)
+
+    # draft frames never pass for frames of the full render
+
+    if roop.globals.draft:
+        input_file_name += '-draft'
+
+    # no root keeps the frames next to the input, shared roots need the path in the name to tell inputs apart
+
+    if temp_root is None:
+        return os.path.join(os.path.dirname(input_file_path), TEMP_DIRECTORY, input_file_name)
+
+    input_hash = hashlib.sha1(os.path.abspath(input_file_path).encode()).hexdigest()[:8]
+    return os.path.join(temp_root, TEMP_ROOT_DIRECTORY, input_file_name + '-' + input_hash)
+
+
+def get_temp_roots() -> List[Optional[str]]:
+    temp_roots: List[Optional[str]] = list(roop.globals.temp_directories or TEMP_DIRECTORY_CANDIDATES)
+    return temp_roots + [None]
+
+
+def estimate_temp_frames_size(input_file_path: str, fps: float, height: Optional[int] = None) -> int:
+    media_probe = probe(input_file_path)
+    frame_total = math.ceil(media_probe['duration'] * fps) or media_probe['frame_total']
+    frame_height = media_probe['width'] if abs(media_probe['rotation']) in [90, 270] else media_probe['height']
+    scale = min(height / max(frame_height, 1), 1) if height else 1
+
+    return int(media_probe['width'] * media_probe['height'] * scale ** 2 * frame_total * TEMP_FRAME_BYTES_PER_PIXEL[roop.globals.temp_frame_format] * TEMP_SPACE_MARGIN)
+
+
+def is_memory_backed(path: str) -> bool:
+    mount_point = ''
+    file_system_type = ''
+
+    # commonpath refuses paths on different windows drives, those mounts cannot hold the path anyway
+
+    for partition in psutil.disk_partitions(all=True):
+        if os.path.normcase(os.path.splitdrive(path)[0]) != os.path.normcase(os.path.splitdrive(partition.mountpoint)[0]):
+            continue
+        if os.path.commonpath([path, partition.mountpoint]) == partition.mountpoint and len(partition.mountpoint) > len(mount_point):
+            mount_point, file_system_type = partition.mountpoint, partition.fstype
+    return file_system_type in ['tmpfs', 'ramfs']
+
+
+def get_temp_root_capacity(input_file_path: str, temp_root: Optional[str]) -> int:
+    path = os.path.abspath(temp_root or os.path.dirname(input_file_path) or '.')
+
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    capacity = shutil.disk_usage(path).free
+
+    # frames in memory compete with the frames in flight, some memory is kept for processing
+
+    if is_memory_backed(path):
+        capacity = min(capacity, psutil.virtual_memory().available - TEMP_MEMORY_RESERVE)
+    return capacity
+
+
+def select_temp_directory(input_file_path: str, fps: float, height: Optional[int] = None) -> Optional[str]:
+    temp_frames_size = estimate_temp_frames_size(input_file_path, fps, height)
+
+    for temp_root in get_temp_roots():
+        try:
+            capacity = get_temp_root_capacity(input_file_path, temp_root)
+        except (OSError, ValueError):
+            continue
+        if capacity >= temp_frames_size:
+            TEMP_ROOTS[os.path.abspath(input_file_path)] = temp_root
+            return get_temp_directory_path_in(input_file_path, temp_root)
+    return None
 
 
 def get_temp_output_file_path(input_file_path: str) -> str:
@@ -33,7 +137,7 @@ def get_temp_output_file_path(input_file_path: str) -> str:
 
 
 def normalize_output_file_path(replacement_file_path: str, input_file_path: str, output_file_path: str) -> Optional[str]:
-    if replacement_file_path and input_file_path and output_file_path:
+    if replacement_file_path and input_file_path and output_file_path and not is_image_directory(input_file_path):
         replacement_name, _ = os.path.splitext(os.path.basename(replacement_file_path))
         input_name, input_extension = os.path.splitext(os.path.basename(input_file_path))
 
@@ -77,6 +181,42 @@ def has_image_extension(image_file_path: str) -> bool:
     return image_file_path.lower().endswith(('png', 'jpg', 'jpeg', 'webp'))
 
 
+def is_image_directory(input_path: str) -> bool:
+    if not input_path:
+        return False
+
+    if os.path.isdir(input_path):
+        return True
+
+    # existing files are taken literally, their names may contain glob characters
+
+    return not os.path.isfile(input_path) and any(character in input_path for character in '*?[')
+
+
+def get_image_file_paths(input_path: str) -> List[str]:
+    if not is_image_directory(input_path):
+        return []
+
+    if os.path.isdir(input_path):
+        input_path = os.path.join(glob.escape(input_path), '*')
+
+    return sorted(image_file_path for image_file_path in glob.glob(input_path) if os.path.isfile(image_file_path) and has_image_extension(image_file_path))
+
+
+def get_image_output_file_paths(input_file_paths: List[str], output_directory_path: str) -> List[str]:
+    input_file_paths = [os.path.abspath(input_file_path) for input_file_path in input_file_paths]
+
+    # globs match the same names in several directories, outputs keep their path below the common directory
+
+    try:
+        common_directory_path = os.path.commonpath([os.path.dirname(input_file_path) for input_file_path in input_file_paths])
+        return [os.path.join(output_directory_path, os.path.relpath(input_file_path, common_directory_path)) for input_file_path in input_file_paths]
+    except ValueError:
+        # inputs on several windows drives have no common directory, the drive becomes the top directory
+
+        return [os.path.join(output_directory_path, drive.rstrip(':'), path.lstrip('\\/')) for drive, path in map(os.path.splitdrive, input_file_paths)]
+
+
 def is_image(image_file_path: str) -> bool:
     if image_file_path and os.path.isfile(image_file_path):
         mimetype, _ = mimetypes.guess_type(image_file_path)
@@ -91,3 +231,24 @@ def is_video(video_file_path: str) -> bool:
         return bool(mimetype and mimetype.startswith('video/'))
 
     return False
+
+
+@contextmanager
+def lock_file(lock_file_path: str) -> Iterator[None]:
+    with open(lock_file_path, 'a+') as file:
+        if platform.system().lower() == 'windows':
+            import msvcrt
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)  # type: ignore[attr-defined]
+            try:
+                yield
+            finally:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)  # type: ignore[attr-defined]
+        else:
+            import fcntl
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
@@ -10,18 +10,40 @@ keep_fps: Optional[bool] = None
 keep_frames: Optional[bool] = None
 reprocess_frames: Optional[bool] = None
 render_only: Optional[bool] = None
+draft: Optional[bool] = None
 skip_video: Optional[bool] = None
 skip_audio: Optional[bool] = None
 many_faces: Optional[bool] = None
 reference_face_position: Optional[int] = None
 reference_frame_number: Optional[int] = None
 similar_face_distance: Optional[float] = None
+face_analyser_profile: Optional[str] = None
+face_analyser_modules: Optional[List[str]] = None
+detection_size: Optional[int] = None
+detection_proxy_size: Optional[int] = None
+temp_directories: Optional[List[str]] = None
 temp_frame_format: Optional[str] = None
 temp_frame_quality: Optional[int] = None
 output_video_encoder: Optional[str] = None
 output_video_lossiness: Optional[int] = None
+output_video_format: Optional[str] = None
 max_memory: Optional[int] = None
+models_directory: Optional[str] = None
 execution_providers: List[str] = []
 execution_threads: Optional[int] = None
+execution_intra_op_threads: Optional[int] = None
+execution_batch_size: Optional[int] = None
+autotune: Optional[bool] = None
+model_precision: Optional[str] = None
+io_threads: Optional[int] = None
+live: Optional[bool] = None
+live_latency: Optional[int] = None
+live_resolution: Optional[str] = None
+live_fps: Optional[float] = None
+shard_count: Optional[int] = None
+shard_index: Optional[int] = None
+shard_directory: Optional[str] = None
+shard_workers: Optional[int] = None
+shard_retries: Optional[int] = None
 
 log_level: str = 'error'
@@ -0,0 +1,251 @@
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import os
+import threading
+import time
+import cv2
+import numpy
+
+import roop.globals
+
+from roop.face_analyser import get_one_face
+from roop.ffmpeg import open_stream_decoder, read_stream_frame, open_stream_encoder, write_video_frame, close_video_encoder
+from roop.predictor import predict_frame
+from roop.probe import get_media_probe, probe, run_ffprobe
+from roop.processors.frame.core import get_frame_processors_modules
+from roop.progress import update_status
+from roop.typing import Face, Frame
+
+LIVE_REPORT_INTERVAL = 5.0
+LIVE_LATENCY_WINDOW = 1000
+LIVE_POLL_INTERVAL = 0.1
+NAME = 'ROOP.LIVE'
+LiveFrame = Tuple[int, float, Frame]
+
+
+def create_live_stats() -> Dict[str, Any]:
+    return {
+        'lock': threading.Lock(),
+        'start_time': time.perf_counter(),
+        'captured_total': 0,
+        'processed_total': 0,
+        'written_total': 0,
+        'dropped_total': 0,
+        'late_total': 0,
+        'reused_total': 0,
+        'latencies': deque(maxlen=LIVE_LATENCY_WINDOW)
+    }
+
+
+def update_live_stats(stats: Dict[str, Any], name: str, latency: Optional[float] = None) -> None:
+    with stats['lock']:
+        stats[name] += 1
+        if latency is not None:
+            stats['latencies'].append(latency)
+
+
+def format_live_stats(stats: Dict[str, Any]) -> str:
+    with stats['lock']:
+        elapsed = max(time.perf_counter() - stats['start_time'], 1e-6)
+        latencies = numpy.array(stats['latencies']) * 1000 if stats['latencies'] else numpy.zeros(1)
+        return f'{stats["written_total"] / elapsed:.2f} fps written of {stats["captured_total"] / elapsed:.2f} fps captured, ' \
+               f'latency p50 {numpy.percentile(latencies, 50):.0f}ms p95 {numpy.percentile(latencies, 95):.0f}ms p99 {numpy.percentile(latencies, 99):.0f}ms, ' \
+               f'{stats["dropped_total"]} dropped, {stats["late_total"]} late, {stats["reused_total"]} reused'
+
+
+def get_live_format(input_url: str) -> Tuple[Tuple[int, int], float, bool]:
+    # raw pipes carry no header, their format has to be given
+
+    if roop.globals.live_resolution and roop.globals.live_fps:
+        width, height = map(int, roop.globals.live_resolution.split('x'))
+        return (width, height), roop.globals.live_fps, True
+
+    media_probe = probe(input_url) if os.path.isfile(input_url) else get_media_probe(run_ffprobe(input_url) or {})
+    resolution = (media_probe['width'], media_probe['height'])
+
+    if abs(media_probe['rotation']) in [90, 270]:
+        resolution = resolution[::-1]
+    return resolution, roop.globals.live_fps or media_probe['fps'], False
+
+
+def read_live_frames(stream_decoder: Any, resolution: Tuple[int, int], capture_queue: Deque[LiveFrame], capture_condition: threading.Condition, stats: Dict[str, Any], stop_event: threading.Event) -> None:
+    frame_index = 0
+
+    while not stop_event.is_set():
+        temp_frame = read_stream_frame(stream_decoder, resolution)
+        if temp_frame is None:
+            break
+        update_live_stats(stats, 'captured_total')
+
+        # the oldest waiting frame makes room, workers always get the freshest frames
+
+        with capture_condition:
+            if len(capture_queue) == capture_queue.maxlen:
+                update_live_stats(stats, 'dropped_total')
+            capture_queue.append((frame_index, time.perf_counter(), temp_frame))
+            capture_condition.notify()
+        frame_index += 1
+
+    stop_event.set()
+    with capture_condition:
+        capture_condition.notify_all()
+
+
+def process_live_frames(live_faces: Dict[str, Any], capture_queue: Deque[LiveFrame], capture_condition: threading.Condition, result_frames: Dict[int, LiveFrame], result_lock: threading.Lock, stats: Dict[str, Any], stop_event: threading.Event) -> None:
+    latency_budget = roop.globals.live_latency / 1000
+
+    while True:
+        with capture_condition:
+            # a failed worker sets the stop without notifying, waits time out to see it
+
+            while not capture_queue and not stop_event.is_set():
+                capture_condition.wait(LIVE_POLL_INTERVAL)
+            if not capture_queue:
+                return
+            frame_index, captured_at, temp_frame = capture_queue.popleft()
+
+        # frames that waited past the budget are skipped rather than shown late
+
+        if time.perf_counter() - captured_at > latency_budget:
+            update_live_stats(stats, 'late_total')
+            continue
+
+        # frames pass unprocessed until a reference face shows up
+
+        reference_face = find_live_reference_face(live_faces, temp_frame)
+
+        if reference_face is not None or roop.globals.many_faces:
+            for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+                temp_frame = frame_processor.process_frame(live_faces['source_face'], reference_face, temp_frame)
+        update_live_stats(stats, 'processed_total')
+
+        with result_lock:
+            result_frames[frame_index] = (frame_index, captured_at, temp_frame)
+
+
+def run_live_thread(target: Callable[..., None], args: Tuple[Any, ...], stop_event: threading.Event, live_exceptions: List[Exception]) -> None:
+    try:
+        target(*args)
+    except Exception as exception:
+        live_exceptions.append(exception)
+        stop_event.set()
+
+
+def write_live_frames(stream_encoder: Any, fps: float, result_frames: Dict[int, LiveFrame], result_lock: threading.Lock, stats: Dict[str, Any], stop_event: threading.Event, workers: List[threading.Thread]) -> None:
+    frame_interval = 1 / fps
+    next_write_time = time.perf_counter()
+    last_frame: Optional[Frame] = None
+    last_frame_index = -1
+    next_report_time = time.perf_counter() + LIVE_REPORT_INTERVAL
+
+    # the output keeps the native rate, a tick without a new frame repeats the last one
+
+    while not (stop_event.is_set() and not any(worker.is_alive() for worker in workers) and not result_frames):
+        time.sleep(max(next_write_time - time.perf_counter(), 0))
+        next_write_time += frame_interval
+
+        with result_lock:
+            frame_indexes = [frame_index for frame_index in result_frames if frame_index > last_frame_index]
+            live_frame = result_frames[max(frame_indexes)] if frame_indexes else None
+            for frame_index in frame_indexes:
+                del result_frames[frame_index]
+
+        # processed frames overtaken by a newer one before their tick count as dropped
+
+        for _ in frame_indexes[1:]:
+            update_live_stats(stats, 'dropped_total')
+
+        if live_frame:
+            last_frame_index, captured_at, last_frame = live_frame
+            update_live_stats(stats, 'written_total', time.perf_counter() - captured_at)
+        elif last_frame is not None:
+            update_live_stats(stats, 'reused_total')
+
+        if last_frame is not None:
+            write_video_frame(stream_encoder, last_frame)
+
+        if time.perf_counter() > next_report_time:
+            update_status(format_live_stats(stats), NAME)
+            next_report_time += LIVE_REPORT_INTERVAL
+
+
+def get_live_faces(first_frame: Frame) -> Dict[str, Any]:
+    source_face = get_one_face(cv2.imread(roop.globals.replacement_path)) if roop.globals.replacement_path else None
+    reference_face = None if roop.globals.many_faces else get_one_face(first_frame, roop.globals.reference_face_position)
+
+    if reference_face is None and not roop.globals.many_faces:
+        update_status('No reference face in the first frame, looking for it in the following frames...', NAME)
+    return {
+        'source_face': source_face,
+        'reference_face': reference_face
+    }
+
+
+def find_live_reference_face(live_faces: Dict[str, Any], temp_frame: Frame) -> Optional[Face]:
+    if live_faces['reference_face'] is None and not roop.globals.many_faces:
+        reference_face = get_one_face(temp_frame, roop.globals.reference_face_position)
+
+        # the first worker to find a face sets the reference, the others keep it
+
+        if reference_face is not None and live_faces.setdefault('found_reference_face', reference_face) is reference_face:
+            live_faces['reference_face'] = reference_face
+            update_status('Reference face found', NAME)
+        return live_faces.get('found_reference_face')
+
+    return live_faces['reference_face']
+
+
+def start_live() -> bool:
+    input_url = roop.globals.input_path
+    resolution, fps, raw = get_live_format(input_url)
+
+    if not resolution[0] or not resolution[1]:
+        update_status(f'Live input {input_url} cannot be probed, set --live-resolution and --live-fps', NAME)
+        return False
+
+    update_status(f'Streaming {input_url} at {resolution[0]}x{resolution[1]} and {fps} FPS with a {roop.globals.live_latency}ms latency budget...', NAME)
+    stream_decoder = open_stream_decoder(input_url, resolution, fps, raw)
+    first_frame = read_stream_frame(stream_decoder, resolution)
+
+    if first_frame is None:
+        update_status(f'Live input {input_url} sent no frames', NAME)
+        return False
+
+    if not roop.globals.allow_nsfw and predict_frame(first_frame):
+        update_status('Streaming halted: NSFW detected!', NAME)
+        stream_decoder.kill()
+        return False
+
+    live_faces = get_live_faces(first_frame)
+    stream_encoder = open_stream_encoder(roop.globals.output_path, resolution, fps)
+    stats = create_live_stats()
+    stop_event = threading.Event()
+    capture_queue: Deque[LiveFrame] = deque(maxlen=roop.globals.execution_threads)
+    capture_condition = threading.Condition()
+    result_frames: Dict[int, LiveFrame] = {}
+    result_lock = threading.Lock()
+    live_exceptions: List[Exception] = []
+    reader = threading.Thread(target=run_live_thread, args=(read_live_frames, (stream_decoder, resolution, capture_queue, capture_condition, stats, stop_event), stop_event, live_exceptions), daemon=True)
+    workers = [threading.Thread(target=run_live_thread, args=(process_live_frames, (live_faces, capture_queue, capture_condition, result_frames, result_lock, stats, stop_event), stop_event, live_exceptions), daemon=True) for _ in range(roop.globals.execution_threads)]
+    reader.start()
+    for worker in workers:
+        worker.start()
+
+    try:
+        write_live_frames(stream_encoder, fps, result_frames, result_lock, stats, stop_event, workers)
+    except (BrokenPipeError, KeyboardInterrupt):
+        stop_event.set()
+    finally:
+        stop_event.set()
+        with capture_condition:
+            capture_condition.notify_all()
+        stream_decoder.kill()
+        close_video_encoder(stream_encoder)
+
+    update_status(format_live_stats(stats), NAME)
+
+    # a failed worker stopped the stream, its error is the outcome
+
+    if live_exceptions:
+        raise live_exceptions[0]
+    return True
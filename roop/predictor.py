@@ -2,6 +2,7 @@ import threading
 import numpy
 import opennsfw2
 from PIL import Image
+from typing import List
 from keras import Model
 
 from roop.typing import Frame
@@ -9,6 +10,7 @@ from roop.typing import Frame
 PREDICTOR = None
 THREAD_LOCK = threading.Lock()
 MAX_PROBABILITY = 0.85
+PREDICT_IMAGES_CHUNK_SIZE = 32
 
 
 def get_predictor() -> Model:
@@ -39,6 +41,17 @@ def predict_image(input_path: str) -> bool:
     return opennsfw2.predict_image(input_path) > MAX_PROBABILITY
 
 
+def predict_images(input_paths: List[str]) -> bool:
+    # opennsfw2 decodes every image of a call into one batch, large directories are checked in chunks
+
+    for start in range(0, len(input_paths), PREDICT_IMAGES_CHUNK_SIZE):
+        probabilities = opennsfw2.predict_images(input_paths[start:start + PREDICT_IMAGES_CHUNK_SIZE])
+        if any(probability > MAX_PROBABILITY for probability in probabilities):
+            return True
+
+    return False
+
+
 def predict_video(input_path: str) -> bool:
     _, probabilities = opennsfw2.predict_video_frames(video_path=input_path, frame_interval=100)
 
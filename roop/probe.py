@@ -0,0 +1,147 @@
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import os
+import subprocess
+import threading
+
+from roop.typing import MediaProbe
+
+ProbeKey = Tuple[str, int, float]
+Packet = Tuple[float, bool]
+PROBES: Dict[ProbeKey, MediaProbe] = {}
+PACKET_PROBES: Dict[ProbeKey, List[Packet]] = {}
+THREAD_LOCK = threading.Lock()
+
+
+def get_probe_key(input_path: str) -> ProbeKey:
+    input_stat = os.stat(input_path)
+    return os.path.abspath(input_path), input_stat.st_size, input_stat.st_mtime
+
+
+def probe(input_path: str) -> MediaProbe:
+    probe_key = get_probe_key(input_path)
+
+    with THREAD_LOCK:
+        if probe_key in PROBES:
+            return PROBES[probe_key]
+
+        output = run_ffprobe(input_path)
+        media_probe = get_media_probe(output or {})
+
+        # failed probes are not memoized, the defaults would stick until the file changes
+
+        if output is not None:
+            PROBES[probe_key] = media_probe
+
+    return media_probe
+
+
+def probe_packets(input_path: str) -> List[Packet]:
+    probe_key = get_probe_key(input_path)
+
+    with THREAD_LOCK:
+        if probe_key in PACKET_PROBES:
+            return PACKET_PROBES[probe_key]
+
+    # listing every packet takes seconds on long videos, it runs outside the lock so probes are not held up
+
+    packets = run_ffprobe_packets(input_path)
+
+    if packets is None:
+        return []
+
+    with THREAD_LOCK:
+        PACKET_PROBES[probe_key] = packets
+
+    return packets
+
+
+def clear_probes() -> None:
+    with THREAD_LOCK:
+        PROBES.clear()
+        PACKET_PROBES.clear()
+
+
+# Example probe command line command
+# ffprobe -v error -show_streams -show_format -of json ..\?.mp4
+
+def run_ffprobe(input_path: str) -> Optional[Dict[str, Any]]:
+    command = ['ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', input_path]
+
+    try:
+        return json.loads(subprocess.check_output(command).decode())
+    except Exception:
+        return None
+
+
+# Example probe packets command line command
+# ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of json ..\?.mp4
+
+def run_ffprobe_packets(input_path: str) -> Optional[List[Packet]]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'json', input_path]
+
+    try:
+        output = json.loads(subprocess.check_output(command, stderr=subprocess.DEVNULL).decode())
+    except Exception:
+        return None
+
+    packets = []
+
+    # packets without a timestamp cannot be placed and are left out
+
+    for packet in output.get('packets', []):
+        try:
+            packets.append((float(packet['pts_time']), 'K' in packet.get('flags', '')))
+        except (KeyError, ValueError):
+            pass
+    return packets
+
+
+def get_media_probe(output: Dict[str, Any]) -> MediaProbe:
+    streams = output.get('streams', [])
+    video_stream: Dict[str, Any] = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    fps = parse_frame_rate(video_stream.get('r_frame_rate')) or parse_frame_rate(video_stream.get('avg_frame_rate'))
+    duration = parse_float(video_stream.get('duration')) or parse_float(output.get('format', {}).get('duration'))
+    frame_total = int(video_stream.get('nb_frames', 0)) or round(duration * fps)
+
+    return {
+        'fps': fps or 30,
+        'frame_total': frame_total,
+        'duration': duration,
+        'width': int(video_stream.get('width', 0)),
+        'height': int(video_stream.get('height', 0)),
+        'pixel_format': video_stream.get('pix_fmt'),
+        'rotation': get_rotation(video_stream),
+        'audio_streams': [
+            {
+                'index': stream.get('index'),
+                'codec_name': stream.get('codec_name'),
+                'channels': stream.get('channels'),
+                'sample_rate': int(stream.get('sample_rate', 0))
+            }
+            for stream in streams if stream.get('codec_type') == 'audio'
+        ]
+    }
+
+
+def parse_frame_rate(frame_rate: Any) -> float:
+    try:
+        numerator, denominator = map(int, str(frame_rate).split('/'))
+        return numerator / denominator
+    except Exception:
+        return 0
+
+
+def parse_float(value: Any) -> float:
+    try:
+        return float(value)
+    except Exception:
+        return 0
+
+
+def get_rotation(video_stream: Dict[str, Any]) -> int:
+    for side_data in video_stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(side_data['rotation'])
+
+    return int(parse_float(video_stream.get('tags', {}).get('rotate')))
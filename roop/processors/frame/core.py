@@ -1,14 +1,21 @@
 import os
 import sys
 import importlib
+import threading
 import psutil
+import cv2
+import numpy
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
+from queue import Queue, Empty, Full
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Dict, Iterator, List, Callable, Optional, Tuple
+from PIL import Image
 from tqdm import tqdm
 
 import roop
+from roop.face_analyser import get_many_faces_batch
+from roop.face_store import set_frame_number
+from roop.typing import FaceContext, Frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -17,9 +24,21 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_frame',
     'process_frames',
     'process_image',
+    'process_images',
     'process_video',
     'post_process'
 ]
+FRAME_PROCESSORS_INTERFACE_V2 = [
+    'REQUIREMENTS',
+    'BATCH_SIZE',
+    'process_batch'
+]
+FRAME_MEMORY_RATIO = 0.5
+FRAME_QUEUE_DEPTH_PER_THREAD = 4
+FRAME_QUEUE_TIMEOUT = 0.1
+FRAME_ENCODER: Optional[Callable[[Frame], None]] = None
+FrameItem = Tuple[int, str, Frame]
+BatchProcessor = Callable[[Frame, List[int]], Frame]
 
 
 def load_frame_processor_module(frame_processor: str) -> Any:
@@ -28,6 +47,8 @@ def load_frame_processor_module(frame_processor: str) -> Any:
         for method_name in FRAME_PROCESSORS_INTERFACE:
             if not hasattr(frame_processor_module, method_name):
                 raise NotImplementedError
+        if hasattr(frame_processor_module, 'process_batch') and not is_frame_processor_v2(frame_processor_module):
+            raise NotImplementedError
     except ModuleNotFoundError:
         sys.exit(f'Frame processor {frame_processor} not found.')
     except NotImplementedError:
@@ -45,39 +66,341 @@ def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType
     return FRAME_PROCESSORS_MODULES
 
 
-def multi_process_frame(replacement_path: str, sorted_frame_file_paths: List[str], process_frames: Callable[[str, List[str], Any], None], update: Callable[[], None]) -> None:
-    with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
-        futures = []
-        queue = create_queue(sorted_frame_file_paths)
-        queue_per_future = max(len(sorted_frame_file_paths) // roop.globals.execution_threads, 1)
-        while not queue.empty():
-            future = executor.submit(process_frames, replacement_path, pick_queue(queue, queue_per_future), update)
-            futures.append(future)
-        for future in as_completed(futures):
-            future.result()
+def start_warm_up(frame_processors: List[str]) -> threading.Thread:
+    # the optional warm_up hook loads and runs the models in the background, the first frames then find them ready
+
+    def warm_up() -> None:
+        for frame_processor_module in get_frame_processors_modules(frame_processors):
+            if hasattr(frame_processor_module, 'warm_up'):
+                try:
+                    frame_processor_module.warm_up()
+                except Exception:
+                    # a failed warm up is not fatal, the first frame loads the models again and raises
+                    pass
+
+    warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+    warm_up_thread.start()
+    return warm_up_thread
+
+
+def is_frame_processor_v2(frame_processor_module: ModuleType) -> bool:
+    return all(hasattr(frame_processor_module, name) for name in FRAME_PROCESSORS_INTERFACE_V2)
+
+
+def get_frame_processor_requirements(frame_processor_module: ModuleType) -> Optional[List[str]]:
+    # processors that do not declare their requirements get the full analysis
+
+    return getattr(frame_processor_module, 'REQUIREMENTS', None)
+
+
+def get_frame_processor_batch_size(frame_processor_module: ModuleType) -> int:
+    # a set batch size overrides the preferred one of processors that batch, the others take frame by frame
+
+    if not hasattr(frame_processor_module, 'BATCH_SIZE'):
+        return 1
+    return roop.globals.execution_batch_size or frame_processor_module.BATCH_SIZE
+
+
+def get_face_analyser_modules(frame_processors: List[str]) -> Optional[List[str]]:
+    face_analyser_modules = ['detection']
+
+    for frame_processor_module in get_frame_processors_modules(frame_processors):
+        requirements = get_frame_processor_requirements(frame_processor_module)
+        if requirements is None:
+            return None
+        face_analyser_modules.extend(requirement for requirement in requirements if requirement not in face_analyser_modules)
+    return face_analyser_modules
+
+
+def create_frame_batch_processor(process_frame: Callable[[Frame], Frame]) -> BatchProcessor:
+    # adapter for v1 processors, the batch is processed frame by frame
+
+    def process_batch(temp_frames: Frame, frame_numbers: List[int]) -> Frame:
+        result_frames = []
+        for temp_frame, frame_number in zip(temp_frames, frame_numbers):
+            set_frame_number(frame_number)
+            try:
+                result_frames.append(process_frame(temp_frame))
+            finally:
+                set_frame_number(None)
+        return result_frames[0][numpy.newaxis] if len(result_frames) == 1 else numpy.stack(result_frames)
+
+    return process_batch
+
+
+def create_batch_processor(process_batch: Callable[[Frame, FaceContext], Frame], requirements: List[str], face_context: FaceContext) -> BatchProcessor:
+    # detection runs once for the batch and is handed to the processor with the faces
+
+    def process_frame_batch(temp_frames: Frame, frame_numbers: List[int]) -> Frame:
+        batch_face_context: FaceContext = {**face_context, 'frame_numbers': frame_numbers}
+        if 'detection' in requirements:
+            batch_face_context['many_faces'] = get_many_faces_batch(temp_frames, frame_numbers)
+        return process_batch(temp_frames, batch_face_context)
+
+    return process_frame_batch
+
+
+def get_frame_resolution(frame_file_path: str) -> Tuple[int, int]:
+    with Image.open(frame_file_path) as image:
+        return image.size
+
+
+def get_frame_size(frame_file_path: str) -> int:
+    width, height = get_frame_resolution(frame_file_path)
+    return width * height * 3
+
+
+def get_memory_budget() -> int:
+    available_memory = psutil.virtual_memory().available
+
+    if roop.globals.max_memory:
+        used_memory = psutil.Process(os.getpid()).memory_info().rss
+        available_memory = min(available_memory, roop.globals.max_memory * 1024 ** 3 - used_memory)
+
+    return max(int(available_memory * FRAME_MEMORY_RATIO), 0)
+
+
+def get_frame_queue_depth(frame_file_path: str, batch_size: int = 1) -> int:
+    # execution threads hold a batch plus its intermediate copies, io readers and writers a frame each, both queues share the rest
+
+    frame_size = get_frame_size(frame_file_path)
+    frames_in_flight = get_memory_budget() // (frame_size * 2) - roop.globals.execution_threads * batch_size - roop.globals.io_threads * 2
+    queue_depth = min(frames_in_flight // 2, roop.globals.execution_threads * FRAME_QUEUE_DEPTH_PER_THREAD)
+    return max(queue_depth, 1)
+
+
+def set_frame_encoder(frame_encoder: Callable[[Frame], None]) -> None:
+    global FRAME_ENCODER
+
+    FRAME_ENCODER = frame_encoder
+
+
+def clear_frame_encoder() -> None:
+    global FRAME_ENCODER
+
+    FRAME_ENCODER = None
+
+
+def put_queue(queue: Queue[Any], item: Any, stop_event: threading.Event) -> bool:
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=FRAME_QUEUE_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
+
 
+def get_queue(queue: Queue[Any], stop_event: threading.Event) -> Any:
+    while not stop_event.is_set():
+        try:
+            return queue.get(timeout=FRAME_QUEUE_TIMEOUT)
+        except Empty:
+            pass
+    return None
 
-def create_queue(sorted_frame_file_paths: List[str]) -> Queue[str]:
-    queue: Queue[str] = Queue()
 
-    for frame_path in sorted_frame_file_paths:
-        queue.put(frame_path)
-    return queue
+def acquire_slot(frame_slots: threading.Semaphore, stop_event: threading.Event) -> bool:
+    while not stop_event.is_set():
+        if frame_slots.acquire(timeout=FRAME_QUEUE_TIMEOUT):
+            return True
+    return False
 
 
-def pick_queue(queue: Queue[str], queue_per_future: int) -> List[str]:
-    queues = []
-    for _ in range(queue_per_future):
-        if not queue.empty():
-            queues.append(queue.get())
-    return queues
+def read_frames(sorted_frame_file_paths: List[str], read_queue: Queue[Optional[FrameItem]], frame_slots: threading.Semaphore, stop_event: threading.Event) -> None:
+    # io threads decode ahead of the execution threads, the frame slots bound how far
 
+    frame_items = iter(enumerate(sorted_frame_file_paths))
+    frame_items_lock = threading.Lock()
 
-def process_video(replacement_path: str, sorted_frame_file_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+    with ThreadPoolExecutor(max_workers=roop.globals.io_threads) as executor:
+        futures = [executor.submit(read_frame_items, frame_items, frame_items_lock, read_queue, frame_slots, stop_event) for _ in range(roop.globals.io_threads)]
+
+        # a failed read leaves a gap the reorder buffer would wait for forever
+
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            stop_event.set()
+            raise
+    for _ in range(roop.globals.execution_threads):
+        put_queue(read_queue, None, stop_event)
+
+
+def read_frame_items(frame_items: Iterator[Tuple[int, str]], frame_items_lock: threading.Lock, read_queue: Queue[Optional[FrameItem]], frame_slots: threading.Semaphore, stop_event: threading.Event) -> None:
+    while acquire_slot(frame_slots, stop_event):
+        with frame_items_lock:
+            frame_item = next(frame_items, None)
+        if frame_item is None:
+            frame_slots.release()
+            return
+        frame_index, frame_file_path = frame_item
+        temp_frame = cv2.imread(frame_file_path)
+
+        # imread returns None for unreadable files, the workers would fail on it without naming the frame
+
+        if temp_frame is None:
+            frame_slots.release()
+            raise IOError(f'Frame {frame_file_path} cannot be read')
+        if not put_queue(read_queue, (frame_index, frame_file_path, temp_frame), stop_event):
+            return
+
+
+def create_frame_emitter(frame_encoder: Optional[Callable[[Frame], None]], frame_slots: threading.Semaphore) -> Callable[[int, Frame], None]:
+    # workers finish out of order, the reorder buffer hands frames to the encoder in order
+
+    reorder_buffer: Dict[int, Frame] = {}
+    reorder_lock = threading.Lock()
+    next_frame_index = 0
+
+    def emit_frame(frame_index: int, temp_frame: Frame) -> None:
+        nonlocal next_frame_index
+
+        if frame_encoder is None:
+            frame_slots.release()
+            return
+        with reorder_lock:
+            reorder_buffer[frame_index] = temp_frame
+            while next_frame_index in reorder_buffer:
+                frame_encoder(reorder_buffer.pop(next_frame_index))
+                frame_slots.release()
+                next_frame_index += 1
+
+    return emit_frame
+
+
+def write_frames(write_queue: Queue[Optional[FrameItem]], write_frame_file: bool, output_file_paths: Optional[List[str]], emit_frame: Callable[[int, Frame], None], update: Callable[[], None]) -> None:
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        frame_index, frame_file_path, temp_frame = item
+        if write_frame_file:
+            cv2.imwrite(output_file_paths[frame_index] if output_file_paths else frame_file_path, temp_frame)
+        emit_frame(frame_index, temp_frame)
+        if update:
+            update()
+
+
+def run_reader(sorted_frame_file_paths: List[str], read_queue: Queue[Optional[FrameItem]], frame_slots: threading.Semaphore, stop_event: threading.Event, io_exceptions: List[Exception]) -> None:
+    try:
+        read_frames(sorted_frame_file_paths, read_queue, frame_slots, stop_event)
+    except Exception as exception:
+        io_exceptions.append(exception)
+        stop_event.set()
+
+
+def run_writer(write_queue: Queue[Optional[FrameItem]], write_frame_file: bool, output_file_paths: Optional[List[str]], emit_frame: Callable[[int, Frame], None], update: Callable[[], None], stop_event: threading.Event, io_exceptions: List[Exception]) -> None:
+    try:
+        write_frames(write_queue, write_frame_file, output_file_paths, emit_frame, update)
+    except Exception as exception:
+        io_exceptions.append(exception)
+        stop_event.set()
+
+
+def get_queue_items(read_queue: Queue[Optional[FrameItem]], batch_size: int, stop_event: threading.Event) -> Tuple[List[FrameItem], bool]:
+    item = get_queue(read_queue, stop_event)
+    if item is None:
+        return [], True
+    items = [item]
+
+    # a batch takes what is already decoded, it never waits for more frames
+
+    while len(items) < batch_size:
+        try:
+            item = read_queue.get_nowait()
+        except Empty:
+            break
+        if item is None:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def process_items(items: List[FrameItem], process_batch: BatchProcessor) -> List[FrameItem]:
+    processed_items: List[FrameItem] = []
+    start = 0
+
+    # frames of different sizes, as in image directories, cannot share a stack
+
+    while start < len(items):
+        end = start + 1
+        while end < len(items) and items[end][2].shape == items[start][2].shape:
+            end += 1
+        batch_items = items[start:end]
+        temp_frames = batch_items[0][2][numpy.newaxis] if len(batch_items) == 1 else numpy.stack([temp_frame for _, _, temp_frame in batch_items])
+        result_frames = process_batch(temp_frames, [frame_index for frame_index, _, _ in batch_items])
+        processed_items.extend((frame_index, frame_file_path, result_frame) for (frame_index, frame_file_path, _), result_frame in zip(batch_items, result_frames))
+        start = end
+    return processed_items
+
+
+def process_queue(read_queue: Queue[Optional[FrameItem]], write_queue: Queue[Optional[FrameItem]], process_batch: BatchProcessor, batch_size: int, stop_event: threading.Event) -> None:
+    while True:
+        items, done = get_queue_items(read_queue, batch_size, stop_event)
+        for item in process_items(items, process_batch):
+            if not put_queue(write_queue, item, stop_event):
+                return
+        if done:
+            return
+
+
+def multi_process_frame(sorted_frame_file_paths: List[str], process_frame: Callable[[Frame], Frame], update: Callable[[], None], output_file_paths: Optional[List[str]] = None, process_batch: Optional[BatchProcessor] = None, batch_size: int = 1) -> None:
+    if process_batch is None:
+        process_batch = create_frame_batch_processor(process_frame)
+        batch_size = 1
+    queue_depth = get_frame_queue_depth(sorted_frame_file_paths[0], batch_size)
+    read_queue: Queue[Optional[FrameItem]] = Queue(maxsize=queue_depth)
+    write_queue: Queue[Optional[FrameItem]] = Queue(maxsize=queue_depth)
+    frame_slots = threading.Semaphore(queue_depth * 2 + roop.globals.execution_threads * batch_size + roop.globals.io_threads * 2)
+    emit_frame = create_frame_emitter(FRAME_ENCODER, frame_slots)
+    write_frame_file = FRAME_ENCODER is None or bool(roop.globals.keep_frames)
+    stop_event = threading.Event()
+    io_exceptions: List[Exception] = []
+    reader = threading.Thread(target=run_reader, args=(sorted_frame_file_paths, read_queue, frame_slots, stop_event, io_exceptions), daemon=True)
+    writers = [threading.Thread(target=run_writer, args=(write_queue, write_frame_file, output_file_paths, emit_frame, update, stop_event, io_exceptions), daemon=True) for _ in range(roop.globals.io_threads)]
+    reader.start()
+    for writer in writers:
+        writer.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=roop.globals.execution_threads) as executor:
+            futures = []
+            for _ in range(roop.globals.execution_threads):
+                future = executor.submit(process_queue, read_queue, write_queue, process_batch, batch_size, stop_event)
+                futures.append(future)
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                stop_event.set()
+                raise
+    finally:
+        while any(writer.is_alive() for writer in writers):
+            try:
+                write_queue.put(None, timeout=FRAME_QUEUE_TIMEOUT)
+            except Full:
+                pass
+
+    reader.join()
+
+    if io_exceptions:
+        raise io_exceptions[0]
+
+
+def process_video(sorted_frame_file_paths: List[str], process_frame: Callable[[Frame], Frame], process_batch: Optional[BatchProcessor] = None, batch_size: int = 1) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(sorted_frame_file_paths)
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        multi_process_frame(replacement_path, sorted_frame_file_paths, process_frames, lambda: update_progress(progress))
+        multi_process_frame(sorted_frame_file_paths, process_frame, lambda: update_progress(progress), process_batch=process_batch, batch_size=batch_size)
+
+
+def process_images(input_file_paths: List[str], output_file_paths: List[str], process_frame: Callable[[Frame], Frame], process_batch: Optional[BatchProcessor] = None, batch_size: int = 1) -> None:
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    total = len(input_file_paths)
+    with tqdm(total=total, desc='Processing', unit='image', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        multi_process_frame(input_file_paths, process_frame, lambda: update_progress(progress), output_file_paths, process_batch=process_batch, batch_size=batch_size)
 
 
 def update_progress(progress: Any = None) -> None:
@@ -1,5 +1,6 @@
 from typing import Any, List, Callable
 import cv2
+import numpy
 import os
 import threading
 from gfpgan.utils import GFPGANer
@@ -9,7 +10,7 @@ import roop.processors.frame.core
 
 from roop.download import conditional_download
 from roop.face_analyser import get_many_faces
-from roop.file import get_absolute_path, get_temp_directory_path, is_image, is_video
+from roop.file import get_image_file_paths, get_models_directory_path, get_temp_directory_path, is_image, is_video
 from roop.typing import Frame, Face
 from roop.progress import update_status
 
@@ -17,6 +18,7 @@ FACE_ENHANCER = None
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-ENHANCER'
+REQUIREMENTS = ['detection']
 
 
 def get_face_enhancer() -> Any:
@@ -24,7 +26,7 @@ def get_face_enhancer() -> Any:
 
     with THREAD_LOCK:
         if FACE_ENHANCER is None:
-            model_file_path = get_absolute_path('../models/GFPGANv1.4.pth')
+            model_file_path = os.path.join(get_models_directory_path(), 'GFPGANv1.4.pth')
             # todo: set models path -> https://github.com/TencentARC/GFPGAN/issues/399
             FACE_ENHANCER = GFPGANer(model_path=model_file_path, upscale=1, device=get_device())
 
@@ -48,7 +50,7 @@ def clear_face_enhancer() -> None:
 
 
 def pre_check() -> bool:
-    download_directory_path = get_absolute_path('../models')
+    download_directory_path = get_models_directory_path()
     conditional_download(download_directory_path, ['https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth'])
 
     return True
@@ -61,8 +63,8 @@ def pre_start() -> bool:
             update_status(f'Extracted video frames cannot be found in: {temp_frame_file_path}', NAME)
             return False
     else:
-        if not is_image(roop.globals.input_path) and not is_video(roop.globals.input_path):
-            update_status('Select an image or video for target path.', NAME)
+        if not roop.globals.live and not is_image(roop.globals.input_path) and not is_video(roop.globals.input_path) and not get_image_file_paths(roop.globals.input_path):
+            update_status('Select an image, image directory or video for target path.', NAME)
             return False
 
     return True
@@ -72,6 +74,15 @@ def post_process() -> None:
     clear_face_enhancer()
 
 
+def warm_up() -> None:
+    get_many_faces(numpy.zeros((roop.globals.detection_size, roop.globals.detection_size, 3), dtype=numpy.uint8))
+
+    # an aligned face skips the face helper detection and runs the restoration network once
+
+    with THREAD_SEMAPHORE:
+        get_face_enhancer().enhance(numpy.zeros((512, 512, 3), dtype=numpy.uint8), has_aligned=True, paste_back=False)
+
+
 def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
     start_x, start_y, end_x, end_y = map(int, target_face['bbox'])
     padding_x = int((end_x - start_x) * 0.5)
@@ -88,7 +99,7 @@ def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
                 temp_face,
                 paste_back=True
             )
-        temp_frame[start_y:end_y, start_x:end_x] = temp_face
+        numpy.copyto(temp_frame[start_y:end_y, start_x:end_x], temp_face)
 
     return temp_frame
 
@@ -104,13 +115,7 @@ def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) ->
 
 
 def process_frames(replacement_path: str, sorted_frame_file_paths: List[str], update: Callable[[], None]) -> None:
-    for frame_file_path in sorted_frame_file_paths:
-        temp_frame = cv2.imread(frame_file_path)
-        result = process_frame(None, None, temp_frame)
-        cv2.imwrite(frame_file_path, result)
-
-        if update:
-            update()
+    roop.processors.frame.core.multi_process_frame(sorted_frame_file_paths, lambda temp_frame: process_frame(None, None, temp_frame), update)
 
 
 def process_image(replacement_path: str, input_path: str, output_path: str) -> None:
@@ -119,5 +124,9 @@ def process_image(replacement_path: str, input_path: str, output_path: str) -> N
     cv2.imwrite(output_path, result)
 
 
+def process_images(replacement_path: str, input_paths: List[str], output_paths: List[str]) -> None:
+    roop.processors.frame.core.process_images(input_paths, output_paths, lambda temp_frame: process_frame(None, None, temp_frame))
+
+
 def process_video(replacement_path: str, sorted_frame_file_paths: List[str]) -> None:
-    roop.processors.frame.core.process_video(None, sorted_frame_file_paths, process_frames)
+    roop.processors.frame.core.process_video(sorted_frame_file_paths, lambda temp_frame: process_frame(None, None, temp_frame))
@@ -1,23 +1,33 @@
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional, Tuple
 
 import cv2
-import insightface
+import numpy
 import os
 import threading
 
+from insightface.utils import face_align
+
 import roop.globals
 import roop.processors.frame.core
 
 from roop.download import conditional_download
-from roop.face_analyser import get_one_face, get_many_faces, find_similar_face
+from roop.draft import check_draft_reference, get_draft_face, record_draft_decision
+from roop.execution import get_model, get_precision_model_path, get_quantized_model_path
+from roop.face_analyser import get_one_face, get_many_faces, get_similar_face
+from roop.face_store import get_frame_number
 from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
-from roop.file import get_absolute_path, get_temp_directory_path, is_image, is_video
-from roop.typing import Face, Frame
+from roop.file import get_image_file_paths, get_models_directory_path, get_temp_directory_path, is_image, is_video
+from roop.typing import Face, FaceContext, Frame
 from roop.progress import update_status
 
 FACE_SWAPPER = None
+SOURCE_FACE = None
+SOURCE_PATH: Optional[str] = None
 THREAD_LOCK = threading.Lock()
+THREAD_BUFFERS = threading.local()
 NAME = 'ROOP.FACE-SWAPPER'
+REQUIREMENTS = ['detection', 'recognition']
+BATCH_SIZE = 4
 
 
 def get_face_swapper() -> Any:
@@ -25,8 +35,8 @@ def get_face_swapper() -> Any:
 
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
-            model_file_path = get_absolute_path('../models/inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_file_path, providers=roop.globals.execution_providers)
+            model_file_path = os.path.join(get_models_directory_path(), 'inswapper_128.onnx')
+            FACE_SWAPPER = get_model(get_precision_model_path(model_file_path))
 
     return FACE_SWAPPER
 
@@ -37,9 +47,41 @@ def clear_face_swapper() -> None:
     FACE_SWAPPER = None
 
 
+def get_source_face(replacement_path: str) -> Optional[Face]:
+    global SOURCE_FACE, SOURCE_PATH
+
+    # the ui and runs in the same process change the replacement, the cached face only holds for its path
+
+    with THREAD_LOCK:
+        if SOURCE_FACE is None or SOURCE_PATH != replacement_path:
+            SOURCE_FACE = get_one_face(cv2.imread(replacement_path))
+            SOURCE_PATH = replacement_path
+
+    return SOURCE_FACE
+
+
+def clear_source_face() -> None:
+    global SOURCE_FACE, SOURCE_PATH
+
+    SOURCE_FACE = None
+    SOURCE_PATH = None
+
+
+def get_source_latent(source_face: Face) -> Frame:
+    # the latent only depends on the source face, keep it next to its embedding
+
+    if source_face.latent is None:
+        latent = numpy.dot(source_face.normed_embedding.reshape((1, -1)), get_face_swapper().emap)
+        source_face.latent = latent / numpy.linalg.norm(latent)
+
+    return source_face.latent
+
+
 def pre_check() -> bool:
-    download_directory_path = get_absolute_path('../models')
+    download_directory_path = get_models_directory_path()
     conditional_download(download_directory_path, ['https://huggingface.co/CountFloyd/deepfake/resolve/main/inswapper_128.onnx'])
+    if roop.globals.model_precision == 'int8' and not os.path.isfile(get_quantized_model_path(os.path.join(download_directory_path, 'inswapper_128.onnx'))):
+        update_status('No int8 model found, run python -m roop.quantize first. Falling back to fp32...', NAME)
     return True
 
 
@@ -57,8 +99,8 @@ def pre_start() -> bool:
             update_status(f'Extracted video frames cannot be found in: {temp_directory_path}', NAME)
             return False
     else:
-        if not is_image(roop.globals.input_path) and not is_video(roop.globals.input_path):
-            update_status('Select an image or video for target path', NAME)
+        if not roop.globals.live and not is_image(roop.globals.input_path) and not is_video(roop.globals.input_path) and not get_image_file_paths(roop.globals.input_path):
+            update_status('Select an image, image directory or video for target path', NAME)
             return False
 
     return True
@@ -66,11 +108,137 @@ def pre_start() -> bool:
 
 def post_process() -> None:
     clear_face_swapper()
+    clear_source_face()
     clear_face_reference()
 
 
+def warm_up() -> None:
+    # the first run of each session allocates its buffers, detection runs on an empty frame and recognition on the source face
+
+    get_many_faces(numpy.zeros((roop.globals.detection_size, roop.globals.detection_size, 3), dtype=numpy.uint8))
+    face_swapper = get_face_swapper()
+    source_face = get_source_face(roop.globals.replacement_path) if roop.globals.replacement_path else None
+
+    if source_face:
+        face_swapper.session.run(face_swapper.output_names, {
+            face_swapper.input_names[0]: numpy.zeros((1, 3) + face_swapper.input_size[::-1], dtype=numpy.float32),
+            face_swapper.input_names[1]: get_source_latent(source_face)
+        })
+
+
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    face_swapper = get_face_swapper()
+    crop_size = face_swapper.input_size[0]
+    crop_frame, prediction_buffer, prediction_frame, swapped_face = get_swap_buffers(crop_size)
+    affine_matrix = face_align.estimate_norm(target_face.kps, crop_size)
+    cv2.warpAffine(temp_frame, affine_matrix, (crop_size, crop_size), dst=crop_frame, borderValue=0.0)
+    crop_blob = cv2.dnn.blobFromImage(crop_frame, 1.0 / face_swapper.input_std, face_swapper.input_size, (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+    prediction = face_swapper.session.run(face_swapper.output_names, {
+        face_swapper.input_names[0]: crop_blob,
+        face_swapper.input_names[1]: get_source_latent(source_face)
+    })[0]
+
+    # same as clip(255 * prediction).astype(uint8) in rgb, written into the thread buffers
+
+    numpy.multiply(prediction[0].transpose((1, 2, 0)), 255, out=prediction_buffer)
+    numpy.clip(prediction_buffer, 0, 255, out=prediction_buffer)
+    numpy.copyto(prediction_frame, prediction_buffer, casting='unsafe')
+    cv2.cvtColor(prediction_frame, cv2.COLOR_RGB2BGR, dst=swapped_face)
+    return paste_back(temp_frame, swapped_face, affine_matrix)
+
+
+def get_swap_buffers(crop_size: int) -> Tuple[Frame, Frame, Frame, Frame]:
+    buffers = getattr(THREAD_BUFFERS, 'swap', None)
+
+    if buffers is None or buffers[0].shape[0] != crop_size:
+        buffers = (
+            numpy.empty((crop_size, crop_size, 3), dtype=numpy.uint8),
+            numpy.empty((crop_size, crop_size, 3), dtype=numpy.float32),
+            numpy.empty((crop_size, crop_size, 3), dtype=numpy.uint8),
+            numpy.empty((crop_size, crop_size, 3), dtype=numpy.uint8)
+        )
+        THREAD_BUFFERS.swap = buffers
+    return buffers
+
+
+def get_paste_back_buffers(height: int, width: int) -> Tuple[Frame, Frame, Frame]:
+    buffers = getattr(THREAD_BUFFERS, 'paste_back', None)
+
+    if buffers is None or buffers[0].shape[0] < height or buffers[0].shape[1] < width:
+        buffer_height = max(height, buffers[0].shape[0] if buffers else 0)
+        buffer_width = max(width, buffers[0].shape[1] if buffers else 0)
+        buffers = (
+            numpy.empty((buffer_height, buffer_width, 3), dtype=numpy.uint8),
+            numpy.empty((buffer_height, buffer_width), dtype=numpy.float32),
+            numpy.empty((buffer_height, buffer_width, 3), dtype=numpy.float32)
+        )
+        THREAD_BUFFERS.paste_back = buffers
+    swapped_buffer, mask_buffer, merge_buffer = buffers
+    return swapped_buffer[:height, :width], mask_buffer[:height, :width], merge_buffer[:height, :width]
+
+
+def paste_back(temp_frame: Frame, swapped_face: Frame, affine_matrix: Frame) -> Frame:
+    crop_size = swapped_face.shape[0]
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    crop_corners = numpy.array([[[0, 0], [crop_size, 0], [0, crop_size], [crop_size, crop_size]]], dtype=numpy.float32)
+    frame_corners = cv2.transform(crop_corners, inverse_matrix)[0]
+    frame_height, frame_width = temp_frame.shape[:2]
+    min_x, min_y = numpy.clip(frame_corners.min(axis=0), 0, (frame_width - 1, frame_height - 1))
+    max_x, max_y = numpy.clip(frame_corners.max(axis=0), 0, (frame_width - 1, frame_height - 1))
+
+    # same mask parameters as insightface, the margin covers the blur radius
+
+    mask_size = int(numpy.sqrt((max_x - min_x) * (max_y - min_y)))
+    erode_size = max(mask_size // 10, 10)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    margin = blur_size + 2
+    start_x = max(int(min_x) - margin, 0)
+    start_y = max(int(min_y) - margin, 0)
+    end_x = min(int(max_x) + margin, frame_width)
+    end_y = min(int(max_y) + margin, frame_height)
+
+    if start_x >= end_x or start_y >= end_y:
+        return temp_frame
+
+    region_width = end_x - start_x
+    region_height = end_y - start_y
+    region_matrix = inverse_matrix.copy()
+    region_matrix[:, 2] -= (start_x, start_y)
+    swapped_region, mask_region, merge_region = get_paste_back_buffers(region_height, region_width)
+    temp_region = temp_frame[start_y:end_y, start_x:end_x]
+
+    cv2.warpAffine(swapped_face, region_matrix, (region_width, region_height), dst=swapped_region, borderValue=0.0)
+    cv2.warpAffine(get_crop_mask(crop_size), region_matrix, (region_width, region_height), dst=mask_region, borderValue=0.0)
+    cv2.threshold(mask_region, 20, 1, cv2.THRESH_BINARY, dst=mask_region)
+    cv2.erode(mask_region, get_erode_kernel(erode_size), dst=mask_region)
+    cv2.GaussianBlur(mask_region, (blur_size, blur_size), 0, dst=mask_region)
+
+    # blend as temp + mask * (swapped - temp) inside the region only
+
+    numpy.subtract(swapped_region, temp_region, out=merge_region, dtype=numpy.float32)
+    numpy.multiply(merge_region, mask_region[:, :, numpy.newaxis], out=merge_region)
+    numpy.add(merge_region, temp_region, out=merge_region)
+    numpy.copyto(temp_region, merge_region, casting='unsafe')
+    return temp_frame
+
+
+def get_erode_kernel(erode_size: int) -> Frame:
+    erode_kernels = getattr(THREAD_BUFFERS, 'erode_kernels', None)
+
+    if erode_kernels is None:
+        erode_kernels = THREAD_BUFFERS.erode_kernels = {}
+    if erode_size not in erode_kernels:
+        erode_kernels[erode_size] = numpy.ones((erode_size, erode_size), dtype=numpy.uint8)
+    return erode_kernels[erode_size]
+
+
+def get_crop_mask(crop_size: int) -> Frame:
+    crop_mask = getattr(THREAD_BUFFERS, 'crop_mask', None)
+
+    if crop_mask is None or crop_mask.shape[0] != crop_size:
+        crop_mask = numpy.full((crop_size, crop_size), 255, dtype=numpy.float32)
+        THREAD_BUFFERS.crop_mask = crop_mask
+    return crop_mask
 
 
 def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
@@ -80,38 +248,109 @@ def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) ->
             for target_face in many_faces:
                 temp_frame = swap_face(source_face, target_face, temp_frame)
     else:
-        target_face = find_similar_face(temp_frame, reference_face)
+        target_face = find_target_face(temp_frame, get_frame_number(), get_many_faces(temp_frame), reference_face)
         if target_face:
             temp_frame = swap_face(source_face, target_face, temp_frame)
 
     return temp_frame
 
 
+def find_target_face(temp_frame: Frame, frame_number: Optional[int], many_faces: Optional[List[Face]], reference_face: Face) -> Optional[Face]:
+    # a draft of the same input decided which face matches, a draft run records its decisions
+
+    target_face = get_draft_face(temp_frame, frame_number, many_faces) or get_similar_face(many_faces, reference_face)
+    record_draft_decision(temp_frame, frame_number, target_face)
+    return target_face
+
+
+def process_batch(temp_frames: Frame, face_context: FaceContext) -> Frame:
+    source_face = face_context['source_face']
+
+    for temp_frame, frame_number, many_faces in zip(temp_frames, face_context['frame_numbers'], face_context['many_faces']):
+        if roop.globals.many_faces:
+            target_faces = many_faces or []
+        else:
+            target_face = find_target_face(temp_frame, frame_number, many_faces, face_context['reference_face'])
+            target_faces = [target_face] if target_face else []
+        for target_face in target_faces:
+            swap_face(source_face, target_face, temp_frame)
+
+    return temp_frames
+
+
+def get_batch_size() -> int:
+    return roop.globals.execution_batch_size or BATCH_SIZE
+
+
 def process_frames(replacement_path: str, sorted_frame_file_paths: List[str], update: Callable[[], None]) -> None:
-    source_face = get_one_face(cv2.imread(replacement_path))
+    source_face = get_source_face(replacement_path)
     reference_face = None if roop.globals.many_faces else get_face_reference()
+    face_context: FaceContext = {'source_face': source_face, 'reference_face': reference_face}
 
-    for frame_file_path in sorted_frame_file_paths:
-        temp_frame = cv2.imread(frame_file_path)
-        result = process_frame(source_face, reference_face, temp_frame)
-        cv2.imwrite(frame_file_path, result)
-
-        if update:
-            update()
+    roop.processors.frame.core.multi_process_frame(sorted_frame_file_paths, lambda temp_frame: process_frame(source_face, reference_face, temp_frame), update, process_batch=roop.processors.frame.core.create_batch_processor(process_batch, REQUIREMENTS, face_context), batch_size=get_batch_size())
 
 
 def process_image(replacement_path: str, input_path: str, output_path: str) -> None:
-    source_face = get_one_face(cv2.imread(replacement_path))
+    source_face = get_source_face(replacement_path)
     target_frame = cv2.imread(input_path)
     reference_face = None if roop.globals.many_faces else get_one_face(target_frame, roop.globals.reference_face_position)
     result = process_frame(source_face, reference_face, target_frame)
     cv2.imwrite(output_path, result)
 
 
+def process_images(replacement_path: str, input_paths: List[str], output_paths: List[str]) -> None:
+    source_face = get_source_face(replacement_path)
+    get_source_latent(source_face)
+
+    face_context: FaceContext = {'source_face': source_face}
+
+    roop.processors.frame.core.process_images(input_paths, output_paths, lambda temp_frame: process_image_frame(source_face, temp_frame), roop.processors.frame.core.create_batch_processor(process_image_batch, REQUIREMENTS, face_context), get_batch_size())
+
+
+def process_image_batch(temp_frames: Frame, face_context: FaceContext) -> Frame:
+    source_face = face_context['source_face']
+
+    for temp_frame, many_faces in zip(temp_frames, face_context['many_faces']):
+        if roop.globals.many_faces:
+            target_faces = many_faces or []
+        else:
+            target_faces = [get_reference_position_face(many_faces)] if many_faces else []
+        for target_face in target_faces:
+            swap_face(source_face, target_face, temp_frame)
+
+    return temp_frames
+
+
+def get_reference_position_face(many_faces: List[Face]) -> Face:
+    # every image is its own reference, picked like get_one_face from the faces the batch detected
+
+    try:
+        return many_faces[roop.globals.reference_face_position]
+    except IndexError:
+        return many_faces[-1]
+
+
+def process_image_frame(source_face: Face, temp_frame: Frame) -> Frame:
+    if roop.globals.many_faces:
+        return process_frame(source_face, None, temp_frame)
+
+    # every image is its own reference, swapping the reference face directly saves a second detection
+
+    target_face = get_one_face(temp_frame, roop.globals.reference_face_position)
+    if target_face:
+        temp_frame = swap_face(source_face, target_face, temp_frame)
+    return temp_frame
+
+
 def process_video(replacement_path: str, sorted_frame_file_paths: List[str]) -> None:
     if not roop.globals.many_faces and not get_face_reference():
         reference_frame = cv2.imread(sorted_frame_file_paths[roop.globals.reference_frame_number])
         reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
         set_face_reference(reference_face)
 
-    roop.processors.frame.core.process_video(replacement_path, sorted_frame_file_paths, process_frames)
+    source_face = get_source_face(replacement_path)
+    get_source_latent(source_face)
+    reference_face = None if roop.globals.many_faces else get_face_reference()
+    check_draft_reference(reference_face)
+    face_context: FaceContext = {'source_face': source_face, 'reference_face': reference_face}
+    roop.processors.frame.core.process_video(sorted_frame_file_paths, lambda temp_frame: process_frame(source_face, reference_face, temp_frame), roop.processors.frame.core.create_batch_processor(process_batch, REQUIREMENTS, face_context), get_batch_size())
@@ -0,0 +1,215 @@
+from functools import partial
+from types import SimpleNamespace
+from typing import Any, Dict, List
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy
+import onnx
+import onnxruntime
+from onnx import numpy_helper
+from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+import roop.globals
+
+from roop.capturer import get_video_frame, get_video_frame_total
+from roop.execution import get_quantized_model_path, get_quantized_models_directory_path, get_session_options
+from roop.face_analyser import get_face_analyser, get_many_faces, get_one_face
+from roop.file import get_image_file_paths, is_video
+from roop.processors.frame.face_swapper import get_face_swapper, swap_face
+from roop.progress import update_status
+from roop.typing import Frame
+
+QUANTIZE_REPORT_FILE = 'report.json'
+QUANTIZE_TASK_NAMES = ['detection', 'recognition', 'swapper']
+NAME = 'ROOP.QUANTIZE'
+ModelInputs = List[Dict[str, numpy.ndarray]]
+
+
+def parse_args() -> argparse.Namespace:
+    program = argparse.ArgumentParser(prog='python -m roop.quantize', formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('-i', '--input', help='sample video or image directory to take the calibration frames from', dest='input_path', required=True)
+    program.add_argument('-r', '--replacement', help='replacement image file used to run the swapper', dest='replacement_path', required=True)
+    program.add_argument('--method', help='dynamic quantizes the weights only, static calibrates the activations on the sample frames', dest='method', default='dynamic', choices=['dynamic', 'static'])
+    program.add_argument('--frame-total', help='number of calibration frames spread over the sample', dest='frame_total', type=int, default=32)
+    program.add_argument('--detection-size', help='input size of the face detector', dest='detection_size', type=int, default=640, choices=[320, 480, 640, 800, 960, 1280])
+    program.add_argument('--models-directory', help='directory to load the models from and write the int8 models to', dest='models_directory', default=os.environ.get('ROOP_MODELS_DIRECTORY'))
+    return program.parse_args()
+
+
+def get_sample_frames(input_path: str, frame_total: int) -> List[Frame]:
+    if is_video(input_path):
+        video_frame_total = get_video_frame_total(input_path)
+        frame_numbers = numpy.linspace(1, video_frame_total, min(frame_total, video_frame_total), dtype=int)
+        sample_frames = [get_video_frame(input_path, frame_number) for frame_number in frame_numbers]
+    else:
+        image_file_paths = get_image_file_paths(input_path)
+        sample_frames = [cv2.imread(image_file_paths[index]) for index in numpy.linspace(0, len(image_file_paths) - 1, min(frame_total, len(image_file_paths)), dtype=int)]
+    return [sample_frame for sample_frame in sample_frames if sample_frame is not None]
+
+
+def record_model_inputs(model: Any, model_inputs: ModelInputs) -> None:
+    session_run = model.session.run
+
+    # the fp32 pipeline prepares the inputs exactly like processing does, its feeds become the calibration data
+
+    def run(output_names: List[str], input_feed: Dict[str, numpy.ndarray], run_options: Any = None) -> Any:
+        model_inputs.append({input_name: input_value.copy() for input_name, input_value in input_feed.items()})
+        return session_run(output_names, input_feed, run_options)
+
+    model.session.run = run
+
+
+def collect_model_inputs(replacement_path: str, sample_frames: List[Frame]) -> Dict[str, ModelInputs]:
+    source_face = get_one_face(cv2.imread(replacement_path))
+
+    if source_face is None:
+        raise ValueError(f'No face in replacement path {replacement_path} detected')
+
+    face_analyser = get_face_analyser()
+    face_swapper = get_face_swapper()
+    model_inputs: Dict[str, ModelInputs] = {task_name: [] for task_name in QUANTIZE_TASK_NAMES}
+    record_model_inputs(face_analyser.models['detection'], model_inputs['detection'])
+    record_model_inputs(face_analyser.models['recognition'], model_inputs['recognition'])
+    record_model_inputs(face_swapper, model_inputs['swapper'])
+
+    for sample_frame in sample_frames:
+        for target_face in get_many_faces(sample_frame) or []:
+            swap_face(source_face, target_face, sample_frame.copy())
+    return model_inputs
+
+
+def get_model_file_paths() -> Dict[str, str]:
+    face_analyser = get_face_analyser()
+
+    return {
+        'detection': face_analyser.models['detection'].model_file,
+        'recognition': face_analyser.models['recognition'].model_file,
+        'swapper': get_face_swapper().model_file
+    }
+
+
+def quantize_model(model_file_path: str, quantized_model_path: str, method: str, model_inputs: ModelInputs) -> None:
+    if method == 'static':
+        calibration_data_reader = SimpleNamespace(get_next=partial(next, iter(model_inputs), None))
+        quantize_static(model_file_path, quantized_model_path, calibration_data_reader, quant_format=QuantFormat.QDQ, per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(model_file_path, quantized_model_path, weight_type=QuantType.QUInt8)
+
+
+def restore_emap(model_file_path: str, quantized_model_path: str) -> None:
+    emap = onnx.load(model_file_path).graph.initializer[-1]
+    quantized_model = onnx.load(quantized_model_path)
+
+    # the swapper reads its embedding map from the last initializer, the quantizer drops or reorders it
+
+    for initializer in list(quantized_model.graph.initializer):
+        if initializer.name == emap.name:
+            quantized_model.graph.initializer.remove(initializer)
+    quantized_model.graph.initializer.append(emap)
+    onnx.save(quantized_model, quantized_model_path)
+
+
+def measure_model(model_file_path: str, model_inputs: ModelInputs) -> Any:
+    session = onnxruntime.InferenceSession(model_file_path, sess_options=get_session_options(), providers=['CPUExecutionProvider'])
+    session.run(None, model_inputs[0])
+
+    start_time = time.perf_counter()
+    model_outputs = [session.run(None, model_input) for model_input in model_inputs]
+    return (time.perf_counter() - start_time) / len(model_inputs), model_outputs
+
+
+def get_drift(task_name: str, model_outputs: List[List[numpy.ndarray]], quantized_model_outputs: List[List[numpy.ndarray]]) -> Dict[str, float]:
+    if task_name == 'detection':
+        # the first third of the outputs are the scores of each stride
+
+        score_drifts = [numpy.abs(model_output[index] - quantized_model_output[index]).max() for model_output, quantized_model_output in zip(model_outputs, quantized_model_outputs) for index in range(len(model_output) // 3)]
+        return {
+            'score_drift_max': float(numpy.max(score_drifts))
+        }
+
+    if task_name == 'recognition':
+        # same distance as used to match against the reference face
+
+        embeddings = numpy.concatenate([model_output[0] for model_output in model_outputs])
+        quantized_embeddings = numpy.concatenate([quantized_model_output[0] for quantized_model_output in quantized_model_outputs])
+        normed_embeddings = embeddings / numpy.linalg.norm(embeddings, axis=1, keepdims=True)
+        quantized_normed_embeddings = quantized_embeddings / numpy.linalg.norm(quantized_embeddings, axis=1, keepdims=True)
+        distances = numpy.sum(numpy.square(normed_embeddings - quantized_normed_embeddings), axis=1)
+        return {
+            'embedding_distance_mean': float(distances.mean()),
+            'embedding_distance_max': float(distances.max())
+        }
+
+    swapped_faces = numpy.concatenate([numpy.clip(model_output[0] * 255, 0, 255) for model_output in model_outputs])
+    quantized_swapped_faces = numpy.concatenate([numpy.clip(quantized_model_output[0] * 255, 0, 255) for quantized_model_output in quantized_model_outputs])
+    mean_square_error = numpy.mean(numpy.square(swapped_faces - quantized_swapped_faces))
+    return {
+        'pixel_difference_mean': float(numpy.abs(swapped_faces - quantized_swapped_faces).mean()),
+        'psnr': float(10 * numpy.log10(255 ** 2 / mean_square_error)) if mean_square_error else float('inf')
+    }
+
+
+def compare_model(task_name: str, model_file_path: str, quantized_model_path: str, model_inputs: ModelInputs) -> Dict[str, Any]:
+    run_time, model_outputs = measure_model(model_file_path, model_inputs)
+    quantized_run_time, quantized_model_outputs = measure_model(quantized_model_path, model_inputs)
+
+    return {
+        'model': os.path.basename(model_file_path),
+        'runs': len(model_inputs),
+        'fp32_ms': run_time * 1000,
+        'int8_ms': quantized_run_time * 1000,
+        'speedup': run_time / quantized_run_time,
+        **get_drift(task_name, model_outputs, quantized_model_outputs)
+    }
+
+
+def format_comparison(task_name: str, comparison: Dict[str, Any]) -> str:
+    drifts = ', '.join(f'{name} {value:.4f}' for name, value in comparison.items() if name not in ['model', 'runs', 'fp32_ms', 'int8_ms', 'speedup'])
+    return f'{task_name}: {comparison["fp32_ms"]:.1f}ms fp32, {comparison["int8_ms"]:.1f}ms int8, {comparison["speedup"]:.2f}x speedup, {drifts}'
+
+
+def run() -> None:
+    args = parse_args()
+    roop.globals.models_directory = args.models_directory
+    roop.globals.detection_size = args.detection_size
+    roop.globals.face_analyser_modules = ['detection', 'recognition']
+    roop.globals.execution_providers = ['CPUExecutionProvider']
+    roop.globals.model_precision = 'fp32'
+
+    sample_frames = get_sample_frames(args.input_path, args.frame_total)
+    update_status(f'Collecting model inputs on {len(sample_frames)} sample frames...', NAME)
+    model_inputs = collect_model_inputs(args.replacement_path, sample_frames)
+
+    if not model_inputs['swapper']:
+        update_status(f'No face in {args.input_path} detected', NAME)
+        return
+
+    os.makedirs(get_quantized_models_directory_path(), exist_ok=True)
+    report: Dict[str, Any] = {
+        'method': args.method,
+        'frame_total': len(sample_frames),
+        'models': {}
+    }
+
+    for task_name, model_file_path in get_model_file_paths().items():
+        quantized_model_path = get_quantized_model_path(model_file_path)
+        update_status(f'Quantizing {os.path.basename(model_file_path)} with {args.method} quantization...', NAME)
+        quantize_model(model_file_path, quantized_model_path, args.method, model_inputs[task_name])
+
+        if task_name == 'swapper':
+            restore_emap(model_file_path, quantized_model_path)
+
+        report['models'][task_name] = compare_model(task_name, model_file_path, quantized_model_path, model_inputs[task_name])
+        update_status(format_comparison(task_name, report['models'][task_name]), NAME)
+
+    report_file_path = os.path.join(get_quantized_models_directory_path(), QUANTIZE_REPORT_FILE)
+    with open(report_file_path, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    update_status(f'Comparison report written to {report_file_path}', NAME)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,235 @@
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import json
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy
+
+import roop.core
+import roop.globals
+
+from roop.capturer import get_video_frame, get_video_frame_total
+from roop.face_analyser import clear_face_analyser, get_many_faces, get_one_face
+from roop.file import get_image_file_paths, is_video
+from roop.processors.frame.core import get_face_analyser_modules, get_frame_processors_modules
+from roop.progress import update_status
+from roop.typing import Face, Frame
+
+REGRESSION_PSNR_LIMIT = 100.0
+NAME = 'ROOP.REGRESSION'
+
+
+def parse_args() -> Tuple[argparse.Namespace, List[str]]:
+    program = argparse.ArgumentParser(prog='python -m roop.regression', description='remaining arguments are roop options shared by both configurations', formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100))
+    program.add_argument('-i', '--input', help='fixed clip as video or image directory', dest='input_path', required=True)
+    program.add_argument('-r', '--replacement', help='replacement image file', dest='replacement_path', required=True)
+    program.add_argument('--optimized', help='roop options of the optimized configuration (e.g., "--model-precision int8 --detection-proxy-size 320")', dest='optimized', default='')
+    program.add_argument('--frame-total', help='number of frames from the start of the clip', dest='frame_total', type=int, default=60)
+    program.add_argument('--hit-similarity', help='identity similarity from which a face counts as swapped', dest='hit_similarity', type=float, default=0.3)
+    program.add_argument('--min-psnr', help='fail below this mean psnr against the reference', dest='min_psnr', type=float, default=30.0)
+    program.add_argument('--min-ssim', help='fail below this mean ssim against the reference', dest='min_ssim', type=float, default=0.95)
+    program.add_argument('--max-identity-drift', help='fail when the mean identity similarity drops more than this', dest='max_identity_drift', type=float, default=0.02)
+    program.add_argument('--max-hit-rate-drift', help='fail when the swap hit rate drops more than this', dest='max_hit_rate_drift', type=float, default=0.02)
+    program.add_argument('--report', help='write the per frame metrics to this json file', dest='report_path')
+    return program.parse_known_args()
+
+
+def get_configuration(roop_args: List[str]) -> Dict[str, Any]:
+    # both configurations go through the roop argument parser, they get the same defaults as production
+
+    argv = sys.argv
+    sys.argv = [argv[0]] + roop_args
+
+    try:
+        roop.core.parse_args()
+    finally:
+        sys.argv = argv
+
+    if roop.globals.face_analyser_profile == 'minimal':
+        roop.globals.face_analyser_modules = get_face_analyser_modules(roop.globals.frame_processors)
+    return {name: value for name, value in vars(roop.globals).items() if not name.startswith('_') and name not in ['List', 'Optional']}
+
+
+def set_configuration(configuration: Dict[str, Any]) -> None:
+    for name, value in configuration.items():
+        setattr(roop.globals, name, value)
+    clear_models()
+
+
+def clear_models() -> None:
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        frame_processor.post_process()
+    clear_face_analyser()
+
+
+def get_clip_frames(input_path: str, frame_total: int) -> List[Frame]:
+    # consecutive frames, tracking and dedup only show their drift on a continuous clip
+
+    if is_video(input_path):
+        clip_frames = [get_video_frame(input_path, frame_number) for frame_number in range(1, min(frame_total, get_video_frame_total(input_path)) + 1)]
+    else:
+        clip_frames = [cv2.imread(image_file_path) for image_file_path in get_image_file_paths(input_path)[:frame_total]]
+    return [clip_frame for clip_frame in clip_frames if clip_frame is not None]
+
+
+def run_reference(replacement_path: str, clip_frames: List[Frame]) -> List[Frame]:
+    source_face = get_one_face(cv2.imread(replacement_path))
+    reference_face = None if roop.globals.many_faces else get_one_face(clip_frames[min(roop.globals.reference_frame_number, len(clip_frames) - 1)], roop.globals.reference_face_position)
+    output_frames = []
+
+    for clip_frame in clip_frames:
+        temp_frame = clip_frame.copy()
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+            temp_frame = frame_processor.process_frame(source_face, reference_face, temp_frame)
+        output_frames.append(temp_frame)
+    return output_frames
+
+
+def run_optimized(replacement_path: str, clip_frames: List[Frame]) -> List[Frame]:
+    temp_directory_path = tempfile.mkdtemp(prefix='roop-regression-')
+    sorted_frame_file_paths = [os.path.join(temp_directory_path, f'{frame_index + 1:04d}.png') for frame_index in range(len(clip_frames))]
+
+    # the optimized configuration runs the production video path with its pipeline
+
+    try:
+        for frame_file_path, clip_frame in zip(sorted_frame_file_paths, clip_frames):
+            cv2.imwrite(frame_file_path, clip_frame)
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+            frame_processor.process_video(replacement_path, sorted_frame_file_paths)
+            frame_processor.post_process()
+        return [cv2.imread(frame_file_path) for frame_file_path in sorted_frame_file_paths]
+    finally:
+        shutil.rmtree(temp_directory_path, ignore_errors=True)
+
+
+def get_psnr(reference_frame: Frame, temp_frame: Frame) -> float:
+    mean_square_error = numpy.mean(numpy.square(reference_frame.astype(numpy.float64) - temp_frame))
+
+    if not mean_square_error:
+        return REGRESSION_PSNR_LIMIT
+    return min(float(10 * numpy.log10(255 ** 2 / mean_square_error)), REGRESSION_PSNR_LIMIT)
+
+
+def get_ssim(reference_frame: Frame, temp_frame: Frame) -> float:
+    # gaussian weighted ssim on luma with the constants of the original paper
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    x = cv2.cvtColor(reference_frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    y = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2GRAY).astype(numpy.float64)
+    mu_x = cv2.GaussianBlur(x, (11, 11), 1.5)
+    mu_y = cv2.GaussianBlur(y, (11, 11), 1.5)
+    sigma_x = cv2.GaussianBlur(x * x, (11, 11), 1.5) - mu_x * mu_x
+    sigma_y = cv2.GaussianBlur(y * y, (11, 11), 1.5) - mu_y * mu_y
+    sigma_xy = cv2.GaussianBlur(x * y, (11, 11), 1.5) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (sigma_x + sigma_y + c2))
+    return float(ssim_map.mean())
+
+
+def get_identity_similarity(source_face: Face, temp_frame: Frame) -> Optional[float]:
+    many_faces = get_many_faces(temp_frame)
+
+    if not many_faces:
+        return None
+    return max(float(numpy.dot(face.normed_embedding, source_face.normed_embedding)) for face in many_faces)
+
+
+def measure(replacement_path: str, clip_frames: List[Frame], reference_frames: List[Frame], optimized_frames: List[Frame], hit_similarity: float) -> List[Dict[str, Any]]:
+    source_face = get_one_face(cv2.imread(replacement_path))
+    frame_metrics = []
+
+    for frame_index, (clip_frame, reference_frame, optimized_frame) in enumerate(zip(clip_frames, reference_frames, optimized_frames)):
+        reference_similarity = get_identity_similarity(source_face, reference_frame)
+        optimized_similarity = get_identity_similarity(source_face, optimized_frame)
+        frame_metrics.append({
+            'frame_number': frame_index + 1,
+            'has_face': bool(get_many_faces(clip_frame)),
+            'psnr': get_psnr(reference_frame, optimized_frame),
+            'ssim': get_ssim(reference_frame, optimized_frame),
+            'reference_similarity': reference_similarity,
+            'optimized_similarity': optimized_similarity,
+            'reference_hit': reference_similarity is not None and reference_similarity >= hit_similarity,
+            'optimized_hit': optimized_similarity is not None and optimized_similarity >= hit_similarity
+        })
+    return frame_metrics
+
+
+def summarize(frame_metrics: List[Dict[str, Any]], reference_seconds: float, optimized_seconds: float) -> Dict[str, Any]:
+    face_metrics = [frame_metric for frame_metric in frame_metrics if frame_metric['has_face']] or frame_metrics
+    similarity_metrics = [frame_metric for frame_metric in face_metrics if frame_metric['reference_similarity'] is not None]
+
+    return {
+        'frame_total': len(frame_metrics),
+        'speedup': reference_seconds / max(optimized_seconds, 1e-9),
+        'psnr_mean': float(numpy.mean([frame_metric['psnr'] for frame_metric in frame_metrics])),
+        'psnr_min': float(numpy.min([frame_metric['psnr'] for frame_metric in frame_metrics])),
+        'ssim_mean': float(numpy.mean([frame_metric['ssim'] for frame_metric in frame_metrics])),
+        'ssim_min': float(numpy.min([frame_metric['ssim'] for frame_metric in frame_metrics])),
+        'identity_drift': float(numpy.mean([frame_metric['reference_similarity'] - (frame_metric['optimized_similarity'] or 0) for frame_metric in similarity_metrics])) if similarity_metrics else 0.0,
+        'reference_hit_rate': float(numpy.mean([frame_metric['reference_hit'] for frame_metric in face_metrics])),
+        'optimized_hit_rate': float(numpy.mean([frame_metric['optimized_hit'] for frame_metric in face_metrics]))
+    }
+
+
+def get_failures(summary: Dict[str, Any], args: argparse.Namespace) -> List[str]:
+    failures = []
+
+    if summary['psnr_mean'] < args.min_psnr:
+        failures.append(f'mean psnr {summary["psnr_mean"]:.2f} below {args.min_psnr}')
+    if summary['ssim_mean'] < args.min_ssim:
+        failures.append(f'mean ssim {summary["ssim_mean"]:.4f} below {args.min_ssim}')
+    if summary['identity_drift'] > args.max_identity_drift:
+        failures.append(f'identity drift {summary["identity_drift"]:.4f} above {args.max_identity_drift}')
+    if summary['reference_hit_rate'] - summary['optimized_hit_rate'] > args.max_hit_rate_drift:
+        failures.append(f'hit rate {summary["optimized_hit_rate"]:.2%} against {summary["reference_hit_rate"]:.2%} drifts above {args.max_hit_rate_drift:.2%}')
+    return failures
+
+
+def run() -> None:
+    args, roop_args = parse_args()
+    roop_args += ['--input', args.input_path, '--replacement', args.replacement_path]
+    reference_configuration = get_configuration(roop_args)
+    optimized_configuration = get_configuration(roop_args + shlex.split(args.optimized))
+
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        if not frame_processor.pre_check():
+            sys.exit(2)
+
+    clip_frames = get_clip_frames(args.input_path, args.frame_total)
+    update_status(f'Running the reference configuration on {len(clip_frames)} frames...', NAME)
+    set_configuration(reference_configuration)
+    start_time = time.perf_counter()
+    reference_frames = run_reference(args.replacement_path, clip_frames)
+    reference_seconds = time.perf_counter() - start_time
+
+    update_status(f'Running the optimized configuration {args.optimized or "(defaults)"}...', NAME)
+    set_configuration(optimized_configuration)
+    start_time = time.perf_counter()
+    optimized_frames = run_optimized(args.replacement_path, clip_frames)
+    optimized_seconds = time.perf_counter() - start_time
+
+    # both outputs are measured with the reference models
+
+    set_configuration(reference_configuration)
+    frame_metrics = measure(args.replacement_path, clip_frames, reference_frames, optimized_frames, args.hit_similarity)
+    summary = summarize(frame_metrics, reference_seconds, optimized_seconds)
+    failures = get_failures(summary, args)
+    update_status(f'{summary["speedup"]:.2f}x speedup, psnr {summary["psnr_mean"]:.2f} (min {summary["psnr_min"]:.2f}), ssim {summary["ssim_mean"]:.4f} (min {summary["ssim_min"]:.4f}), '
+                  f'identity drift {summary["identity_drift"]:.4f}, hit rate {summary["optimized_hit_rate"]:.2%} against {summary["reference_hit_rate"]:.2%}', NAME)
+
+    if args.report_path:
+        with open(args.report_path, 'w') as report_file:
+            json.dump({'optimized': args.optimized, 'summary': summary, 'failures': failures, 'frames': frame_metrics}, report_file, indent=4)
+
+    for failure in failures:
+        update_status(f'Regression: {failure}', NAME)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    run()
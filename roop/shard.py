@@ -0,0 +1,339 @@
+from typing import Any, Dict, List, Optional, Tuple
+import glob
+import hashlib
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import roop.globals
+
+from roop.autotune import autotune
+from roop.capturer import get_video_frame
+from roop.face_analyser import get_one_face
+from roop.face_reference import set_face_reference
+from roop.face_store import get_content_hash
+from roop.ffmpeg import extract_frame_range, create_segment, concat_segments, has_audio_stream
+from roop.file import get_temp_directory_path, lock_file
+from roop.predictor import predict_video
+from roop.probe import probe
+from roop.processors.frame.core import get_frame_processors_modules
+from roop.progress import update_status
+
+STATUS_FILE = 'status.json'
+SEGMENT_LIST_FILE = 'segments.txt'
+SHARD_POLL_INTERVAL = 1.0
+SHARD_HEARTBEAT_INTERVAL = 10.0
+SHARD_HEARTBEAT_TIMEOUT = 60.0
+
+
+def get_shard_directory_path(input_file_path: str) -> str:
+    return roop.globals.shard_directory or get_temp_directory_path(input_file_path) + '-shards'
+
+
+def get_shard_frame_directory_path(input_file_path: str, shard_index: int) -> str:
+    return os.path.join(get_shard_directory_path(input_file_path), f'{shard_index:04d}')
+
+
+def get_shard_segment_file_path(input_file_path: str, shard_index: int) -> str:
+    return os.path.join(get_shard_directory_path(input_file_path), f'{shard_index:04d}.mp4')
+
+
+def get_shard_fps(input_file_path: str) -> Tuple[float, int]:
+    media_probe = probe(input_file_path)
+
+    if roop.globals.keep_fps:
+        return media_probe['fps'], media_probe['frame_total']
+
+    return 30, math.ceil(media_probe['duration'] * 30)
+
+
+def get_reference_video_frame_number(input_file_path: str, fps: float) -> int:
+    # the reference frame number counts frames extracted at fps like process_video does, the capture counts native frames
+
+    return round(roop.globals.reference_frame_number / fps * (probe(input_file_path)['fps'] or fps))
+
+
+def get_shard_ranges(frame_total: int, shard_count: int) -> List[Tuple[int, int]]:
+    shard_count = max(min(shard_count, frame_total), 1)
+    bounds = [frame_total * shard_index // shard_count for shard_index in range(shard_count + 1)]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_shard_settings_key(input_file_path: str) -> str:
+    # everything that changes the frames of a shard, finished shards are only reused when all of it matches
+
+    sha256 = hashlib.sha256(get_content_hash(input_file_path).encode())
+    if roop.globals.replacement_path:
+        sha256.update(get_content_hash(roop.globals.replacement_path).encode())
+    sha256.update(repr((
+        roop.globals.frame_processors,
+        roop.globals.model_precision,
+        roop.globals.many_faces,
+        roop.globals.reference_face_position,
+        roop.globals.reference_frame_number,
+        roop.globals.similar_face_distance,
+        roop.globals.detection_size,
+        roop.globals.detection_proxy_size,
+        roop.globals.temp_frame_format,
+        roop.globals.temp_frame_quality,
+        roop.globals.output_video_encoder,
+        roop.globals.output_video_lossiness
+    )).encode())
+    return sha256.hexdigest()[:16]
+
+
+def read_status(input_file_path: str) -> Dict[str, Any]:
+    status_file_path = os.path.join(get_shard_directory_path(input_file_path), STATUS_FILE)
+
+    try:
+        with open(status_file_path) as status_file:
+            return json.load(status_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_status(input_file_path: str, status: Dict[str, Any]) -> None:
+    status_file_path = os.path.join(get_shard_directory_path(input_file_path), STATUS_FILE)
+
+    with open(status_file_path + '.part', 'w') as status_file:
+        json.dump(status, status_file, indent=4)
+    os.replace(status_file_path + '.part', status_file_path)
+
+
+def update_shard_status(input_file_path: str, shard_index: int, **shard_status: Any) -> Dict[str, Any]:
+    status_file_path = os.path.join(get_shard_directory_path(input_file_path), STATUS_FILE)
+
+    # every shard shares the status file, the lock makes each update read-modify-write
+
+    with lock_file(status_file_path + '.lock'):
+        status = read_status(input_file_path)
+        shard = status['shards'][shard_index]
+        shard.update(shard_status)
+        shard.update({
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'updated': time.time()
+        })
+        write_status(input_file_path, status)
+
+    return shard
+
+
+def init_status(input_file_path: str) -> Dict[str, Any]:
+    shard_directory_path = get_shard_directory_path(input_file_path)
+    os.makedirs(shard_directory_path, exist_ok=True)
+    status_file_path = os.path.join(shard_directory_path, STATUS_FILE)
+    fps, frame_total = get_shard_fps(input_file_path)
+
+    with lock_file(status_file_path + '.lock'):
+        status = read_status(input_file_path)
+
+        # finished shards of an earlier run with the same split and settings are kept
+
+        shard_ranges = get_shard_ranges(frame_total, roop.globals.shard_count)
+        settings = get_shard_settings_key(input_file_path)
+        previous_shards = {(shard['start'], shard['end']): shard for shard in status.get('shards', []) if shard['status'] == 'done'} if status.get('input') == os.path.abspath(input_file_path) and status.get('fps') == fps and status.get('settings') == settings else {}
+        status = {
+            'input': os.path.abspath(input_file_path),
+            'fps': fps,
+            'settings': settings,
+            'frame_total': frame_total,
+            'shards': [
+                previous_shards.get((start, end)) or {
+                    'index': shard_index,
+                    'start': start,
+                    'end': end,
+                    'status': 'pending',
+                    'attempts': 0,
+                    'stage': None
+                }
+                for shard_index, (start, end) in enumerate(shard_ranges)
+            ]
+        }
+        write_status(input_file_path, status)
+
+    return status
+
+
+def start_heartbeat(input_file_path: str, shard_index: int) -> threading.Event:
+    stop_event = threading.Event()
+
+    # the coordinator requeues running shards whose worker stopped beating
+
+    def beat() -> None:
+        while not stop_event.wait(SHARD_HEARTBEAT_INTERVAL):
+            update_shard_status(input_file_path, shard_index)
+
+    threading.Thread(target=beat, daemon=True).start()
+    return stop_event
+
+
+def process_shard(shard_index: int) -> bool:
+    input_file_path = roop.globals.input_path
+    status = read_status(input_file_path) or init_status(input_file_path)
+
+    # workers started with other settings would mix differently processed segments
+
+    if status.get('settings') != get_shard_settings_key(input_file_path):
+        update_status(f'Shard {shard_index} halted: settings differ from the coordinator', f'ROOP.SHARD.{shard_index}')
+        return False
+
+    shard = status['shards'][shard_index]
+    shard_frame_directory_path = get_shard_frame_directory_path(input_file_path, shard_index)
+    attempts = shard['attempts'] + 1
+
+    update_shard_status(input_file_path, shard_index, status='running', attempts=attempts, stage='extracting')
+    heartbeat = start_heartbeat(input_file_path, shard_index)
+
+    try:
+        if os.path.isdir(shard_frame_directory_path):
+            shutil.rmtree(shard_frame_directory_path)
+        os.makedirs(shard_frame_directory_path)
+
+        update_status(f'Extracting frames {shard["start"]} to {shard["end"]} with {status["fps"]} FPS...', f'ROOP.SHARD.{shard_index}')
+        extract_frame_range(input_file_path, shard_frame_directory_path, shard['start'], shard['end'] - shard['start'], status['fps'])
+        sorted_frame_file_paths = sorted(glob.glob(os.path.join(glob.escape(shard_frame_directory_path), '*.' + roop.globals.temp_frame_format)))
+
+        if not sorted_frame_file_paths:
+            raise IOError(f'No frames extracted for shard {shard_index}')
+
+        # shards on the same host share the cached calibration
+
+        if roop.globals.autotune:
+            autotune(sorted_frame_file_paths)
+
+        # every shard matches against the reference face of the whole video
+
+        if not roop.globals.many_faces:
+            reference_frame = get_video_frame(input_file_path, get_reference_video_frame_number(input_file_path, status['fps']) + 1)
+            set_face_reference(get_one_face(reference_frame, roop.globals.reference_face_position))
+
+        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+            update_shard_status(input_file_path, shard_index, stage=frame_processor.NAME)
+            update_status('Progressing...', frame_processor.NAME)
+            frame_processor.process_video(roop.globals.replacement_path, sorted_frame_file_paths)
+            frame_processor.post_process()
+
+        update_shard_status(input_file_path, shard_index, stage='encoding')
+
+        if not create_segment(shard_frame_directory_path, get_shard_segment_file_path(input_file_path, shard_index), status['fps']):
+            raise IOError(f'Encoding segment of shard {shard_index} failed')
+
+        if not roop.globals.keep_frames:
+            shutil.rmtree(shard_frame_directory_path)
+    except Exception as exception:
+        update_status(f'Shard {shard_index} failed: {exception}', f'ROOP.SHARD.{shard_index}')
+        update_shard_status(input_file_path, shard_index, status='failed', error=str(exception))
+        return False
+    finally:
+        heartbeat.set()
+
+    update_shard_status(input_file_path, shard_index, status='done', stage=None, error=None)
+    return True
+
+
+def launch_shard(shard_index: int) -> subprocess.Popen[bytes]:
+    return subprocess.Popen([sys.executable] + sys.argv + ['--shard-index', str(shard_index)])
+
+
+def get_pending_shard_indexes(status: Dict[str, Any]) -> List[int]:
+    return [shard['index'] for shard in status['shards'] if shard['status'] == 'pending' or shard['status'] == 'failed' and shard['attempts'] <= roop.globals.shard_retries]
+
+
+def process_sharded_video() -> bool:
+    input_file_path = roop.globals.input_path
+
+    if not roop.globals.allow_nsfw:
+        update_status('NSFW check...')
+        if predict_video(input_file_path):
+            update_status('Processing video halted: NSFW detected!')
+            return False
+
+    status = init_status(input_file_path)
+    update_status(f'Processing {status["frame_total"]} frames in {len(status["shards"])} shards at {get_shard_directory_path(input_file_path)}...')
+
+    # remote workers pick up shards on their own, failed shards are retried locally
+
+    shard_workers = roop.globals.shard_workers
+    running_shards: Dict[int, subprocess.Popen[bytes]] = {}
+
+    while True:
+        status = read_status(input_file_path)
+        pending_shard_indexes = [shard_index for shard_index in get_pending_shard_indexes(status) if shard_index not in running_shards]
+
+        if not shard_workers:
+            pending_shard_indexes = [shard_index for shard_index in pending_shard_indexes if status['shards'][shard_index]['status'] == 'failed']
+
+        for shard_index in pending_shard_indexes[:max(shard_workers or 1, 1) - len(running_shards)]:
+            running_shards[shard_index] = launch_shard(shard_index)
+
+        for shard_index, shard_process in list(running_shards.items()):
+            if shard_process.poll() is not None:
+                del running_shards[shard_index]
+
+                # a worker that crashed before reporting leaves its shard running
+
+                if read_status(input_file_path)['shards'][shard_index]['status'] == 'running':
+                    update_shard_status(input_file_path, shard_index, status='failed', error=f'exit code {shard_process.returncode}')
+
+        # remote workers are only known by their heartbeat, a shard without one for too long is requeued
+
+        for shard in read_status(input_file_path)['shards']:
+            if shard['status'] == 'running' and shard['index'] not in running_shards and time.time() - shard.get('updated', 0) > SHARD_HEARTBEAT_TIMEOUT:
+                update_status(f'Shard {shard["index"]} on {shard.get("host")} stopped responding, requeueing...')
+                update_shard_status(input_file_path, shard['index'], status='failed', error='heartbeat timed out')
+
+        status = read_status(input_file_path)
+        done_total = sum(shard['status'] == 'done' for shard in status['shards'])
+        given_up = [shard['index'] for shard in status['shards'] if shard['status'] == 'failed' and shard['attempts'] > roop.globals.shard_retries]
+
+        if given_up and not running_shards:
+            update_status(f'Processing video halted: shards {given_up} failed after {roop.globals.shard_retries} retries')
+            return False
+
+        if done_total == len(status['shards']):
+            break
+
+        time.sleep(SHARD_POLL_INTERVAL)
+
+    return concat_shards(status)
+
+
+def concat_shards(status: Dict[str, Any]) -> bool:
+    input_file_path = roop.globals.input_path
+    shard_directory_path = get_shard_directory_path(input_file_path)
+    segment_list_file_path = os.path.join(shard_directory_path, SEGMENT_LIST_FILE)
+    audio = not roop.globals.skip_audio and has_audio_stream(input_file_path)
+
+    with open(segment_list_file_path, 'w') as segment_list_file:
+        for shard in status['shards']:
+            segment_file_path = get_shard_segment_file_path(input_file_path, shard['index'])
+            segment_list_file.write("file '" + segment_file_path.replace("'", "'\\''") + "'\n")
+
+    update_status('Concatenating segments with audio...' if audio else 'Concatenating segments...')
+    video_done = concat_segments(segment_list_file_path, input_file_path, roop.globals.output_path, audio)
+
+    if not video_done and audio:
+        update_status('Concatenating segments without audio...')
+        video_done = concat_segments(segment_list_file_path, input_file_path, roop.globals.output_path)
+
+    if video_done and not roop.globals.keep_frames:
+        update_status('Cleaning temporary resources...')
+        shutil.rmtree(shard_directory_path)
+
+    update_status('Processing to video succeed!' if video_done else 'Processing to video failed!')
+    return video_done
+
+
+def start_shard(shard_index: Optional[int]) -> bool:
+    if shard_index is None:
+        return process_sharded_video()
+
+    return process_shard(shard_index)
@@ -1,7 +1,25 @@
-from typing import Any
+from typing import Any, Dict, List, Optional, TypedDict
 
 from insightface.app.common import Face
 import numpy
 
 Face = Face
 Frame = numpy.ndarray[Any, Any]
+
+
+class MediaProbe(TypedDict):
+    fps: float
+    frame_total: int
+    duration: float
+    width: int
+    height: int
+    pixel_format: Optional[str]
+    rotation: int
+    audio_streams: List[Dict[str, Any]]
+
+
+class FaceContext(TypedDict, total=False):
+    source_face: Optional[Face]
+    reference_face: Optional[Face]
+    frame_numbers: List[int]
+    many_faces: List[Optional[List[Face]]]
@@ -1,7 +1,10 @@
 import os
 import sys
+import threading
 import webbrowser
 import customtkinter as ctk
+from collections import OrderedDict
+from queue import Queue
 from tkinterdnd2 import TkinterDnD, DND_ALL
 from typing import Any, Callable, Tuple, Optional
 import cv2
@@ -10,11 +13,14 @@ from PIL import Image, ImageOps
 import roop.globals
 import roop.metadata
 from roop.face_analyser import get_one_face
-from roop.capturer import get_video_frame, get_video_frame_total
+from roop.face_store import open_face_store, set_frame_number
+from roop.capturer import get_video_frame, release_video_captures
 from roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
 from roop.predictor import predict_frame, clear_predictor
+from roop.probe import probe
 from roop.processors.frame.core import get_frame_processors_modules
 from roop.file import is_image, is_video, get_absolute_path
+from roop.typing import Face, Frame
 
 ROOT = None
 ROOT_HEIGHT = 700
@@ -23,6 +29,18 @@ ROOT_WIDTH = 600
 PREVIEW = None
 PREVIEW_MAX_HEIGHT = 700
 PREVIEW_MAX_WIDTH = 1200
+PREVIEW_DRAFT_SIZE = 480
+PREVIEW_CACHE_SIZE = 32
+PREVIEW_POLL_INTERVAL = 50
+
+PREVIEW_CACHE: OrderedDict[Tuple[Any, ...], Image.Image] = OrderedDict()
+PREVIEW_CONDITION = threading.Condition()
+PREVIEW_GENERATION = 0
+PREVIEW_REQUEST: Optional[Tuple[int, int, Tuple[Any, ...]]] = None
+PREVIEW_RESULTS: Queue[Tuple[int, Optional[Tuple[Any, ...]], Optional[Image.Image]]] = Queue()
+PREVIEW_THREAD = None
+PREVIEW_SOURCE_PATH = None
+PREVIEW_SOURCE_FACE = None
 
 RECENT_DIRECTORY_SOURCE = None
 RECENT_DIRECTORY_TARGET = None
@@ -146,6 +164,7 @@ def create_preview(parent: ctk.CTkToplevel) -> ctk.CTkToplevel:
 
     preview.bind('<Up>', lambda event: update_face_reference(1))
     preview.bind('<Down>', lambda event: update_face_reference(-1))
+    preview.after(PREVIEW_POLL_INTERVAL, poll_preview)
     return preview
 
 
@@ -180,6 +199,7 @@ def select_input_path(input_path: Optional[str] = None) -> None:
         PREVIEW.withdraw()
 
     clear_face_reference()
+    release_video_captures()
 
     if input_path is None:
         input_path = ctk.filedialog.askopenfilename(title='select an target image or video', initialdir=RECENT_DIRECTORY_TARGET)
@@ -225,14 +245,9 @@ def render_image_preview(image_path: str, size: Tuple[int, int]) -> ctk.CTkImage
 
 
 def render_video_preview(video_path: str, size: Tuple[int, int], frame_number: int = 0) -> ctk.CTkImage:
-    capture = cv2.VideoCapture(video_path)
+    frame = get_video_frame(video_path, frame_number)
 
-    if frame_number:
-        capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-
-    has_frame, frame = capture.read()
-
-    if has_frame:
+    if frame is not None:
         image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
         if size:
@@ -240,9 +255,6 @@ def render_video_preview(video_path: str, size: Tuple[int, int], frame_number: i
 
         return ctk.CTkImage(image, size=image.size)
 
-    capture.release()
-    cv2.destroyAllWindows()
-
 
 def toggle_preview() -> None:
     if PREVIEW.state() == 'normal':
@@ -263,7 +275,7 @@ def init_preview() -> None:
         preview_slider.pack_forget()
 
     if is_video(roop.globals.input_path):
-        video_frame_total = get_video_frame_total(roop.globals.input_path)
+        video_frame_total = probe(roop.globals.input_path)['frame_total']
 
         if video_frame_total > 0:
             PREVIEW.title('Preview [ ↕ Reference face ] [ ↔ Frame number ]')
@@ -276,32 +288,162 @@ def init_preview() -> None:
 
 
 def update_preview(frame_number: int = 0) -> None:
+    global PREVIEW_GENERATION, PREVIEW_REQUEST, PREVIEW_THREAD
+
     if roop.globals.replacement_path and roop.globals.input_path:
-        temp_frame = get_video_frame(roop.globals.input_path, frame_number)
+        frame_number = int(frame_number)
+        preview_key = get_preview_key(frame_number)
+
+        if preview_key in PREVIEW_CACHE:
+            PREVIEW_CACHE.move_to_end(preview_key)
+            show_preview(PREVIEW_CACHE[preview_key])
+
+        # newer requests replace pending ones and cancel the one in progress
+
+        with PREVIEW_CONDITION:
+            PREVIEW_GENERATION += 1
+            PREVIEW_REQUEST = None if preview_key in PREVIEW_CACHE else (PREVIEW_GENERATION, frame_number, preview_key)
+            PREVIEW_CONDITION.notify()
+
+        if PREVIEW_THREAD is None:
+            PREVIEW_THREAD = threading.Thread(target=render_preview_loop, daemon=True)
+            PREVIEW_THREAD.start()
+
+
+def get_preview_key(frame_number: int) -> Tuple[Any, ...]:
+    return (
+        frame_number,
+        roop.globals.replacement_path,
+        roop.globals.input_path,
+        roop.globals.reference_face_position,
+        roop.globals.reference_frame_number,
+        roop.globals.many_faces,
+        roop.globals.similar_face_distance,
+        tuple(roop.globals.frame_processors)
+    )
+
+
+def is_preview_stale(generation: int) -> bool:
+    return generation != PREVIEW_GENERATION
+
+
+def render_preview_loop() -> None:
+    global PREVIEW_REQUEST
+
+    while True:
+        with PREVIEW_CONDITION:
+            while PREVIEW_REQUEST is None:
+                PREVIEW_CONDITION.wait()
+            generation, frame_number, preview_key = PREVIEW_REQUEST
+            PREVIEW_REQUEST = None
+
+        try:
+            render_preview(generation, frame_number, preview_key)
+        except Exception as exception:
+            print(exception)
+
+
+def render_preview(generation: int, frame_number: int, preview_key: Tuple[Any, ...]) -> None:
+    temp_frame = get_video_frame(roop.globals.input_path, frame_number)
+
+    if temp_frame is None:
+        return
+
+    # render a draft of the downscaled frame first, then the full quality one
+
+    height, width = temp_frame.shape[:2]
+    draft_scale = min(PREVIEW_DRAFT_SIZE / max(height, width), 1)
+    draft_frame = cv2.resize(temp_frame, (int(width * draft_scale), int(height * draft_scale)), interpolation=cv2.INTER_AREA)
+
+    if predict_frame(draft_frame):
+        PREVIEW_RESULTS.put((generation, preview_key, None))
+        return
+
+    source_face = get_preview_source_face()
+    reference_face = get_preview_reference_face(generation)
+
+    # stored detections of a processed run skip detection for both renders
 
-        if predict_frame(temp_frame):
+    if is_video(roop.globals.input_path):
+        media_probe = probe(roop.globals.input_path)
+        resolution = (media_probe['width'], media_probe['height'])
+        if abs(media_probe['rotation']) in [90, 270]:
+            resolution = resolution[::-1]
+        open_face_store(roop.globals.input_path, media_probe['fps'], resolution)
+        set_frame_number(max(frame_number - 1, 0))
+
+    try:
+        if is_preview_stale(generation):
+            return
+        PREVIEW_RESULTS.put((generation, None, process_preview_frame(source_face, reference_face, draft_frame)))
+
+        if is_preview_stale(generation):
+            return
+        PREVIEW_RESULTS.put((generation, preview_key, process_preview_frame(source_face, reference_face, temp_frame)))
+    finally:
+        set_frame_number(None)
+
+
+def get_preview_source_face() -> Optional[Face]:
+    global PREVIEW_SOURCE_PATH, PREVIEW_SOURCE_FACE
+
+    if PREVIEW_SOURCE_PATH != roop.globals.replacement_path:
+        PREVIEW_SOURCE_FACE = get_one_face(cv2.imread(roop.globals.replacement_path))
+        PREVIEW_SOURCE_PATH = roop.globals.replacement_path
+
+    return PREVIEW_SOURCE_FACE
+
+
+def get_preview_reference_face(generation: int) -> Optional[Face]:
+    if get_face_reference():
+        return get_face_reference()
+
+    reference_frame = get_video_frame(roop.globals.input_path, roop.globals.reference_frame_number)
+    reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
+
+    if not is_preview_stale(generation):
+        set_face_reference(reference_face)
+
+    return reference_face
+
+
+def process_preview_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Image.Image:
+    temp_frame = temp_frame.copy()
+
+    for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
+        temp_frame = frame_processor.process_frame(
+            source_face,
+            reference_face,
+            temp_frame
+        )
+
+    image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
+    return ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
+
+
+def poll_preview() -> None:
+    while not PREVIEW_RESULTS.empty():
+        generation, preview_key, image = PREVIEW_RESULTS.get()
+
+        # nsfw frames stop the application as before
+
+        if image is None:
             sys.exit()
 
-        source_face = get_one_face(cv2.imread(roop.globals.replacement_path))
-
-        if not get_face_reference():
-            reference_frame = get_video_frame(roop.globals.input_path, roop.globals.reference_frame_number)
-            reference_face = get_one_face(reference_frame, roop.globals.reference_face_position)
-            set_face_reference(reference_face)
-        else:
-            reference_face = get_face_reference()
-
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            temp_frame = frame_processor.process_frame(
-                source_face,
-                reference_face,
-                temp_frame
-            )
-
-        image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
-        image = ImageOps.contain(image, (PREVIEW_MAX_WIDTH, PREVIEW_MAX_HEIGHT), Image.LANCZOS)
-        image = ctk.CTkImage(image, size=image.size)
-        preview_label.configure(image=image)
+        if preview_key:
+            PREVIEW_CACHE[preview_key] = image
+            PREVIEW_CACHE.move_to_end(preview_key)
+            while len(PREVIEW_CACHE) > PREVIEW_CACHE_SIZE:
+                PREVIEW_CACHE.popitem(last=False)
+
+        if not is_preview_stale(generation):
+            show_preview(image)
+
+    PREVIEW.after(PREVIEW_POLL_INTERVAL, poll_preview)
+
+
+def show_preview(image: Image.Image) -> None:
+    preview_label.configure(image=ctk.CTkImage(image, size=image.size))
 
 
 def update_face_reference(steps: int) -> None:
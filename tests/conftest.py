@@ -0,0 +1,19 @@
+import importlib
+import sys
+import types
+from typing import Any
+
+
+def stub_missing_module(name: str, **attributes: Any) -> None:
+    # the ui toolkit and the nsfw predictor are not needed by the tested modules and may not be installed
+
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+stub_missing_module('roop.ui', update_status=lambda message: None)
+stub_missing_module('roop.predictor', predict_frame=lambda target_frame: False, predict_image=lambda target_path: False, predict_images=lambda target_paths: False, predict_video=lambda target_path: False)
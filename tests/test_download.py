@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Tuple
+import pytest
+
+import roop.download as download
+
+MODEL_CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+CHANGED_MODEL_CONTENT = os.urandom(len(MODEL_CONTENT))
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    # serves the files of the server with etag, range and if-range support like the model hosts
+
+    def do_HEAD(self) -> None:
+        self.send_content(False)
+
+    def do_GET(self) -> None:
+        self.send_content(True)
+
+    def send_content(self, body: bool) -> None:
+        files: Dict[str, bytes] = self.server.files  # type: ignore[attr-defined]
+        requests: List[Tuple[str, Dict[str, str]]] = self.server.requests  # type: ignore[attr-defined]
+        requests.append((self.command, dict(self.headers)))
+        content = files.get(self.path)
+
+        if content is None:
+            self.send_error(404)
+            return
+
+        etag = '"' + hashlib.sha256(content).hexdigest()[:16] + '"'
+        start = 0
+        range_header = self.headers.get('Range')
+
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            start = int(range_header.removeprefix('bytes=').rstrip('-'))
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if body:
+            self.wfile.write(content[start:])
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> Iterator[Any]:
+    model_server = ThreadingHTTPServer(('127.0.0.1', 0), ModelRequestHandler)
+    model_server.files = {'/model.onnx': MODEL_CONTENT, '/other.onnx': MODEL_CONTENT[::-1]}  # type: ignore[attr-defined]
+    model_server.requests = []  # type: ignore[attr-defined]
+    thread = threading.Thread(target=model_server.serve_forever, daemon=True)
+    thread.start()
+    yield model_server
+    model_server.shutdown()
+    model_server.server_close()
+
+
+def get_url(server: Any, path: str) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+def test_download_and_reuse(server: Any, tmp_path: Any) -> None:
+    urls = [get_url(server, '/model.onnx'), get_url(server, '/other.onnx')]
+    download.conditional_download(str(tmp_path), urls)
+
+    assert (tmp_path / 'model.onnx').read_bytes() == MODEL_CONTENT
+    assert (tmp_path / 'other.onnx').read_bytes() == MODEL_CONTENT[::-1]
+    assert not list(tmp_path.glob('*.part*'))
+
+    server.requests.clear()
+    download.conditional_download(str(tmp_path), urls)
+
+    assert server.requests == []
+
+
+def test_resume_unchanged_part(server: Any, tmp_path: Any) -> None:
+    url = get_url(server, '/model.onnx')
+    (tmp_path / 'model.onnx.part').write_bytes(MODEL_CONTENT[:1024])
+    etag = '"' + hashlib.sha256(MODEL_CONTENT).hexdigest()[:16] + '"'
+    (tmp_path / 'model.onnx.part.validator').write_text(etag)
+    download.conditional_download(str(tmp_path), [url])
+
+    assert (tmp_path / 'model.onnx').read_bytes() == MODEL_CONTENT
+    assert server.requests[-1][1]['Range'] == 'bytes=1024-'
+
+
+def test_restart_changed_part(server: Any, tmp_path: Any) -> None:
+    url = get_url(server, '/model.onnx')
+    (tmp_path / 'model.onnx.part').write_bytes(CHANGED_MODEL_CONTENT[:1024])
+    (tmp_path / 'model.onnx.part.validator').write_text('"changed"')
+    download.conditional_download(str(tmp_path), [url])
+
+    assert (tmp_path / 'model.onnx').read_bytes() == MODEL_CONTENT
+    assert server.requests[-1][1]['If-Range'] == '"changed"'
+
+
+def test_complete_part(server: Any, tmp_path: Any) -> None:
+    url = get_url(server, '/model.onnx')
+    (tmp_path / 'model.onnx.part').write_bytes(MODEL_CONTENT)
+    (tmp_path / 'model.onnx.part.validator').write_text('"' + hashlib.sha256(MODEL_CONTENT).hexdigest()[:16] + '"')
+    download.conditional_download(str(tmp_path), [url])
+
+    assert (tmp_path / 'model.onnx').read_bytes() == MODEL_CONTENT
+    assert len(server.requests) == 1
+
+
+def test_pinned_checksum_mismatch(server: Any, tmp_path: Any, monkeypatch: Any) -> None:
+    url = get_url(server, '/model.onnx')
+    monkeypatch.setitem(download.DOWNLOAD_SHA256S, url, hashlib.sha256(CHANGED_MODEL_CONTENT).hexdigest())
+
+    with pytest.raises(IOError):
+        download.conditional_download(str(tmp_path), [url])
+    assert not (tmp_path / 'model.onnx').exists()
+    assert len([request for request in server.requests if request[0] == 'GET']) == download.DOWNLOAD_RETRIES
@@ -0,0 +1,75 @@
+import os
+from typing import Any, Iterator
+import numpy
+import pytest
+from insightface.app.common import Face
+
+import roop.face_store as face_store
+import roop.file as file
+import roop.globals
+
+FRAME_WIDTH = 64
+FRAME_HEIGHT = 48
+
+
+@pytest.fixture(autouse=True)
+def face_store_globals(tmp_path: Any) -> Iterator[None]:
+    roop.globals.detection_size = 640
+    roop.globals.detection_proxy_size = None
+    roop.globals.face_analyser_modules = ['detection', 'recognition']
+    roop.globals.model_precision = 'fp32'
+    roop.globals.keep_frames = False
+    roop.globals.draft = False
+    roop.globals.temp_directories = [str(tmp_path / 'shm')]
+    file.TEMP_ROOTS.clear()
+    yield
+    face_store.close_face_store()
+    file.TEMP_ROOTS.clear()
+
+
+def create_input(tmp_path: Any) -> str:
+    input_path = str(tmp_path / 'input' / 'clip.mp4')
+    os.makedirs(os.path.dirname(input_path))
+    with open(input_path, 'wb') as input_file:
+        input_file.write(os.urandom(1024))
+    return input_path
+
+
+def test_face_store_survives_cleaned_and_changed_temp_root(tmp_path: Any) -> None:
+    input_path = create_input(tmp_path)
+    frame = numpy.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=numpy.uint8)
+    face = Face(bbox=numpy.array([1, 2, 30, 40], dtype=numpy.float32), kps=numpy.ones((5, 2), dtype=numpy.float32), det_score=numpy.float32(0.9))
+
+    # frames are extracted to the first temp root and the detections of the run are stored
+
+    os.makedirs(file.get_temp_directory_path_in(input_path, roop.globals.temp_directories[0]))
+    face_store.open_face_store(input_path, 30, (FRAME_WIDTH, FRAME_HEIGHT))
+    face_store.set_frame_number(0)
+    face_store.store_faces(frame, [face])
+    face_store.set_frame_number(None)
+    face_store.save_face_store()
+    face_store.close_face_store()
+
+    # cleanup removes the frames and a later run picks another root
+
+    file.clean_temp_directory(input_path)
+    file.TEMP_ROOTS.clear()
+    roop.globals.temp_directories = [str(tmp_path / 'other')]
+
+    face_store.open_face_store(input_path, 30, (FRAME_WIDTH, FRAME_HEIGHT))
+    face_store.set_frame_number(0)
+    stored_faces = face_store.get_stored_faces(frame)
+    face_store.set_frame_number(None)
+
+    assert stored_faces is not None and len(stored_faces) == 1
+    assert numpy.allclose(stored_faces[0].bbox, face.bbox)
+
+
+def test_face_store_key_matches_for_cli_and_preview_fps(tmp_path: Any) -> None:
+    input_path = create_input(tmp_path)
+
+    # the cli falls back to the int 30, the preview passes the probed float
+
+    assert face_store.get_face_store_key(input_path, 30) == face_store.get_face_store_key(input_path, 30.0)
+    assert face_store.get_face_store_key(input_path, 30000 / 1001) == face_store.get_face_store_key(input_path, 29.97002997)
+    assert face_store.get_face_store_key(input_path, 30) != face_store.get_face_store_key(input_path, 25.0)
@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Iterator, List
+import cv2
+import numpy
+import psutil
+import pytest
+
+import roop.globals
+import roop.processors.frame.core as frame_core
+from roop.typing import Frame
+
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 720
+FRAME_SIZE = FRAME_WIDTH * FRAME_HEIGHT * 3
+SHORT_FRAME_TOTAL = 60
+LONG_FRAME_TOTAL = 300
+ENCODER_DELAY = 0.02
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+@pytest.fixture(autouse=True)
+def pipeline_globals() -> Iterator[None]:
+    roop.globals.execution_threads = 2
+    roop.globals.io_threads = 2
+    roop.globals.max_memory = None
+    roop.globals.keep_frames = False
+    yield
+    frame_core.clear_frame_encoder()
+
+
+def create_frame_file_paths(directory: str, frame_total: int) -> List[str]:
+    frame = numpy.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=numpy.uint8)
+    frame_file_paths = []
+
+    for frame_number in range(frame_total):
+        frame[:, :, 0] = frame_number % 256
+        frame_file_path = os.path.join(directory, '%04d.png' % (frame_number + 1))
+        cv2.imwrite(frame_file_path, frame)
+        frame_file_paths.append(frame_file_path)
+    return frame_file_paths
+
+
+def measure_peak_rss(run: Callable[[], Any]) -> int:
+    process = psutil.Process(os.getpid())
+    start_rss = process.memory_info().rss
+    peak_rss = start_rss
+    done = threading.Event()
+
+    def sample() -> None:
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, process.memory_info().rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        run()
+    finally:
+        done.set()
+        sampler.join()
+    return peak_rss - start_rss
+
+
+def run_pipeline(frame_file_paths: List[str]) -> List[int]:
+    encoded_frames: List[int] = []
+
+    # the encoder is the slow end, an unbounded pipeline would pile the decoded frames up in front of it
+
+    def encode_frame(temp_frame: Frame) -> None:
+        time.sleep(ENCODER_DELAY)
+        encoded_frames.append(int(temp_frame[0, 0, 0]))
+
+    frame_core.set_frame_encoder(encode_frame)
+    frame_core.multi_process_frame(frame_file_paths, lambda temp_frame: temp_frame.copy(), lambda: None)
+    frame_core.clear_frame_encoder()
+    return encoded_frames
+
+
+def test_peak_rss_stays_flat_on_long_clip(tmp_path: Any) -> None:
+    short_frame_file_paths = create_frame_file_paths(str(tmp_path), SHORT_FRAME_TOTAL)
+    long_frame_file_paths = create_frame_file_paths(str(tmp_path), LONG_FRAME_TOTAL)
+
+    # the short clip already fills every frame slot, the long clip may only add to the run time
+
+    run_pipeline(short_frame_file_paths)
+
+    short_peak_rss = measure_peak_rss(lambda: run_pipeline(short_frame_file_paths))
+    long_peak_rss = measure_peak_rss(lambda: run_pipeline(long_frame_file_paths))
+
+    # five times the frames may not hold more than a handful of extra frames at once
+
+    assert long_peak_rss - short_peak_rss < FRAME_SIZE * 16
+
+
+def test_frames_reach_encoder_in_order(tmp_path: Any) -> None:
+    frame_file_paths = create_frame_file_paths(str(tmp_path), SHORT_FRAME_TOTAL)
+
+    assert run_pipeline(frame_file_paths) == [frame_number % 256 for frame_number in range(SHORT_FRAME_TOTAL)]
+
+
+def test_read_error_stops_pipeline(tmp_path: Any) -> None:
+    frame_file_paths = create_frame_file_paths(str(tmp_path), SHORT_FRAME_TOTAL)
+    corrupt_frame_file_path = frame_file_paths[SHORT_FRAME_TOTAL // 2]
+
+    # a png cut off after its header cannot be decoded
+
+    with open(corrupt_frame_file_path, 'r+b') as corrupt_frame_file:
+        corrupt_frame_file.truncate(64)
+
+    with pytest.raises(IOError, match=re.escape(corrupt_frame_file_path)):
+        run_pipeline(frame_file_paths)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import time
+from types import SimpleNamespace
+from typing import Any, Iterator, List, Optional
+import numpy
+import pytest
+
+import roop.globals
+import roop.live as live
+from roop.typing import Frame
+
+FRAME_WIDTH = 64
+FRAME_HEIGHT = 48
+FRAME_TOTAL = 90
+FRAME_FPS = 30.0
+FACE_FRAME_NUMBER = 15
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+
+
+@pytest.fixture(autouse=True)
+def live_globals(tmp_path: Any) -> Iterator[None]:
+    roop.globals.input_path = str(tmp_path / 'input.raw')
+    roop.globals.output_path = str(tmp_path / 'output.mp4')
+    roop.globals.replacement_path = None
+    roop.globals.live_resolution = f'{FRAME_WIDTH}x{FRAME_HEIGHT}'
+    roop.globals.live_fps = FRAME_FPS
+    roop.globals.live_latency = 1000
+    roop.globals.execution_threads = 2
+    roop.globals.many_faces = False
+    roop.globals.reference_face_position = 0
+    roop.globals.allow_nsfw = True
+    roop.globals.log_level = 'error'
+    roop.globals.output_video_encoder = 'libx264'
+    roop.globals.frame_processors = ['fake']
+
+    # the blue channel carries the frame number, faces show up from a later frame on
+
+    with open(roop.globals.input_path, 'wb') as input_file:
+        for frame_number in range(FRAME_TOTAL):
+            input_file.write(numpy.full((FRAME_HEIGHT, FRAME_WIDTH, 3), (frame_number * 2, 0, 0), dtype=numpy.uint8).tobytes())
+    yield
+
+
+def get_frame_number(temp_frame: Frame) -> int:
+    return int(round(temp_frame[0, 0, 0] / 2))
+
+
+def fake_get_one_face(temp_frame: Frame, position: int = 0) -> Optional[Any]:
+    frame_number = get_frame_number(temp_frame)
+    return SimpleNamespace(frame_number=frame_number) if frame_number >= FACE_FRAME_NUMBER else None
+
+
+def test_live_replays_local_file_in_real_time_and_finds_reference_later(monkeypatch: Any) -> None:
+    processed: List[Any] = []
+    statuses: List[str] = []
+
+    def process_frame(source_face: Any, reference_face: Any, temp_frame: Frame) -> Frame:
+        processed.append((get_frame_number(temp_frame), reference_face))
+        return temp_frame
+
+    # a single worker sees the frames in order, with more a frame read before the face may be processed after it
+
+    roop.globals.execution_threads = 1
+    monkeypatch.setattr(live, 'get_one_face', fake_get_one_face)
+    monkeypatch.setattr(live, 'get_frame_processors_modules', lambda frame_processors: [SimpleNamespace(process_frame=process_frame)])
+    monkeypatch.setattr(live, 'update_status', lambda message, scope: statuses.append(message))
+
+    start_time = time.perf_counter()
+    assert live.start_live()
+    elapsed = time.perf_counter() - start_time
+
+    # the local file is replayed at its native rate instead of as fast as it decodes, ffmpeg reads up to half a second ahead
+
+    assert elapsed >= FRAME_TOTAL / FRAME_FPS - 0.75
+    assert os.path.getsize(roop.globals.output_path) > 0
+    assert 'Reference face found' in statuses
+
+    # frames before the face pass unprocessed, later frames all use the face found first
+
+    assert processed
+    assert all(frame_number >= FACE_FRAME_NUMBER for frame_number, _ in processed)
+    assert len({id(reference_face) for _, reference_face in processed}) == 1
+
+
+def test_live_raises_processor_errors_without_hanging(monkeypatch: Any) -> None:
+    def process_frame(source_face: Any, reference_face: Any, temp_frame: Frame) -> Frame:
+        raise RuntimeError('processor failed')
+
+    roop.globals.many_faces = True
+    monkeypatch.setattr(live, 'get_frame_processors_modules', lambda frame_processors: [SimpleNamespace(process_frame=process_frame)])
+    monkeypatch.setattr(live, 'update_status', lambda message, scope: None)
+
+    start_time = time.perf_counter()
+    with pytest.raises(RuntimeError, match='processor failed'):
+        live.start_live()
+
+    # the stream stops at the first failure rather than after the whole file
+
+    assert time.perf_counter() - start_time < FRAME_TOTAL / FRAME_FPS
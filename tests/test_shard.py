@@ -0,0 +1,195 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import pytest
+
+import roop.globals
+import roop.shard as shard
+from roop.file import lock_file
+
+SHARD_FRAME_TOTAL = 40
+
+
+class ForkedShard:
+    # stands in for the subprocess of launch_shard, the fork keeps the patched pipeline
+
+    def __init__(self, process: Any) -> None:
+        self.process = process
+
+    def poll(self) -> Optional[int]:
+        return self.process.exitcode
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.exitcode
+
+
+def run_forked_shard(shard_index: int) -> None:
+    os._exit(0 if shard.process_shard(shard_index) else 1)
+
+
+def launch_forked_shard(shard_index: int) -> ForkedShard:
+    process = multiprocessing.get_context('fork').Process(target=run_forked_shard, args=(shard_index,))
+    process.start()
+    return ForkedShard(process)
+
+
+def extract_frame_range(input_file_path: str, output_directory_path: str, start_frame_number: int, frame_total: int, fps: float = 30) -> bool:
+    for frame_number in range(frame_total):
+        with open(os.path.join(output_directory_path, '%04d.png' % (frame_number + 1)), 'w') as frame_file:
+            frame_file.write(str(start_frame_number + frame_number))
+    return True
+
+
+def create_segment(frame_directory_path: str, output_file_path: str, fps: float = 30) -> bool:
+    with open(output_file_path, 'w') as segment_file:
+        segment_file.write(','.join(open(os.path.join(frame_directory_path, frame_file_name)).read() for frame_file_name in sorted(os.listdir(frame_directory_path))))
+    return True
+
+
+def concat_segments(segment_list_file_path: str, input_file_path: str, output_file_path: str, audio: bool = False) -> bool:
+    with open(segment_list_file_path) as segment_list_file:
+        segment_file_paths = [line.strip()[len("file '"):-1] for line in segment_list_file]
+    with open(output_file_path, 'w') as output_file:
+        output_file.write(','.join(open(segment_file_path).read() for segment_file_path in segment_file_paths))
+    return True
+
+
+def create_frame_processor(crash_file_path: str) -> Any:
+    # the shard of the crash file exits hard on its first attempt, as a killed worker would
+
+    def process_video(replacement_path: str, temp_frame_paths: List[str]) -> None:
+        if os.path.isfile(crash_file_path) and open(temp_frame_paths[0]).read() == open(crash_file_path).read():
+            os.remove(crash_file_path)
+            os._exit(3)
+        time.sleep(0.2)
+
+    return SimpleNamespace(NAME='ROOP.TEST', process_video=process_video, post_process=lambda: None)
+
+
+@pytest.fixture
+def shard_setup(tmp_path: Any, monkeypatch: Any) -> Dict[str, str]:
+    input_file_path = str(tmp_path / 'input.mp4')
+    replacement_file_path = str(tmp_path / 'replacement.jpg')
+    crash_file_path = str(tmp_path / 'crash')
+    for file_path in [input_file_path, replacement_file_path]:
+        with open(file_path, 'w') as file:
+            file.write(os.path.basename(file_path))
+
+    monkeypatch.setattr(roop.globals, 'input_path', input_file_path)
+    monkeypatch.setattr(roop.globals, 'replacement_path', replacement_file_path)
+    monkeypatch.setattr(roop.globals, 'output_path', str(tmp_path / 'output.mp4'))
+    monkeypatch.setattr(roop.globals, 'frame_processors', ['face_swapper'])
+    monkeypatch.setattr(roop.globals, 'headless', True)
+    monkeypatch.setattr(roop.globals, 'allow_nsfw', True)
+    monkeypatch.setattr(roop.globals, 'many_faces', True)
+    monkeypatch.setattr(roop.globals, 'autotune', False)
+    monkeypatch.setattr(roop.globals, 'skip_audio', True)
+    monkeypatch.setattr(roop.globals, 'keep_frames', False)
+    monkeypatch.setattr(roop.globals, 'temp_frame_format', 'png')
+    monkeypatch.setattr(roop.globals, 'shard_count', 4)
+    monkeypatch.setattr(roop.globals, 'shard_workers', 4)
+    monkeypatch.setattr(roop.globals, 'shard_retries', 1)
+    monkeypatch.setattr(roop.globals, 'shard_directory', str(tmp_path / 'shards'))
+    monkeypatch.setattr(shard, 'SHARD_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(shard, 'SHARD_HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(shard, 'get_shard_fps', lambda input_file_path: (30, SHARD_FRAME_TOTAL))
+    monkeypatch.setattr(shard, 'launch_shard', launch_forked_shard)
+    monkeypatch.setattr(shard, 'extract_frame_range', extract_frame_range)
+    monkeypatch.setattr(shard, 'create_segment', create_segment)
+    monkeypatch.setattr(shard, 'concat_segments', concat_segments)
+    monkeypatch.setattr(shard, 'get_frame_processors_modules', lambda frame_processors: [create_frame_processor(crash_file_path)])
+    return {'crash': crash_file_path, 'output': roop.globals.output_path}
+
+
+def read_output(output_file_path: str) -> List[int]:
+    with open(output_file_path) as output_file:
+        return [int(frame_number) for frame_number in output_file.read().split(',')]
+
+
+def test_shards_in_worker_processes(shard_setup: Dict[str, str]) -> None:
+    with open(shard_setup['crash'], 'w') as crash_file:
+        crash_file.write(str(SHARD_FRAME_TOTAL // 4))
+
+    assert shard.start_shard(None)
+    assert read_output(shard_setup['output']) == list(range(SHARD_FRAME_TOTAL))
+
+
+def test_status_updates_from_many_processes(shard_setup: Dict[str, str]) -> None:
+    shard.init_status(roop.globals.input_path)
+    context = multiprocessing.get_context('fork')
+
+    def count_updates(shard_index: int) -> None:
+        for attempts in range(1, 51):
+            shard.update_shard_status(roop.globals.input_path, shard_index, attempts=attempts)
+
+    processes = [context.Process(target=count_updates, args=(shard_index,)) for shard_index in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [shard_status['attempts'] for shard_status in shard.read_status(roop.globals.input_path)['shards']] == [50] * 4
+
+
+def test_requeue_silent_remote_shard(shard_setup: Dict[str, str], monkeypatch: Any) -> None:
+    monkeypatch.setattr(roop.globals, 'shard_workers', 0)
+    monkeypatch.setattr(shard, 'SHARD_HEARTBEAT_TIMEOUT', 0.5)
+    init_status = shard.init_status
+    status_ready = threading.Event()
+    results: List[bool] = []
+
+    def init_coordinator_status(input_file_path: str) -> Dict[str, Any]:
+        status = init_status(input_file_path)
+        status_ready.set()
+        return status
+
+    monkeypatch.setattr(shard, 'init_status', init_coordinator_status)
+    coordinator = threading.Thread(target=lambda: results.append(shard.start_shard(None)), daemon=True)
+    coordinator.start()
+    status_ready.wait()
+
+    # four remote workers pick up the shards, the last one dies without reporting
+
+    with open(shard_setup['crash'], 'w') as crash_file:
+        crash_file.write(str(SHARD_FRAME_TOTAL * 3 // 4))
+    remote_workers = [launch_forked_shard(shard_index) for shard_index in range(4)]
+    for remote_worker in remote_workers:
+        remote_worker.process.join()
+    coordinator.join(timeout=30)
+
+    assert [remote_worker.returncode for remote_worker in remote_workers] == [0, 0, 0, 3]
+    assert results == [True]
+    assert read_output(shard_setup['output']) == list(range(SHARD_FRAME_TOTAL))
+
+
+def test_done_shards_invalidated_by_settings(shard_setup: Dict[str, str], monkeypatch: Any) -> None:
+    status_file_path = os.path.join(roop.globals.shard_directory, shard.STATUS_FILE)
+    status = shard.init_status(roop.globals.input_path)
+    with lock_file(status_file_path + '.lock'):
+        for shard_status in status['shards']:
+            shard_status['status'] = 'done'
+        shard.write_status(roop.globals.input_path, status)
+
+    assert all(shard_status['status'] == 'done' for shard_status in shard.init_status(roop.globals.input_path)['shards'])
+
+    monkeypatch.setattr(roop.globals, 'model_precision', 'int8')
+
+    assert all(shard_status['status'] == 'pending' for shard_status in shard.init_status(roop.globals.input_path)['shards'])
+
+    with open(status_file_path) as status_file:
+        assert json.load(status_file)['settings'] == shard.get_shard_settings_key(roop.globals.input_path)
+
+
+def test_reference_frame_number_counts_extracted_frames(monkeypatch: Any) -> None:
+    # without keep_fps the frames are extracted at 30 fps from a 60 fps video, the reference is at the same moment
+
+    monkeypatch.setattr(shard, 'probe', lambda input_file_path: {'fps': 60.0})
+    monkeypatch.setattr(roop.globals, 'reference_frame_number', 45)
+
+    assert shard.get_reference_video_frame_number('input.mp4', 30) == 90
+    assert shard.get_reference_video_frame_number('input.mp4', 60.0) == 45